@@ -1,55 +1,36 @@
-import time
-import requests
 import os
 
-from flock_server import (
-    User,
-    Setting,
-    KeybaseNotification,
-    create_api_app,
-    start_keybase_bot,
-    elasticsearch_url,
-)
+from flock_server import create_api_app, create_storage, start_keybase_bot
 
 
 if __name__ == "__main__":
-    # Wait for ElasticSearch to start
-    print("Waiting for ElasticSearch")
-    while True:
-        try:
-            if "ELASTIC_CA_CERT" in os.environ:
-                ca_cert_path = os.environ["ELASTIC_CA_CERT"]
-            else:
-                ca_cert_path = None
-
-            r = requests.get(elasticsearch_url, verify=ca_cert_path)
-            print("{} is ready".format(elasticsearch_url))
-            break
-
-        except:
-            print("{} not ready, waiting ...".format(elasticsearch_url))
-            time.sleep(5)
-
-    # Initialize models
-    print("Initializing user model")
-    try:
-        User.init()
-    except:
-        pass
-    try:
-        Setting.init()
-    except:
-        pass
-    try:
-        KeybaseNotification.init()
-    except:
-        pass
+    # Wait for storage to be ready, and initialize it: with ElasticSearch, the models
+    # and the indices that osquery data goes into
+    create_storage().setup()
 
     if os.environ.get("FLOCK_KEYBASE") == "1":
         # Start keybase bot
         start_keybase_bot()
 
-    else:
-        # Start web service
+    elif os.environ.get("FLOCK_DEV_SERVER") == "1":
+        # Start the single-process development web service, with its metrics on
+        # their own port
+        from flock_server.metrics import start_http_server
+
+        metrics_port = int(os.environ.get("FLOCK_METRICS_PORT", 9102))
+        if metrics_port:
+            start_http_server(metrics_port)
         app = create_api_app()
         app.run(host="0.0.0.0", port=5000, debug=True)
+
+    elif os.environ.get("FLOCK_ASYNC_SERVER") == "1":
+        # Start the asyncio web service
+        from flock_server.async_api import main
+
+        main()
+
+    else:
+        # Start the production web service
+        os.execvp(
+            "gunicorn", ["gunicorn", "-c", "gunicorn.conf.py", "flock_server.wsgi:app"]
+        )
@@ -0,0 +1,151 @@
+"""
+A stand-in for ElasticSearch, with just enough of the API for the gateway.
+
+It keeps users and settings in memory so agents can register and authenticate,
+and it acknowledges bulk requests without storing the docs (except their _ids, so
+creating a doc twice conflicts like it does in ElasticSearch). It's for
+benchmarking the gateway without a cluster, not for testing queries.
+"""
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ElasticsearchStub:
+    def __init__(self, host="127.0.0.1", port=0, bulk_latency=0):
+        # bulk_latency is how many seconds each bulk request takes
+        self.bulk_latency = bulk_latency
+        self.docs = {}
+        self.created_ids = set()
+        self.bulk_requests = 0
+        self.bulk_docs = 0
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub._handle(self)
+
+            do_POST = do_GET
+            do_PUT = do_GET
+            do_HEAD = do_GET
+            do_DELETE = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}"
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.server.serve_forever, name="elasticsearch-stub", daemon=True
+        )
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, handler):
+        length = int(handler.headers.get("Content-Length", 0))
+        body = handler.rfile.read(length) if length else b""
+        path = handler.path.split("?")[0].strip("/").split("/")
+
+        if path == [""]:
+            response = {
+                "version": {"number": "7.6.2", "build_flavor": "default"},
+                "tagline": "You Know, for Search",
+            }
+        elif path[-1] == "_bulk":
+            response = self._bulk(body)
+        elif len(path) == 2 and path[1] == "_search":
+            response = self._search(path[0], json.loads(body) if body else {})
+        elif len(path) >= 2 and path[1] == "_doc":
+            response = self._index(path[0], json.loads(body))
+        else:
+            # Refreshes, templates, lifecycle policies and so on
+            response = {"acknowledged": True}
+
+        data = json.dumps(response).encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.send_header("X-Elastic-Product", "Elasticsearch")
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(data)
+
+    def _index(self, index, doc):
+        with self._lock:
+            docs = self.docs.setdefault(index, [])
+            doc_id = str(len(docs))
+            docs.append((doc_id, doc))
+        return {"_index": index, "_id": doc_id, "result": "created"}
+
+    def _search(self, index, body):
+        # Only supports the term filters the gateway uses to look up users and
+        # settings
+        terms = {}
+        for query in body.get("query", {}).get("bool", {}).get("filter", []):
+            if "term" in query:
+                terms.update(query["term"])
+
+        with self._lock:
+            docs = list(self.docs.get(index, []))
+        hits = [
+            {"_index": index, "_id": doc_id, "_score": 0, "_source": doc}
+            for doc_id, doc in docs
+            if all(doc.get(key) == value for key, value in terms.items())
+        ]
+        return {
+            "took": 0,
+            "timed_out": False,
+            "hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits},
+        }
+
+    def _bulk(self, body):
+        if self.bulk_latency:
+            time.sleep(self.bulk_latency)
+
+        items = []
+        errors = False
+        lines = body.splitlines()
+        i = 0
+        with self._lock:
+            while i < len(lines):
+                if not lines[i].strip():
+                    i += 1
+                    continue
+                action = json.loads(lines[i])
+                op_type, meta = next(iter(action.items()))
+                i += 1 if op_type == "delete" else 2
+
+                doc_id = meta.get("_id")
+                if op_type == "create" and doc_id in self.created_ids:
+                    errors = True
+                    items.append(
+                        {
+                            op_type: {
+                                "_id": doc_id,
+                                "status": 409,
+                                "error": {
+                                    "type": "version_conflict_engine_exception",
+                                    "reason": "document already exists",
+                                },
+                            }
+                        }
+                    )
+                    continue
+                if op_type == "create":
+                    self.created_ids.add(doc_id)
+                items.append({op_type: {"_id": doc_id, "status": 201}})
+
+            self.bulk_requests += 1
+            self.bulk_docs += len(items)
+        return {"took": 0, "errors": errors, "items": items}
@@ -0,0 +1,345 @@
+"""
+Simulate a fleet of agents sending osquery results and logs to the gateway.
+
+Each simulated agent registers with /register, then sends osquery differential
+results to /submit, snapshot results every few rounds, and log events to
+/submit_flock_logs, and the benchmark reports throughput, latency percentiles and
+error rates for each endpoint.
+
+By default it runs offline: it starts an ElasticSearch stand-in and a gateway in
+this process, so it doesn't need a cluster and its results are reproducible. The
+gateway reads its usual FLOCK_* environment variables. The agents share this
+process with the gateway, so to measure a real deployment, start the gateway
+separately and pass its URL:
+
+    pipenv run python -m benchmarks.fleet --agents 50 --duration 30
+    pipenv run python -m benchmarks.fleet --url http://127.0.0.1:5000 --agents 500
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import secrets
+import argparse
+import threading
+from datetime import datetime
+
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from .elasticsearch_stub import ElasticsearchStub
+
+
+QUERY_NAMES = [
+    "processes",
+    "listening_ports",
+    "launchd",
+    "chrome_extensions",
+    "kernel_extensions",
+    "users",
+]
+SNAPSHOT_QUERY_NAMES = ["os_version", "system_info", "disk_encryption"]
+LOG_TYPES = ["server_enabled", "twigs_enabled", "enable_twig", "disable_twig"]
+
+
+class Stats:
+    """
+    Latencies and status codes of requests to each endpoint, from all agents
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.docs = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status, docs=0):
+        # status is the HTTP status code, or the name of the exception
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200 or status == 202:
+                self.docs += docs
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of a sorted list
+    index = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+class Agent:
+    def __init__(self, url, username, rng, args):
+        self.url = url
+        self.username = username
+        self.rng = rng
+        self.args = args
+        self.session = requests.Session()
+        self.counter = 0
+
+    def post(self, stats, endpoint, data, docs=0, auth=True):
+        body = json.dumps(data).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.args.gzip and auth:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
+        start = time.perf_counter()
+        try:
+            res = self.session.post(
+                self.url + endpoint,
+                data=body,
+                headers=headers,
+                auth=(self.username, self.token) if auth else None,
+                timeout=self.args.timeout,
+            )
+            status = res.status_code
+        except requests.RequestException as e:
+            res = None
+            status = type(e).__name__
+        stats.record(endpoint, time.perf_counter() - start, status, docs)
+        return res
+
+    def register(self, stats):
+        res = self.post(
+            stats,
+            "/register",
+            {"username": self.username, "name": self.username},
+            auth=False,
+        )
+        if res is None or res.status_code != 200:
+            return False
+        self.token = res.json()["auth_token"]
+        return True
+
+    def result(self, name, action, columns, now):
+        return {
+            "name": name,
+            "hostIdentifier": self.username,
+            "calendarTime": time.strftime("%a %b %d %H:%M:%S %Y UTC", time.gmtime(now)),
+            "unixTime": now,
+            "epoch": 0,
+            "counter": self.counter,
+            "numerics": False,
+            "action": action,
+            "columns": columns,
+        }
+
+    def columns(self):
+        n = self.rng.randrange(100000)
+        return {
+            "name": f"com.example.agent{n}",
+            "path": f"/Library/LaunchAgents/com.example.agent{n}.plist",
+            "pid": str(self.rng.randrange(100, 65536)),
+            "uid": str(self.rng.choice([0, 501, 502])),
+        }
+
+    def differential_batch(self):
+        now = int(time.time())
+        return [
+            self.result(
+                self.rng.choice(QUERY_NAMES),
+                self.rng.choice(["added", "removed"]),
+                self.columns(),
+                now,
+            )
+            for _ in range(self.args.batch_size)
+        ]
+
+    def snapshot_batch(self):
+        now = int(time.time())
+        batch = []
+        for name in SNAPSHOT_QUERY_NAMES:
+            doc = self.result(name, "snapshot", None, now)
+            del doc["columns"]
+            doc["snapshot"] = [self.columns() for _ in range(self.args.snapshot_rows)]
+            batch.append(doc)
+        return batch
+
+    def log_event(self):
+        log_type = self.rng.choice(LOG_TYPES)
+        event = {"type": log_type, "timestamp": datetime.utcnow().isoformat()}
+        if log_type in ["enable_twig", "disable_twig"]:
+            event["twig_id"] = self.rng.choice(QUERY_NAMES)
+        if log_type == "twigs_enabled":
+            event["twig_ids"] = [self.rng.choice(QUERY_NAMES)]
+        return [event]
+
+    def run(self, stats, deadline):
+        if not self.register(stats):
+            return
+
+        # Agents start at different times, like a real fleet
+        time.sleep(self.rng.uniform(0, self.args.interval))
+        while time.monotonic() < deadline:
+            self.counter += 1
+            batch = self.differential_batch()
+            self.post(stats, "/submit", batch, len(batch))
+            if self.counter % self.args.snapshot_every == 0:
+                batch = self.snapshot_batch()
+                self.post(stats, "/submit", batch, len(batch))
+            if self.counter % self.args.log_every == 0:
+                self.post(stats, "/submit_flock_logs", self.log_event())
+            if self.args.interval:
+                time.sleep(self.args.interval * self.rng.uniform(0.5, 1.5))
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_gateway(elasticsearch_url):
+    # flock_server connects to ElasticSearch when it's imported, so it's imported
+    # once it knows where the stand-in is
+    os.environ["ELASTICSEARCH_HOSTS"] = elasticsearch_url
+    from flock_server import create_api_app
+
+    server = make_server(
+        "127.0.0.1",
+        0,
+        create_api_app(),
+        threaded=True,
+        request_handler=QuietRequestHandler,
+    )
+    thread = threading.Thread(
+        target=server.serve_forever, name="flock-gateway", daemon=True
+    )
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def report(stats, seconds):
+    print(
+        f"{'endpoint':<20} {'requests':>9} {'req/s':>8} {'errors':>7} {'error %':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for endpoint in ["/register", "/submit", "/submit_flock_logs"]:
+        latencies = sorted(stats.latencies.get(endpoint, []))
+        if not latencies:
+            continue
+        statuses = stats.statuses[endpoint]
+        errors = sum(
+            count for status, count in statuses.items() if status not in [200, 202]
+        )
+        print(
+            f"{endpoint:<20} {len(latencies):>9} {len(latencies) / seconds:>8.1f} "
+            f"{errors:>7} {errors / len(latencies) * 100:>8.2f} "
+            f"{percentile(latencies, 50) * 1000:>8.1f} "
+            f"{percentile(latencies, 95) * 1000:>8.1f} "
+            f"{percentile(latencies, 99) * 1000:>8.1f}"
+        )
+        if errors:
+            details = ", ".join(
+                f"{status}: {count}"
+                for status, count in sorted(statuses.items(), key=str)
+                if status not in [200, 202]
+            )
+            print(f"{'':<20} errors by status: {details}")
+    print(f"\nosquery results accepted: {stats.docs} ({stats.docs / seconds:.0f}/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--url", help="URL of a running gateway (default: start one offline)"
+    )
+    parser.add_argument(
+        "--agents", type=int, default=20, help="number of agents (default: 20)"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=30, help="seconds to run (default: 30)"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1,
+        help="average seconds between each agent's batches, 0 to send as fast as "
+        "possible (default: 1)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=50,
+        help="osquery results in each differential batch (default: 50)",
+    )
+    parser.add_argument(
+        "--snapshot-every",
+        type=int,
+        default=10,
+        help="send snapshot results every this many batches (default: 10)",
+    )
+    parser.add_argument(
+        "--snapshot-rows",
+        type=int,
+        default=20,
+        help="rows in each snapshot result (default: 20)",
+    )
+    parser.add_argument(
+        "--log-every",
+        type=int,
+        default=30,
+        help="send a log event every this many batches (default: 30)",
+    )
+    parser.add_argument(
+        "--gzip", action="store_true", help="gzip request bodies, like the agent"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30, help="request timeout (default: 30)"
+    )
+    parser.add_argument(
+        "--bulk-latency",
+        type=float,
+        default=0,
+        help="offline only: seconds each bulk request to the ElasticSearch "
+        "stand-in takes (default: 0)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed for the results (default: 0)"
+    )
+    args = parser.parse_args()
+
+    stub = None
+    gateway = None
+    url = args.url
+    if not url:
+        stub = ElasticsearchStub(bulk_latency=args.bulk_latency)
+        stub.start()
+        gateway, url = start_gateway(stub.url)
+
+    # Usernames are unique to this run, so runs against a real gateway don't clash
+    run_id = secrets.token_hex(4)
+    stats = Stats()
+    agents = [
+        Agent(url, f"fleet-{run_id}-{i}", random.Random(args.seed + i), args)
+        for i in range(args.agents)
+    ]
+
+    print(f"Simulating {args.agents} agents for {args.duration:.0f}s against {url}\n")
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=agent.run, args=(stats, deadline), daemon=True)
+        for agent in agents
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.monotonic() - start
+
+    report(stats, seconds)
+    if stub:
+        print(
+            f"ElasticSearch stand-in: {stub.bulk_requests} bulk requests, "
+            f"{stub.bulk_docs} docs"
+        )
+        gateway.shutdown()
+        stub.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Benchmark the /submit ingest pipeline on a single core.
+
+This runs synthetic osquery results through the same parsing, validation, tagging,
+index routing and notification tallying that /submit does, without sending
+anything to ElasticSearch, so it can run anywhere:
+
+    pipenv run python -m benchmarks.ingest_pipeline
+"""
+import io
+import sys
+import json
+import time
+import argparse
+
+from flock_server.indices import IndexRouter
+from flock_server.ingest import Batch, osquery_pipeline
+from flock_server.keybase_notifications import KeybaseNotifications
+
+
+def make_body(doc_count, now):
+    # Like a real batch: a few queries, each reporting many rows at the same time
+    names = ["launchd", "processes", "listening_ports", "os_version", "users"]
+    docs = []
+    for i in range(doc_count):
+        docs.append(
+            {
+                "hostIdentifier": "benchmark",
+                "name": names[i % len(names)],
+                "action": "added" if i % 3 else "removed",
+                "unixTime": now - (i // 100),
+                "calendarTime": "Mon Apr 20 12:00:00 2020 UTC",
+                "columns": {"name": f"com.example.{i}", "path": f"/tmp/{i}"},
+            }
+        )
+    return json.dumps(docs).encode(), docs
+
+
+def time_chunks(pipeline, body, chunk_size, repeat):
+    # Parse the body and run the pipeline, like /submit
+    timings = []
+    for _ in range(repeat):
+        batch = Batch("benchmark", "Benchmark")
+        start = time.perf_counter()
+        for chunk in pipeline.chunks(io.BytesIO(body), batch, chunk_size):
+            batch.commit()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def time_run(pipeline, docs, repeat):
+    # Only the pipeline stages, on docs that are already parsed
+    timings = []
+    for _ in range(repeat):
+        batch = Batch("benchmark", "Benchmark")
+        copies = [dict(doc) for doc in docs]
+        start = time.perf_counter()
+        for _ in pipeline.run(copies, batch):
+            pass
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--docs",
+        default="1000,10000,100000",
+        help="comma-separated list of batch sizes (default: 1000,10000,100000)",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=500, help="bulk chunk size (default: 500)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per batch size (default: 3)"
+    )
+    args = parser.parse_args()
+
+    pipeline = osquery_pipeline(KeybaseNotifications(), router=IndexRouter())
+
+    print(f"{'docs':>8} {'parse+pipeline (docs/s)':>24} {'pipeline (docs/s)':>18}")
+    for doc_count in [int(count) for count in args.docs.split(",")]:
+        body, docs = make_body(doc_count, int(time.time()))
+        chunks_seconds = time_chunks(pipeline, body, args.chunk_size, args.repeat)
+        run_seconds = time_run(pipeline, docs, args.repeat)
+        print(
+            f"{doc_count:>8} {doc_count / chunks_seconds:>24.0f} "
+            f"{doc_count / run_seconds:>18.0f}"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
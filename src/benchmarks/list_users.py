@@ -0,0 +1,138 @@
+"""
+Benchmark the Keybase bot's list_users command as the fleet grows.
+
+This seeds users, host states and osquery data for fake hosts into a live
+ElasticSearch (it writes to the `user` and `host_state` indices and a
+`flock-benchmark` index, and deletes what it created afterwards), so run it
+against the test containers, not production. With --without-host-states, hosts
+have no host state, so list_users searches their osquery data instead:
+
+    docker-compose -f tests.yml up --build -d
+    docker exec -it flock-server_test-gateway_1 pipenv run python -m benchmarks.list_users
+"""
+import sys
+import time
+import asyncio
+import secrets
+import argparse
+from types import SimpleNamespace
+
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Index, Search
+
+from flock_server.elasticsearch import es
+from flock_server.keybase import Handler
+
+
+BENCHMARK_INDEX = "flock-benchmark"
+
+
+class BotStub:
+    def __init__(self):
+        async def send(channel, message):
+            pass
+
+        self.chat = SimpleNamespace(send=send)
+
+
+def seed(fleet_size, docs_per_host, host_states=True):
+    def actions():
+        for i in range(fleet_size):
+            username = f"benchmark-{i}"
+            yield {
+                "_index": "user",
+                "_source": {
+                    "username": username,
+                    "name": f"Benchmark {i}",
+                    "token": secrets.token_hex(16),
+                },
+            }
+            if host_states:
+                yield {
+                    "_index": "host_state",
+                    "_id": username,
+                    "_source": {
+                        "username": username,
+                        "last_seen": "2020-04-20T12:01:00.000Z",
+                        "last_result_at": "2020-04-20T12:00:00.000Z",
+                        "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+                        "submit_count": docs_per_host,
+                        "doc_count": docs_per_host,
+                    },
+                }
+            for j in range(docs_per_host):
+                yield {
+                    "_index": BENCHMARK_INDEX,
+                    "_source": {
+                        "hostIdentifier": username,
+                        "name": "os_version" if j == 0 else "launchd",
+                        "calendarTime": "Mon Apr 20 12:00:00 2020 UTC",
+                        "@timestamp": f"2020-04-20T12:00:{j % 60:02}.000Z",
+                        "columns": {"name": "Mac OS X", "version": "10.15.4"},
+                    },
+                }
+
+    bulk(es, actions(), chunk_size=2000)
+    Index("user").refresh()
+    Index("host_state").refresh()
+    Index(BENCHMARK_INDEX).refresh()
+
+
+def cleanup():
+    for index in ["user", "host_state"]:
+        Search(index=index).query("prefix", username="benchmark-").delete()
+        Index(index).refresh()
+    es.indices.delete(index=BENCHMARK_INDEX, ignore=[404])
+
+
+async def time_list_users(handler, bot, event, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await handler.list_users(bot, event, [])
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--fleet-sizes",
+        default="10,100,500,1000,2000",
+        help="comma-separated list of fleet sizes (default: 10,100,500,1000,2000)",
+    )
+    parser.add_argument(
+        "--docs-per-host",
+        type=int,
+        default=20,
+        help="osquery documents to seed per host (default: 20)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per fleet size (default: 3)"
+    )
+    parser.add_argument(
+        "--without-host-states",
+        action="store_true",
+        help="don't seed host states, like hosts that haven't submitted anything "
+        "since the gateway was upgraded",
+    )
+    args = parser.parse_args()
+
+    handler = Handler()
+    bot = BotStub()
+    sender = SimpleNamespace(username="benchmark")
+    event = SimpleNamespace(msg=SimpleNamespace(conv_id="benchmark", sender=sender))
+
+    print(f"{'hosts':>8} {'list_users (ms)':>16}")
+    for fleet_size in [int(size) for size in args.fleet_sizes.split(",")]:
+        cleanup()
+        try:
+            seed(fleet_size, args.docs_per_host, not args.without_host_states)
+            seconds = asyncio.run(time_list_users(handler, bot, event, args.repeat))
+            print(f"{fleet_size:>8} {seconds * 1000:>16.1f}")
+        finally:
+            cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
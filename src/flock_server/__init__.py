@@ -1,6 +1,15 @@
 # Connect to elasticsearch, define models
 from .elasticsearch import User, Setting, KeybaseNotification, elasticsearch_url
 
+# Index templates for osquery data
+from .indices import install_flock_template
+
+# Where users, settings, notifications and osquery data are kept
+from .storage import create_storage, ElasticsearchStorage, MemoryStorage, NdjsonStorage
+
+# Cache of authenticated users
+from .identity_cache import identity_cache
+
 # API endpoint
 from .api import create_api_app
 
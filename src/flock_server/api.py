@@ -1,32 +1,230 @@
+import os
 import json
+import time
 import secrets
-from datetime import datetime
+import threading
 from functools import wraps
-from collections import defaultdict
 
-from flask import Flask, request
-from elasticsearch_dsl import Index, Search
-
-from .elasticsearch import es, User
+from flask import Flask, request, g
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl import Search
+from prometheus_client import Histogram
+
+from .elasticsearch import is_unavailable_error, is_duplicate
+from .storage import create_storage
+from .compression import DecompressionMiddleware
+from .identity_cache import identity_cache, UserChangeWatcher
+from .ingest_queue import IngestQueue
+from .spool import Spool
+from .rate_limit import create_rate_limiter
+from .host_states import HostStateTracker
+from .indices import IndexRouter
+from .streaming import BodyTooLargeError
+from .ingest import (
+    IngestError,
+    validate_username,
+    clean_name,
+    Batch,
+    RecentIds,
+    osquery_pipeline,
+    flock_log_pipeline,
+    SubmitCounts,
+)
 from .keybase_notifications import KeybaseNotifications
 
 
-def create_api_app(test_config=None):
-    keybase_notifications = KeybaseNotifications()
+http_request_seconds = Histogram(
+    "flock_http_request_seconds",
+    "Time spent handling each API request, by route",
+    ["method", "route", "status"],
+)
+
 
+def create_api_app(test_config=None):
     # Create the flask
     app = Flask(__name__)
+    app.config.update(
+        # Where to keep users, settings, notifications and osquery docs:
+        # elasticsearch, memory, or ndjson files in STORAGE_PATH
+        STORAGE=os.environ.get("FLOCK_STORAGE", "elasticsearch"),
+        STORAGE_PATH=os.environ.get("FLOCK_STORAGE_PATH", "/var/lib/flock"),
+        # Largest request body to accept
+        MAX_CONTENT_LENGTH=int(
+            os.environ.get("FLOCK_MAX_CONTENT_LENGTH", 100 * 1024 * 1024)
+        ),
+        # Number of documents, and number of bytes, to send to ElasticSearch in each bulk request
+        BULK_CHUNK_SIZE=int(os.environ.get("FLOCK_BULK_CHUNK_SIZE", 500)),
+        BULK_MAX_CHUNK_BYTES=int(
+            os.environ.get("FLOCK_BULK_MAX_CHUNK_BYTES", 10 * 1024 * 1024)
+        ),
+        # Accept /submit batches onto a queue, and index them in the background
+        ASYNC_INGEST=os.environ.get("FLOCK_ASYNC_INGEST") == "1",
+        INGEST_WORKERS=int(os.environ.get("FLOCK_INGEST_WORKERS", 4)),
+        # Maximum number of queued batches, and of queued documents
+        INGEST_QUEUE_DEPTH=int(os.environ.get("FLOCK_INGEST_QUEUE_DEPTH", 1000)),
+        INGEST_QUEUE_HIGH_WATER=int(
+            os.environ.get("FLOCK_INGEST_QUEUE_HIGH_WATER", 100000)
+        ),
+        # Write osquery docs to a rollover alias instead of daily indices
+        INDEX_ROLLOVER=os.environ.get("FLOCK_INDEX_ROLLOVER") == "1",
+        # Docs with a unixTime older than this go into today's index
+        MAX_EVENT_AGE_DAYS=float(os.environ.get("FLOCK_MAX_EVENT_AGE_DAYS", 30)),
+        # Give osquery docs content-hash _ids so docs that agents resend aren't
+        # indexed twice, remembering this many recent _ids to skip resent docs early
+        IDEMPOTENT_INGEST=os.environ.get("FLOCK_IDEMPOTENT_INGEST") == "1",
+        RECENT_IDS_SIZE=int(os.environ.get("FLOCK_RECENT_IDS_SIZE", 100000)),
+        # Per-host rate limits for /submit, in requests and documents per second
+        # (0 for no limit), with burst sizes that default to a minute's worth. JSON
+        # like {"username": {"docs_per_second": 100}} overrides them for some hosts.
+        RATE_LIMIT_REQUESTS=float(os.environ.get("FLOCK_RATE_LIMIT_REQUESTS", 0)),
+        RATE_LIMIT_REQUESTS_BURST=float(
+            os.environ.get("FLOCK_RATE_LIMIT_REQUESTS_BURST", 0)
+        ),
+        RATE_LIMIT_DOCS=float(os.environ.get("FLOCK_RATE_LIMIT_DOCS", 0)),
+        RATE_LIMIT_DOCS_BURST=float(os.environ.get("FLOCK_RATE_LIMIT_DOCS_BURST", 0)),
+        RATE_LIMIT_HOSTS=json.loads(os.environ.get("FLOCK_RATE_LIMIT_HOSTS", "{}")),
+        # Number of hosts to remember rate limits for
+        RATE_LIMIT_MAX_HOSTS=int(os.environ.get("FLOCK_RATE_LIMIT_MAX_HOSTS", 100000)),
+        # Directory to spool documents to while ElasticSearch is unavailable
+        SPOOL_DIR=os.environ.get("FLOCK_SPOOL_DIR"),
+        SPOOL_SEGMENT_BYTES=int(
+            os.environ.get("FLOCK_SPOOL_SEGMENT_BYTES", 64 * 1024 * 1024)
+        ),
+        SPOOL_REPLAY_INTERVAL=float(os.environ.get("FLOCK_SPOOL_REPLAY_INTERVAL", 10)),
+        # Seconds to coalesce each host's state updates for before writing them
+        HOST_STATE_INTERVAL=float(os.environ.get("FLOCK_HOST_STATE_INTERVAL", 10)),
+        # Seconds between checks for users the Keybase bot renamed or deleted, which
+        # are dropped from the identity cache
+        USER_CHANGES_INTERVAL=float(
+            os.environ.get("FLOCK_IDENTITY_CACHE_SYNC_INTERVAL", 5)
+        ),
+    )
     if test_config:
         app.config.update(test_config)
 
+    storage = create_storage(app.config["STORAGE"], app.config["STORAGE_PATH"])
+    app.extensions["flock_storage"] = storage
+    host_states = HostStateTracker(storage, app.config["HOST_STATE_INTERVAL"])
+    app.extensions["flock_host_states"] = host_states
+    user_changes = UserChangeWatcher(
+        storage, interval=app.config["USER_CHANGES_INTERVAL"]
+    )
+    app.extensions["flock_user_changes"] = user_changes
+    app.before_request(user_changes.start)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        if "request_start" in g:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            http_request_seconds.labels(
+                method=request.method, route=route, status=response.status_code
+            ).observe(time.perf_counter() - g.request_start)
+        return response
+
+    # Accept gzip and zstd compressed bodies from agents
+    app.wsgi_app = DecompressionMiddleware(
+        app.wsgi_app,
+        ["/submit", "/submit_flock_logs"],
+        app.config["MAX_CONTENT_LENGTH"],
+    )
+
+    def bulk_index_actions(actions):
+        return storage.index_docs(
+            actions,
+            chunk_size=app.config["BULK_CHUNK_SIZE"],
+            max_chunk_bytes=app.config["BULK_MAX_CHUNK_BYTES"],
+        )
+
+    if app.config["SPOOL_DIR"]:
+        spool = Spool(
+            app.config["SPOOL_DIR"],
+            bulk_index_actions,
+            storage.is_available,
+            segment_bytes=app.config["SPOOL_SEGMENT_BYTES"],
+            replay_interval=app.config["SPOOL_REPLAY_INTERVAL"],
+            replay_batch_size=app.config["BULK_CHUNK_SIZE"],
+        )
+        app.extensions["flock_spool"] = spool
+
+        # Start replaying anything left in the spool by a previous process
+        app.before_request(spool.start)
+    else:
+        spool = None
+
+    # Once docs are spooled, their notifications are spooled too
+    keybase_notifications = KeybaseNotifications(storage=storage, spool=spool)
+    app.extensions["flock_keybase_notifications"] = keybase_notifications
+
+    def index_actions(actions):
+        # Index actions, spooling them instead if ElasticSearch is unavailable. Returns
+        # the number indexed, a list of failures, the number spooled, and a list of
+        # the failures for docs that were already indexed.
+        try:
+            indexed_count, failures = bulk_index_actions(actions)
+        except TransportError as e:
+            if not spool or not is_unavailable_error(e):
+                raise
+            spool.append(actions)
+            return 0, [], len(actions), []
+
+        # Spool documents that ElasticSearch rejected because it's overloaded
+        spooled_count = 0
+        if spool and failures:
+            rejected = [failure for failure in failures if failure["status"] == 429]
+            if rejected:
+                spool.append([actions[failure["item"]] for failure in rejected])
+                spooled_count = len(rejected)
+                failures = [failure for failure in failures if failure["status"] != 429]
+
+        # Docs created with an _id that's already indexed aren't failures
+        duplicates = [failure for failure in failures if is_duplicate(failure)]
+        if duplicates:
+            failures = [failure for failure in failures if not is_duplicate(failure)]
+
+        return indexed_count, failures, spooled_count, duplicates
+
+    if app.config["ASYNC_INGEST"]:
+
+        def index_queued_actions(actions):
+            indexed_count, failures, _, duplicates = index_actions(actions)
+            return indexed_count, failures, duplicates
+
+        ingest_queue = IngestQueue(
+            index_queued_actions,
+            workers=app.config["INGEST_WORKERS"],
+            max_batches=app.config["INGEST_QUEUE_DEPTH"],
+            high_water=app.config["INGEST_QUEUE_HIGH_WATER"],
+            chunk_size=app.config["BULK_CHUNK_SIZE"],
+        )
+        app.extensions["flock_ingest_queue"] = ingest_queue
+    else:
+        ingest_queue = None
+
+    rate_limiter = create_rate_limiter(app.config)
+
+    # Each doc goes through these once
+    submit_pipeline = osquery_pipeline(
+        keybase_notifications,
+        router=IndexRouter(
+            rollover=app.config["INDEX_ROLLOVER"],
+            max_event_age_days=app.config["MAX_EVENT_AGE_DAYS"],
+        ),
+        recent_ids=RecentIds(app.config["RECENT_IDS_SIZE"])
+        if app.config["IDEMPOTENT_INGEST"]
+        else None,
+    )
+    flock_logs_pipeline = flock_log_pipeline()
+
     def check_auth(username, token):
-        r = (
-            Search(index="user")
-            .query("match", username=username)
-            .query("match", token=token)
-            .execute()
+        # Remember the authenticated user for the rest of the request
+        g.user = identity_cache.get(
+            username, token, lambda: storage.get_user(username, token)
         )
-        return len(r) == 1
+        return g.user is not None
 
     def authenticate():
         return {}, 401
@@ -68,60 +266,64 @@ def create_api_app(test_config=None):
 
         return {"error": True, "error_msg": error_msg}, 400
 
+    @app.errorhandler(400)
+    @app.errorhandler(413)
+    def http_error(e):
+        return {"error": True, "error_msg": e.description}, e.code
+
+    @app.errorhandler(TransportError)
+    def elasticsearch_error(e):
+        # Tell agents to try again later when ElasticSearch is down, like when
+        # authenticating a user who isn't cached
+        if is_unavailable_error(e):
+            return api_busy()
+        raise e
+
     def api_success(success_obj=None):
         if not success_obj:
             success_obj = {}
         success_obj["error"] = False
         return success_obj, 200
 
-    def get_name():
-        results = (
-            Search(index="user")
-            .query("match", username=request.authorization["username"])
-            .execute()
+    def api_accepted(accepted_obj):
+        accepted_obj["error"] = False
+        accepted_obj["queued"] = True
+        return accepted_obj, 202
+
+    def api_busy():
+        return (
+            {"error": True, "error_msg": "Server is busy, try again later"},
+            503,
+            {"Retry-After": "30"},
         )
-        if len(results) == 1:
-            user = results[0]
-            return user.name
-        else:
-            return None
+
+    def api_throttled(retry_after):
+        return (
+            {"error": True, "error_msg": "Too many requests, try again later"},
+            429,
+            {"Retry-After": str(retry_after)},
+        )
+
+    def get_name():
+        return g.user.name
 
     @app.route("/es-test")
     def es_test():
-        r = Search(index="user").query("match", username="user1").execute()
+        r = Search(index="user").filter("term", username="user1").execute()
         return str(r.hits)
 
     @app.route("/register", methods=["POST"])
     def register():
         if not request.json:
             return api_error("Invalid JSON object")
-        username = request.json.get("username")
-        name = request.json.get("name", "")
-
-        if not username:
-            return api_error("You must provide a username")
-
-        # Validate username
-        valid_chars = (
-            "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ01234567890_-"
-        )
-        for c in username:
-            if c not in valid_chars:
-                return api_error(
-                    "Usernames must only contain letters, numbers, '-', or '_'"
-                )
-
-        # Strip invalid characters from name
-        new_name = ""
-        invalid_chars = "`{}!@#$%^&*_"
-        for c in name:
-            if c not in invalid_chars:
-                new_name += c
-        name = new_name
+        try:
+            username = validate_username(request.json.get("username"))
+        except IngestError as e:
+            return api_error(str(e))
+        name = clean_name(request.json.get("name", ""))
 
         # Is the user already registered?
-        r = Search(index="user").query("match", username=username).execute()
-        if len(r) != 0:
+        if storage.get_user(username) is not None:
             keybase_notifications.add(
                 "user_already_exists", {"username": username, "name": name},
             )
@@ -132,10 +334,8 @@ def create_api_app(test_config=None):
                 )
             )
 
-        # Add user, and force a refresh of the index
-        user = User(username=username, name=name, token=secrets.token_hex(16))
-        user.save()
-        Index("user").refresh()
+        # Add user
+        user = storage.add_user(username, name, secrets.token_hex(16))
 
         keybase_notifications.add(
             "user_registered", {"username": username, "name": name},
@@ -152,102 +352,144 @@ def create_api_app(test_config=None):
     @app.route("/submit", methods=["POST"])
     @requires_auth
     def submit():
-        try:
-            docs = request.json
-        except:
-            return api_error("Invalid JSON object")
-
-        if not docs:
-            return api_error("Invalid JSON object")
-
-        if type(docs) != list:
-            return api_error("Data is not an array")
+        username = request.authorization["username"]
+
+        # The user was loaded while authenticating
+        user = g.user
+
+        # Throttle hosts that submit too much
+        retry_after = rate_limiter.admit(username)
+        if retry_after:
+            return api_throttled(retry_after)
+
+        # Docs are parsed from the request body and forwarded to ElasticSearch in
+        # chunks, so a large body never needs to fit in memory all at once. The
+        # whole body is validated before anything is forwarded, so when a request
+        # is rejected, resending it doesn't index anything twice.
+        counts = SubmitCounts()
+        batch = Batch(username, user.name)
+
+        # With the ingest queue, each chunk is queued as soon as it's produced. The
+        # batch's notifications and host state are recorded by whichever finishes
+        # last: the last queued chunk to be indexed, or this request, which holds
+        # one of the outstanding references until it has queued every chunk.
+        outstanding = {"count": 1}
+        outstanding_lock = threading.Lock()
+
+        def release():
+            with outstanding_lock:
+                outstanding["count"] -= 1
+                if outstanding["count"]:
+                    return
+            keybase_notifications.add_many(batch.notifications())
+            if batch.host_state:
+                host_states.update(username, batch.host_state)
+
+        def index(actions, checkpoint):
+            # Add data to ElasticSearch
+            chunk_failures, chunk_duplicates = counts.add_chunk(
+                actions, *index_actions(actions)
+            )
 
-        # Validate
-        for i, doc in enumerate(docs):
-            # Item should be an object
-            if type(doc) != dict:
-                return api_error("Item {} is not an object".format(i))
-
-            # hostIdentifier should be the username
-            if ("hostIdentifier" not in doc) or (
-                request.authorization["username"] != doc["hostIdentifier"]
-            ):
-                return api_error(
-                    "Item {} does not contain the correct hostIdentifier".format(i)
+            # Remember these docs, and send notifications for them, unless they
+            # failed or were already indexed
+            batch.commit(chunk_failures, chunk_duplicates, checkpoint)
+
+        def queue(actions, checkpoint):
+            # Index in the background, returning False if the queue is full
+            offset = counts.processed_count
+
+            def indexed(chunk_failures, chunk_duplicates):
+                # Called from an ingest queue thread, once the chunk is indexed
+                batch.commit(
+                    [
+                        dict(failure, item=failure["item"] + offset)
+                        for failure in chunk_failures
+                    ],
+                    [
+                        dict(duplicate, item=duplicate["item"] + offset)
+                        for duplicate in chunk_duplicates
+                    ],
+                    checkpoint,
                 )
+                release()
+
+            with outstanding_lock:
+                outstanding["count"] += 1
+            if ingest_queue.put(actions, indexed):
+                counts.add_queued(actions)
+                return True
+            with outstanding_lock:
+                outstanding["count"] -= 1
+            return False
+
+        error_msg = None
+        busy = False
+        try:
+            chunks = submit_pipeline.chunks(
+                request.stream,
+                batch,
+                app.config["BULK_CHUNK_SIZE"],
+                max_bytes=app.config["MAX_CONTENT_LENGTH"],
+            )
+            for actions in chunks:
+                checkpoint = batch.next_checkpoint()
+                if not ingest_queue:
+                    index(actions, checkpoint)
+                elif not queue(actions, checkpoint):
+                    if counts.processed_count == 0:
+                        # Nothing was queued yet, so the agent can send the whole
+                        # body again later
+                        busy = True
+                        break
+                    # Part of the body is already queued, so index the rest right
+                    # away rather than rejecting it
+                    index(actions, checkpoint)
+
+            if not busy:
+                # Commit any duplicates skipped after the last chunk
+                batch.commit()
+                counts.add_skipped(batch)
+        except IngestError as e:
+            error_msg = str(e)
+        except BodyTooLargeError:
+            return {"error": True, "error_msg": "Request body is too large"}, 413
+        finally:
+            if ingest_queue:
+                release()
+
+        if counts.failures:
+            app.logger.warning(
+                f"Failed to index {len(counts.failures)} of {counts.processed_count} documents: {counts.failures}"
+            )
 
-        # Load the user
-        results = (
-            Search(index="user")
-            .query("match", username=request.authorization["username"])
-            .execute()
+        # Send notifications for everything that was indexed. Queued docs are
+        # handled once they're indexed.
+        if not ingest_queue:
+            keybase_notifications.add_many(batch.notifications())
+
+        # Record what was forwarded. What queued docs say about the host is
+        # recorded once they're indexed.
+        host_states.update(
+            username,
+            dict(
+                {} if ingest_queue else batch.host_state,
+                submit_count=1,
+                doc_count=counts.processed_count,
+            ),
         )
-        user = results[0]
-
-        # Make a list of the types of docs that should trigger notifications
-        notification_names = []
-        for key in keybase_notifications.notifications:
-            if keybase_notifications.notifications[key]["type"] == "osquery":
-                notification_names.append(key)
-
-        # Dictionary that sorts incoming docs by notification type
-        docs_by_type = {}
-
-        # Add data to ElasticSearch
-        notification_docs = defaultdict(list)
-        for doc in docs:
-            # Convert 'unixTime' to '@timestamp'
-            if "unixTime" in doc:
-                doc["@timestamp"] = datetime.utcfromtimestamp(
-                    int(doc["unixTime"])
-                ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-            # Tag
-            doc["username"] = request.authorization["username"]
-            doc["user_name"] = user.name
-
-            # Add data
-            index = "flock-{}".format(datetime.now().strftime("%Y-%m-%d"))
-            es.index(index=index, doc_type="osquery", body=doc)
-
-        # Figure out what notifications to send
-        for doc in docs:
-            if "name" in doc and doc["name"] in notification_names:
-                notification_docs[doc["name"]].append(doc)
-
-        # Send notifications
-        for key, value in notification_docs.items():
-            if len(value) == 1:
-                keybase_notifications.add(key, value[0])
-            elif len(value) > 1:
-                added_count = 0
-                removed_count = 0
-                other_count = 0
-                for doc in value:
-                    if "action" in doc:
-                        if doc["action"] == "added":
-                            added_count += 1
-                        elif doc["action"] == "removed":
-                            removed_count += 1
-                        else:
-                            other_count += 1
-                    else:
-                        other_count += 1
-
-                keybase_notifications.add(
-                    key,
-                    {
-                        "type": "summary",
-                        "username": request.authorization["username"],
-                        "name": user.name,
-                        "added_count": added_count,
-                        "removed_count": removed_count,
-                        "other_count": other_count,
-                    },
-                )
+        rate_limiter.consume_docs(username, counts.processed_count)
+        counts.record(queued=bool(ingest_queue))
 
-        return api_success({"processed_count": len(docs)})
+        if busy:
+            return api_busy()
+        if error_msg:
+            return api_error(error_msg)
+
+        if ingest_queue:
+            return api_accepted(counts.queued_response())
+
+        return api_success(counts.response())
 
     @app.route("/submit_flock_logs", methods=["POST"])
     @requires_auth
@@ -261,40 +503,19 @@ def create_api_app(test_config=None):
         if type(docs) != list:
             return api_error("Data is not an array")
 
-        # Validate
-        for i, doc in enumerate(docs):
-            # Item should be an object
-            if type(doc) != dict:
-                return api_error("Item {} is not an object".format(i))
-
-            # Item should have type and timestamp, and maybe twig_id
-            if "type" not in doc:
-                return api_error("Item {} does not contain a type field".format(i))
-            if "timestamp" not in doc:
-                return api_error("Item {} does not contain a timestamp field".format(i))
-            if doc["type"] == "enable_twig" or doc["type"] == "disable_twig":
-                if "twig_id" not in doc:
-                    return api_error(
-                        "Item {} is about a twig, but does not contain a twig_id field".format(
-                            i
-                        )
-                    )
+        # Validate, and figure out which notifications to send
+        username = request.authorization["username"]
+        batch = Batch(username, get_name())
+        try:
+            for doc in flock_logs_pipeline.run(docs, batch):
+                pass
+        except IngestError as e:
+            return api_error(str(e))
+        batch.commit()
 
         # Add keybase notifications
-        for doc in docs:
-            if doc["type"] in [
-                "server_enabled",
-                "server_disabled",
-                "twigs_enabled",
-                "twigs_disabled",
-            ]:
-                details = {
-                    "username": request.authorization["username"],
-                    "name": get_name(),
-                }
-                if doc["type"] in ["twigs_enabled", "twigs_disabled"]:
-                    details["twig_ids"] = doc["twig_ids"]
-                keybase_notifications.add(doc["type"], details)
+        keybase_notifications.add_many(batch.notifications())
+        host_states.update(username, dict(batch.host_state, log_count=len(docs)))
 
         return api_success({"processed_count": len(docs)})
 
@@ -0,0 +1,643 @@
+"""
+An asyncio version of the API, served by aiohttp and backed by AsyncElasticsearch,
+so one process can keep thousands of agent requests in flight while they wait on
+ElasticSearch:
+
+    pipenv run python -m flock_server.async_api
+
+It serves /register, /ping, /submit and /submit_flock_logs with the same requests
+and responses as the Flask API, and metrics at /metrics on FLOCK_METRICS_PORT. It
+needs aiohttp and elasticsearch>=7.8 with its async extra.
+"""
+import io
+import os
+import json
+import time
+import asyncio
+import logging
+import secrets
+from datetime import datetime
+from functools import wraps
+
+from elasticsearch.exceptions import TransportError
+from werkzeug.exceptions import HTTPException
+
+# aiohttp and the async Elasticsearch client are in the Pipfile, but the asyncio
+# API is optional when running without them
+try:
+    from aiohttp import web, BasicAuth
+    from elasticsearch.helpers import async_bulk, async_streaming_bulk
+except ImportError:
+    web = None
+
+from .elasticsearch import (
+    User,
+    create_async_client,
+    bulk_index,
+    is_available,
+    is_unavailable_error,
+    is_duplicate,
+    es_request_seconds,
+    request_timeout,
+)
+from .api import http_request_seconds
+from .compression import DecompressingStream, supported_encodings, record_decompression
+from .identity_cache import identity_cache, UserChangeWatcher
+from .spool import Spool
+from .rate_limit import create_rate_limiter
+from .host_states import HostStateTracker
+from .storage import ElasticsearchStorage
+from .indices import IndexRouter
+from .streaming import BodyTooLargeError
+from .ingest import (
+    IngestError,
+    validate_username,
+    clean_name,
+    Batch,
+    RecentIds,
+    osquery_pipeline,
+    flock_log_pipeline,
+    SubmitCounts,
+)
+from .keybase_notifications import KeybaseNotifications
+from .metrics import start_http_server
+
+
+logger = logging.getLogger(__name__)
+
+
+async def async_bulk_index(
+    client, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024
+):
+    # Like bulk_index(), using an AsyncElasticsearch client
+    indexed_count = 0
+    failures = []
+    i = 0
+    with es_request_seconds.labels(operation="index").time():
+        results = async_streaming_bulk(
+            client,
+            actions,
+            chunk_size=chunk_size,
+            max_chunk_bytes=max_chunk_bytes,
+            raise_on_error=False,
+            request_timeout=request_timeout("index"),
+        )
+        async for ok, info in results:
+            if ok:
+                indexed_count += 1
+            else:
+                item = next(iter(info.values()))
+                failures.append(
+                    {
+                        "item": i,
+                        "status": item.get("status"),
+                        "error": item.get("error"),
+                    }
+                )
+            i += 1
+    return indexed_count, failures
+
+
+def _is_json(request):
+    mimetype = request.content_type
+    return mimetype == "application/json" or (
+        mimetype.startswith("application/") and mimetype.endswith("+json")
+    )
+
+
+def create_async_api_app(test_config=None):
+    if web is None:
+        raise RuntimeError(
+            "The asyncio API needs aiohttp and elasticsearch>=7.8 with async support"
+        )
+    if os.environ.get("FLOCK_STORAGE", "elasticsearch") != "elasticsearch":
+        raise RuntimeError("The asyncio API only supports ElasticSearch storage")
+
+    config = dict(
+        # Largest request body to accept
+        MAX_CONTENT_LENGTH=int(
+            os.environ.get("FLOCK_MAX_CONTENT_LENGTH", 100 * 1024 * 1024)
+        ),
+        # Number of documents, and number of bytes, to send to ElasticSearch in each bulk request
+        BULK_CHUNK_SIZE=int(os.environ.get("FLOCK_BULK_CHUNK_SIZE", 500)),
+        BULK_MAX_CHUNK_BYTES=int(
+            os.environ.get("FLOCK_BULK_MAX_CHUNK_BYTES", 10 * 1024 * 1024)
+        ),
+        # Write osquery docs to a rollover alias instead of daily indices
+        INDEX_ROLLOVER=os.environ.get("FLOCK_INDEX_ROLLOVER") == "1",
+        # Docs with a unixTime older than this go into today's index
+        MAX_EVENT_AGE_DAYS=float(os.environ.get("FLOCK_MAX_EVENT_AGE_DAYS", 30)),
+        # Give osquery docs content-hash _ids so docs that agents resend aren't
+        # indexed twice, remembering this many recent _ids to skip resent docs early
+        IDEMPOTENT_INGEST=os.environ.get("FLOCK_IDEMPOTENT_INGEST") == "1",
+        RECENT_IDS_SIZE=int(os.environ.get("FLOCK_RECENT_IDS_SIZE", 100000)),
+        # Per-host rate limits for /submit, in requests and documents per second
+        # (0 for no limit), with burst sizes that default to a minute's worth. JSON
+        # like {"username": {"docs_per_second": 100}} overrides them for some hosts.
+        RATE_LIMIT_REQUESTS=float(os.environ.get("FLOCK_RATE_LIMIT_REQUESTS", 0)),
+        RATE_LIMIT_REQUESTS_BURST=float(
+            os.environ.get("FLOCK_RATE_LIMIT_REQUESTS_BURST", 0)
+        ),
+        RATE_LIMIT_DOCS=float(os.environ.get("FLOCK_RATE_LIMIT_DOCS", 0)),
+        RATE_LIMIT_DOCS_BURST=float(os.environ.get("FLOCK_RATE_LIMIT_DOCS_BURST", 0)),
+        RATE_LIMIT_HOSTS=json.loads(os.environ.get("FLOCK_RATE_LIMIT_HOSTS", "{}")),
+        # Number of hosts to remember rate limits for
+        RATE_LIMIT_MAX_HOSTS=int(os.environ.get("FLOCK_RATE_LIMIT_MAX_HOSTS", 100000)),
+        # Directory to spool documents to while ElasticSearch is unavailable
+        SPOOL_DIR=os.environ.get("FLOCK_SPOOL_DIR"),
+        SPOOL_SEGMENT_BYTES=int(
+            os.environ.get("FLOCK_SPOOL_SEGMENT_BYTES", 64 * 1024 * 1024)
+        ),
+        SPOOL_REPLAY_INTERVAL=float(os.environ.get("FLOCK_SPOOL_REPLAY_INTERVAL", 10)),
+        # Seconds to coalesce each host's state updates for before writing them
+        HOST_STATE_INTERVAL=float(os.environ.get("FLOCK_HOST_STATE_INTERVAL", 10)),
+        # Seconds between checks for users the Keybase bot renamed or deleted, which
+        # are dropped from the identity cache
+        USER_CHANGES_INTERVAL=float(
+            os.environ.get("FLOCK_IDENTITY_CACHE_SYNC_INTERVAL", 5)
+        ),
+    )
+    if test_config:
+        config.update(test_config)
+
+    # The ElasticSearch client is bound to the event loop, so it's created when the
+    # app starts
+    clients = {}
+
+    async def open_client(app):
+        clients["es"] = create_async_client()
+
+    async def close_client(app):
+        await clients.pop("es").close()
+
+    if config["SPOOL_DIR"]:
+        # The spool is written and replayed in threads, with the blocking client
+        spool = Spool(
+            config["SPOOL_DIR"],
+            lambda actions: bulk_index(
+                actions,
+                chunk_size=config["BULK_CHUNK_SIZE"],
+                max_chunk_bytes=config["BULK_MAX_CHUNK_BYTES"],
+            ),
+            is_available,
+            segment_bytes=config["SPOOL_SEGMENT_BYTES"],
+            replay_interval=config["SPOOL_REPLAY_INTERVAL"],
+            replay_batch_size=config["BULK_CHUNK_SIZE"],
+        )
+
+        async def start_spool(app):
+            spool.start()
+
+    else:
+        spool = None
+
+    # Once docs are spooled, their notifications are spooled too
+    keybase_notifications = KeybaseNotifications(spool=spool)
+
+    async def run_in_thread(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def index_actions(actions):
+        # Index actions, spooling them instead if ElasticSearch is unavailable. Returns
+        # the number indexed, a list of failures, the number spooled, and a list of
+        # the failures for docs that were already indexed.
+        try:
+            indexed_count, failures = await async_bulk_index(
+                clients["es"],
+                actions,
+                chunk_size=config["BULK_CHUNK_SIZE"],
+                max_chunk_bytes=config["BULK_MAX_CHUNK_BYTES"],
+            )
+        except TransportError as e:
+            if not spool or not is_unavailable_error(e):
+                raise
+            await run_in_thread(spool.append, actions)
+            return 0, [], len(actions), []
+
+        # Spool documents that ElasticSearch rejected because it's overloaded
+        spooled_count = 0
+        if spool and failures:
+            rejected = [failure for failure in failures if failure["status"] == 429]
+            if rejected:
+                await run_in_thread(
+                    spool.append, [actions[failure["item"]] for failure in rejected]
+                )
+                spooled_count = len(rejected)
+                failures = [failure for failure in failures if failure["status"] != 429]
+
+        # Docs created with an _id that's already indexed aren't failures
+        duplicates = [failure for failure in failures if is_duplicate(failure)]
+        if duplicates:
+            failures = [failure for failure in failures if not is_duplicate(failure)]
+
+        return indexed_count, failures, spooled_count, duplicates
+
+    async def add_notifications(notifications):
+        # Checking which notifications are enabled might load the settings, which
+        # uses the blocking client
+        if not notifications:
+            return
+        try:
+            actions = await run_in_thread(
+                keybase_notifications.notification_actions, notifications
+            )
+            if actions:
+                with es_request_seconds.labels(operation="notification_save").time():
+                    await async_bulk(
+                        clients["es"],
+                        actions,
+                        request_timeout=request_timeout("notification_save"),
+                    )
+                # Publishing can look up the bot's address, which blocks
+                await run_in_thread(keybase_notifications.bus.publish)
+        except TransportError as e:
+            if not spool or not is_unavailable_error(e):
+                raise
+            await run_in_thread(
+                spool.append,
+                keybase_notifications.notification_actions(
+                    notifications, keybase_notifications.fallback_settings()
+                ),
+            )
+
+    # Host states are written in a thread, with the blocking client
+    host_states = HostStateTracker(ElasticsearchStorage(), config["HOST_STATE_INTERVAL"])
+
+    async def update_host_state(username, update):
+        if host_states.interval:
+            host_states.update(username, update)
+        else:
+            await run_in_thread(host_states.update, username, update)
+
+    # Renamed and deleted users are checked for in a thread, with the blocking client
+    user_changes = UserChangeWatcher(
+        ElasticsearchStorage(), interval=config["USER_CHANGES_INTERVAL"]
+    )
+
+    async def start_user_changes(app):
+        user_changes.start()
+
+    async def flush_host_states(app):
+        await run_in_thread(host_states.flush)
+
+    rate_limiter = create_rate_limiter(config)
+
+    # Each doc goes through these once
+    submit_pipeline = osquery_pipeline(
+        keybase_notifications,
+        router=IndexRouter(
+            rollover=config["INDEX_ROLLOVER"],
+            max_event_age_days=config["MAX_EVENT_AGE_DAYS"],
+        ),
+        recent_ids=RecentIds(config["RECENT_IDS_SIZE"])
+        if config["IDEMPOTENT_INGEST"]
+        else None,
+    )
+    flock_logs_pipeline = flock_log_pipeline()
+
+    async def load_user(username, token):
+        with es_request_seconds.labels(operation="auth_search").time():
+            r = await clients["es"].search(
+                index="user",
+                body={
+                    "query": {
+                        "bool": {
+                            "filter": [
+                                {"term": {"username": username}},
+                                {"term": {"token": token}},
+                            ]
+                        }
+                    }
+                },
+                request_timeout=request_timeout("auth_search"),
+            )
+        if len(r["hits"]["hits"]) == 1:
+            return User.from_es(r["hits"]["hits"][0])
+        return None
+
+    async def check_auth(request):
+        # Returns the authenticated username and user, or None
+        auth_header = request.headers.get("Authorization")
+        if not auth_header:
+            return None
+        try:
+            auth = BasicAuth.decode(auth_header)
+        except ValueError:
+            return None
+
+        generation = identity_cache.generation(auth.login)
+        found, user = identity_cache.lookup(auth.login, auth.password)
+        if not found:
+            user = await load_user(auth.login, auth.password)
+            identity_cache.store(auth.login, auth.password, user, generation)
+        if user is None:
+            return None
+        return auth.login, user
+
+    def requires_auth(f):
+        # Handlers are called with the authenticated username and user
+        @wraps(f)
+        async def decorated(request):
+            auth = await check_auth(request)
+            if not auth:
+                return web.json_response({}, status=401)
+            return await f(request, *auth)
+
+        return decorated
+
+    def api_error(request, error_msg, username=None):
+        headers = []
+        for header in request.headers.items():
+            if header[0].lower() != "authorization":
+                headers.append(header)
+
+        error_details = {
+            "method": request.method,
+            "path": request.path,
+            "headers": headers,
+            "error_msg": error_msg,
+        }
+
+        # If this is an authenticated API request, add the username
+        if username:
+            error_details["username"] = username
+
+        logger.debug(f"API error: {error_details}")
+
+        return web.json_response({"error": True, "error_msg": error_msg}, status=400)
+
+    def api_success(success_obj=None):
+        if not success_obj:
+            success_obj = {}
+        success_obj["error"] = False
+        return web.json_response(success_obj)
+
+    def api_throttled(retry_after):
+        return web.json_response(
+            {"error": True, "error_msg": "Too many requests, try again later"},
+            status=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    @web.middleware
+    async def record_request_time(request, handler):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            route = request.match_info.route.resource
+            http_request_seconds.labels(
+                method=request.method,
+                route=route.canonical if route else "unmatched",
+                status=status,
+            ).observe(time.perf_counter() - start)
+
+    @web.middleware
+    async def json_errors(request, handler):
+        # Respond to bad requests with JSON, like the Flask API
+        try:
+            return await handler(request)
+        except HTTPException as e:
+            # Raised by DecompressingStream
+            return web.json_response(
+                {"error": True, "error_msg": e.description}, status=e.code
+            )
+        except web.HTTPRequestEntityTooLarge:
+            return web.json_response(
+                {"error": True, "error_msg": "Request body is too large"}, status=413
+            )
+        except web.HTTPBadRequest as e:
+            return web.json_response({"error": True, "error_msg": e.text}, status=400)
+        except TransportError as e:
+            # Tell agents to try again later when ElasticSearch is down, like when
+            # authenticating a user who isn't cached
+            if not is_unavailable_error(e):
+                raise
+            return web.json_response(
+                {"error": True, "error_msg": "Server is busy, try again later"},
+                status=503,
+                headers={"Retry-After": "30"},
+            )
+
+    async def read_body(request):
+        # Returns a file-like object of the request body. The server runs with
+        # auto_decompress off, so compressed bodies are decompressed here, the
+        # same way as DecompressionMiddleware does it.
+        body = io.BytesIO(await request.read())
+        encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+        if encoding == "identity":
+            return body
+        if encoding not in supported_encodings():
+            raise web.HTTPUnsupportedMediaType(
+                text=json.dumps(
+                    {
+                        "error": True,
+                        "error_msg": f"Unsupported Content-Encoding: {encoding}",
+                    }
+                ),
+                content_type="application/json",
+            )
+        return DecompressingStream(body, encoding, config["MAX_CONTENT_LENGTH"])
+
+    async def read_json(request):
+        # Like Flask's request.json: None unless the body is JSON
+        if not _is_json(request):
+            return None
+        body = await read_body(request)
+        try:
+            return json.loads(body.read())
+        except ValueError:
+            raise web.HTTPBadRequest(text="Failed to decode JSON object")
+        finally:
+            if isinstance(body, DecompressingStream):
+                record_decompression(body)
+
+    async def register(request):
+        data = await read_json(request)
+        if not data:
+            return api_error(request, "Invalid JSON object")
+        try:
+            username = validate_username(data.get("username"))
+        except IngestError as e:
+            return api_error(request, str(e))
+        name = clean_name(data.get("name", ""))
+
+        # Is the user already registered?
+        with es_request_seconds.labels(operation="user_search").time():
+            r = await clients["es"].search(
+                index="user",
+                body={
+                    "query": {"bool": {"filter": [{"term": {"username": username}}]}}
+                },
+                request_timeout=request_timeout("user_search"),
+            )
+        if len(r["hits"]["hits"]) != 0:
+            await add_notifications(
+                [("user_already_exists", {"username": username, "name": name})]
+            )
+
+            return api_error(
+                request,
+                "Your computer ({}) is already registered with this server".format(
+                    username
+                ),
+            )
+
+        # Add user, and force a refresh of the index
+        user = User(
+            username=username,
+            name=name,
+            token=secrets.token_hex(16),
+            created_at=datetime.now(),
+        )
+        with es_request_seconds.labels(operation="user_save").time():
+            await clients["es"].index(index="user", body=user.to_dict(), refresh=True)
+
+        await add_notifications(
+            [("user_registered", {"username": username, "name": name})]
+        )
+
+        return api_success({"auth_token": user.token})
+
+    @requires_auth
+    async def info(request, username, user):
+        # Ping the server, to make sure settings are configured correctly
+        return api_success()
+
+    @requires_auth
+    async def submit(request, username, user):
+        # Throttle hosts that submit too much
+        retry_after = rate_limiter.admit(username)
+        if retry_after:
+            return api_throttled(retry_after)
+
+        counts = SubmitCounts()
+        batch = Batch(username, user.name)
+
+        # The whole body is validated, and then forwarded to ElasticSearch in
+        # chunks, like the Flask API. Parsing, decompressing and buffering the body
+        # block, so each chunk is produced in a thread, and a large body doesn't
+        # hold up other requests.
+        error_msg = None
+        body = await read_body(request)
+        try:
+            chunks = submit_pipeline.chunks(
+                body,
+                batch,
+                config["BULK_CHUNK_SIZE"],
+                max_bytes=config["MAX_CONTENT_LENGTH"],
+            )
+            while True:
+                actions = await run_in_thread(next, chunks, None)
+                if actions is None:
+                    break
+
+                # Add data to ElasticSearch
+                chunk_failures, chunk_duplicates = counts.add_chunk(
+                    actions, *await index_actions(actions)
+                )
+
+                # Remember these docs, and send notifications for them, unless
+                # they failed or were already indexed
+                batch.commit(chunk_failures, chunk_duplicates)
+
+            # Commit any duplicates skipped after the last chunk
+            batch.commit()
+            counts.add_skipped(batch)
+        except IngestError as e:
+            error_msg = str(e)
+        except BodyTooLargeError:
+            return web.json_response(
+                {"error": True, "error_msg": "Request body is too large"}, status=413
+            )
+        finally:
+            if isinstance(body, DecompressingStream):
+                record_decompression(body)
+
+        if counts.failures:
+            logger.warning(
+                f"Failed to index {len(counts.failures)} of {counts.processed_count} documents: {counts.failures}"
+            )
+
+        # Send notifications for everything that was indexed
+        await add_notifications(batch.notifications())
+
+        # Record what was forwarded
+        await update_host_state(
+            username,
+            dict(batch.host_state, submit_count=1, doc_count=counts.processed_count),
+        )
+        rate_limiter.consume_docs(username, counts.processed_count)
+        counts.record()
+
+        if error_msg:
+            return api_error(request, error_msg, username)
+
+        return api_success(counts.response())
+
+    @requires_auth
+    async def submit_flock_logs(request, username, user):
+        # Validate that the data is JSON
+        try:
+            docs = await read_json(request)
+        except web.HTTPBadRequest:
+            return api_error(request, "Invalid JSON object", username)
+
+        if type(docs) != list:
+            return api_error(request, "Data is not an array", username)
+
+        # Validate, and figure out which notifications to send
+        batch = Batch(username, user.name)
+        try:
+            for doc in flock_logs_pipeline.run(docs, batch):
+                pass
+        except IngestError as e:
+            return api_error(request, str(e), username)
+        batch.commit()
+
+        # Add keybase notifications
+        await add_notifications(batch.notifications())
+        await update_host_state(username, dict(batch.host_state, log_count=len(docs)))
+
+        return api_success({"processed_count": len(docs)})
+
+    app = web.Application(
+        middlewares=[record_request_time, json_errors],
+        client_max_size=config["MAX_CONTENT_LENGTH"],
+    )
+    app.on_startup.append(open_client)
+    app.on_startup.append(start_user_changes)
+    app.on_cleanup.append(flush_host_states)
+    app.on_cleanup.append(close_client)
+    if spool:
+        app.on_startup.append(start_spool)
+
+    app.router.add_post("/register", register)
+    app.router.add_get("/ping", info)
+    app.router.add_post("/submit", submit)
+    app.router.add_post("/submit_flock_logs", submit_flock_logs)
+    return app
+
+
+def main():
+    # Serve metrics on their own port, away from agents
+    metrics_port = int(os.environ.get("FLOCK_METRICS_PORT", 9102))
+    if metrics_port:
+        start_http_server(metrics_port)
+
+    # Bodies are decompressed by the app, so aiohttp mustn't do it too
+    web.run_app(
+        create_async_api_app(),
+        port=int(os.environ.get("FLOCK_PORT", 5000)),
+        auto_decompress=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import io
+import json
+import gzip
+import time
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.wsgi import LimitedStream
+from prometheus_client import Counter, Histogram
+
+# zstandard is in the Pipfile, but zstd support is optional when running without it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+compressed_bytes = Counter(
+    "flock_request_compressed_bytes_total",
+    "Compressed bytes received in request bodies",
+    ["encoding"],
+)
+decompressed_bytes = Counter(
+    "flock_request_decompressed_bytes_total",
+    "Bytes of request bodies after decompression",
+    ["encoding"],
+)
+compression_ratio = Histogram(
+    "flock_request_compression_ratio",
+    "Decompressed size divided by compressed size, per request",
+    ["encoding"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+decompression_seconds = Histogram(
+    "flock_request_decompression_seconds",
+    "Time spent decompressing each request body",
+    ["encoding"],
+)
+
+
+def supported_encodings():
+    encodings = ["gzip"]
+    if zstandard:
+        encodings.append("zstd")
+    return encodings
+
+
+def record_decompression(decompressing_stream):
+    # Report how much a DecompressingStream decompressed, once it's been read
+    encoding = decompressing_stream.encoding
+    compressed = decompressing_stream.compressed_bytes_read
+    decompressed = decompressing_stream.bytes_read
+    compressed_bytes.labels(encoding=encoding).inc(compressed)
+    decompressed_bytes.labels(encoding=encoding).inc(decompressed)
+    if compressed > 0:
+        compression_ratio.labels(encoding=encoding).observe(decompressed / compressed)
+    decompression_seconds.labels(encoding=encoding).observe(
+        decompressing_stream.seconds
+    )
+
+
+class _CountingStream(io.RawIOBase):
+    # Counts how many compressed bytes are read
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[: len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+class DecompressingStream(io.RawIOBase):
+    """
+    A stream that decompresses a gzip or zstd stream as it's read, and stops with a
+    413 error once more than max_size bytes come out of it
+    """
+
+    def __init__(self, stream, encoding, max_size):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.bytes_read = 0
+        self.seconds = 0
+        self._compressed = _CountingStream(stream)
+        if encoding == "gzip":
+            self._reader = gzip.GzipFile(fileobj=self._compressed, mode="rb")
+        else:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(
+                self._compressed, read_across_frames=True
+            )
+
+    @property
+    def compressed_bytes_read(self):
+        return self._compressed.bytes_read
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = time.perf_counter()
+        try:
+            data = self._reader.read(len(b))
+        except (OSError, EOFError, zlib.error) as e:
+            raise BadRequest(f"Invalid {self.encoding} request body: {e}")
+        except Exception as e:
+            if zstandard and isinstance(e, zstandard.ZstdError):
+                raise BadRequest(f"Invalid {self.encoding} request body: {e}")
+            raise
+        finally:
+            self.seconds += time.perf_counter() - start
+
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_size:
+            raise RequestEntityTooLarge(
+                f"Decompressed request body is larger than {self.max_size} bytes"
+            )
+        b[: len(data)] = data
+        return len(data)
+
+
+class DecompressionMiddleware:
+    """
+    WSGI middleware that decompresses request bodies sent with a gzip or zstd
+    Content-Encoding, for requests to the given paths
+    """
+
+    def __init__(self, wsgi_app, paths, max_content_length):
+        # max_content_length limits the size of the body both before and after it's
+        # decompressed
+        self.wsgi_app = wsgi_app
+        self.paths = paths
+        self.max_content_length = max_content_length
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "identity").strip().lower()
+        if encoding == "identity" or environ.get("PATH_INFO") not in self.paths:
+            return self.wsgi_app(environ, start_response)
+
+        if encoding not in supported_encodings():
+            return self._error(
+                start_response,
+                "415 Unsupported Media Type",
+                f"Unsupported Content-Encoding: {encoding}",
+            )
+
+        # Read no further than the compressed body
+        content_length = environ.get("CONTENT_LENGTH")
+        if content_length:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                return self._error(
+                    start_response, "400 Bad Request", "Invalid Content-Length"
+                )
+            if content_length > self.max_content_length:
+                return self._error(
+                    start_response,
+                    "413 Request Entity Too Large",
+                    "Request body is too large",
+                )
+            stream = LimitedStream(environ["wsgi.input"], content_length)
+        elif environ.get("wsgi.input_terminated"):
+            stream = environ["wsgi.input"]
+        else:
+            stream = io.BytesIO()
+
+        decompressing_stream = DecompressingStream(
+            stream, encoding, self.max_content_length
+        )
+        environ = dict(environ)
+        environ["wsgi.input"] = decompressing_stream
+        environ["wsgi.input_terminated"] = True
+        environ.pop("CONTENT_LENGTH", None)
+        del environ["HTTP_CONTENT_ENCODING"]
+
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            record_decompression(decompressing_stream)
+
+    def _error(self, start_response, status, error_msg):
+        body = json.dumps({"error": True, "error_msg": error_msg}).encode()
+        start_response(
+            status,
+            [("Content-Type", "application/json"), ("Content-Length", str(len(body)))],
+        )
+        return [body]
@@ -1,9 +1,23 @@
 import os
+import socket
 from datetime import datetime
 
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import ConnectionError
-from elasticsearch_dsl import connections, Date, Document, Index, Text, Boolean
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionError, TransportError
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch_dsl import (
+    connections,
+    Date,
+    Document,
+    Index,
+    Text,
+    Keyword,
+    Boolean,
+    Long,
+    Object,
+)
+from urllib3.connection import HTTPConnection
+from prometheus_client import Histogram
 
 
 # Configure ElasticSearch default connection
@@ -16,38 +30,114 @@ if "ELASTICSEARCH_HOSTS" in os.environ:
 else:
     elasticsearch_url = "https://elasticsearch:9200"
 
-# Connect using both high-level and low-level elasticsearch clients
-if elasticsearch_url.startswith("https://"):
+# ELASTICSEARCH_HOSTS can list several nodes, separated by commas, and requests are
+# spread across them
+elasticsearch_hosts = [host.strip() for host in elasticsearch_url.split(",")]
+
+# Seconds a request may take, unless its operation (the label it has in
+# flock_elasticsearch_request_seconds) has its own timeout, like "index=60"
+default_timeout = float(os.environ.get("FLOCK_ELASTICSEARCH_TIMEOUT", 20))
+operation_timeouts = {}
+for item in os.environ.get("FLOCK_ELASTICSEARCH_TIMEOUTS", "").split(","):
+    if item.strip():
+        operation, seconds = item.split("=")
+        operation_timeouts[operation.strip()] = float(seconds)
+
+# Every node has its own pool of up to maxsize connections. With a sniff interval,
+# the nodes are discovered from the cluster every that many seconds, and when a
+# connection fails. Timed out requests are only retried on another node with
+# FLOCK_ELASTICSEARCH_RETRY_ON_TIMEOUT, because ElasticSearch may still complete them.
+sniff_interval = float(os.environ.get("FLOCK_ELASTICSEARCH_SNIFF_INTERVAL", 0))
+client_options = dict(
+    timeout=default_timeout,
+    maxsize=int(os.environ.get("FLOCK_ELASTICSEARCH_MAXSIZE", 10)),
+    max_retries=int(os.environ.get("FLOCK_ELASTICSEARCH_MAX_RETRIES", 3)),
+    retry_on_timeout=os.environ.get("FLOCK_ELASTICSEARCH_RETRY_ON_TIMEOUT") == "1",
+)
+if sniff_interval:
+    client_options.update(
+        sniffer_timeout=sniff_interval,
+        sniff_on_connection_fail=True,
+        sniff_timeout=5,
+    )
+
+if any(host.startswith("https://") for host in elasticsearch_hosts):
     if "ELASTIC_PASSWORD" in os.environ:
         http_auth = ("elastic", os.environ["ELASTIC_PASSWORD"])
     else:
         http_auth = None
 
-    connections.create_connection(
-        hosts=[elasticsearch_url],
-        timeout=20,
+    client_options.update(
         use_ssl=True,
         verify_certs=True,
         ca_certs=ca_cert_path,
         http_auth=http_auth,
     )
-    es = Elasticsearch(
-        hosts=[elasticsearch_url],
-        timeout=20,
-        use_ssl=True,
-        verify_certs=True,
-        ca_certs=ca_cert_path,
-        http_auth=http_auth,
-    )
-else:
-    connections.create_connection(hosts=[elasticsearch_url], timeout=20)
-    es = Elasticsearch([elasticsearch_url], timeout=20)
+
+# Idle connections are kept open for the next request. TCP keep-alive probes stop
+# firewalls and load balancers from silently dropping them in the meantime.
+keepalive = int(os.environ.get("FLOCK_ELASTICSEARCH_KEEPALIVE", 60))
+
+
+class KeepAliveConnection(Urllib3HttpConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if keepalive:
+            socket_options = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                socket_options += [
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, keepalive),
+                ]
+            self.pool.conn_kw["socket_options"] = socket_options
+
+
+# The high-level and low-level clients share one client, and so one connection pool
+es = Elasticsearch(
+    elasticsearch_hosts, connection_class=KeepAliveConnection, **client_options
+)
+connections.add_connection("default", es)
+
+
+def request_timeout(operation):
+    # The request_timeout for an operation's requests
+    return operation_timeouts.get(operation, default_timeout)
+
+
+def create_async_client():
+    # The asyncio API uses AsyncElasticsearch, which needs elasticsearch>=7.8 and
+    # aiohttp. Each event loop needs its own client.
+    from elasticsearch import AsyncElasticsearch
+
+    return AsyncElasticsearch(elasticsearch_hosts, **client_options)
+
+
+# How long ElasticSearch requests take, by what they're for
+es_request_seconds = Histogram(
+    "flock_elasticsearch_request_seconds",
+    "Time spent on ElasticSearch requests, by operation",
+    ["operation"],
+)
+
+
+def reset_connections():
+    # Connection pools can't be shared across a fork, so each gateway worker process
+    # creates its own after it starts. Transport.set_connections() reuses existing
+    # connections, so drop the old pool first. With sniffing, each worker discovers
+    # the nodes again on its first request.
+    transport = es.transport
+    del transport.connection_pool
+    transport.set_connections(transport.hosts)
+    if sniff_interval:
+        transport.last_sniff = 0
 
 
 class User(Document):
-    username = Text()
+    username = Keyword()
     name = Text()
-    token = Text()
+    token = Keyword()
     created_at = Date()
 
     class Index:
@@ -58,8 +148,18 @@ class User(Document):
         return super(User, self).save(**kwargs)
 
 
+class UserChange(Document):
+    # A user that the Keybase bot renamed or deleted, so gateway processes can drop
+    # it from their identity caches
+    username = Keyword()
+    changed_at = Date()
+
+    class Index:
+        name = "user_change"
+
+
 class Setting(Document):
-    key = Text()
+    key = Keyword()
     value = Text()
 
     class Index:
@@ -67,10 +167,84 @@ class Setting(Document):
 
 
 class KeybaseNotification(Document):
-    notification_type = Text()
+    notification_type = Keyword()
     details = Text()
     delivered = Boolean()
     created_at = Date()
 
+    # How many times sending the notification failed, and when to try again, if
+    # it failed too many times
+    attempts = Long()
+    next_attempt_at = Date()
+
     class Index:
         name = "keybase_notification"
+
+
+class HostState(Document):
+    # The latest state of each host, with its username as the _id. See
+    # host_states.py.
+    username = Keyword()
+    last_seen = Date()
+    last_result_at = Date()
+    os_version = Object()
+    server_enabled = Boolean()
+    twigs = Object()
+    submit_count = Long()
+    doc_count = Long()
+    log_count = Long()
+
+    class Index:
+        name = "host_state"
+
+
+def bulk_index(actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024):
+    # Send actions to ElasticSearch with the bulk API, split into chunks of at most
+    # chunk_size actions and max_chunk_bytes bytes. Returns the number of documents
+    # that were indexed, and a list describing each document that failed.
+    indexed_count = 0
+    failures = []
+    with es_request_seconds.labels(operation="index").time():
+        results = streaming_bulk(
+            es,
+            actions,
+            chunk_size=chunk_size,
+            max_chunk_bytes=max_chunk_bytes,
+            raise_on_error=False,
+            request_timeout=request_timeout("index"),
+        )
+        for i, (ok, info) in enumerate(results):
+            if ok:
+                indexed_count += 1
+            else:
+                item = next(iter(info.values()))
+                failures.append(
+                    {
+                        "item": i,
+                        "status": item.get("status"),
+                        "error": item.get("error"),
+                    }
+                )
+    return indexed_count, failures
+
+
+def is_duplicate(failure):
+    # A bulk failure for a doc created with an _id that's already indexed
+    return failure["status"] == 409
+
+
+def is_available():
+    # Is ElasticSearch up and able to accept writes?
+    try:
+        health = es.cluster.health(request_timeout=5)
+    except TransportError:
+        return False
+    return health["status"] != "red"
+
+
+def is_unavailable_error(e):
+    # Does this exception mean ElasticSearch is down or overloaded, rather than that
+    # the request was bad?
+    if isinstance(e, ConnectionError):
+        return True
+    return isinstance(e, TransportError) and e.status_code in (429, 502, 503, 504)
@@ -0,0 +1,135 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+from prometheus_client import Counter
+
+
+logger = logging.getLogger(__name__)
+
+host_state_updates = Counter(
+    "flock_host_state_updates_total",
+    "Host state updates, by whether they were coalesced with a pending update",
+    ["result"],
+)
+
+
+# Each host has a small state document that's kept up to date as it submits data,
+# so the bot and dashboards can look up a host without searching its osquery
+# results. It can have these keys:
+#
+# - last_seen: when the gateway last heard from the host
+# - last_result_at: the @timestamp of the host's latest osquery result
+# - os_version: the columns of the host's latest os_version result
+# - server_enabled: whether the agent's log server is enabled
+# - twigs: a dict that maps twig ids to whether they're enabled
+# - submit_count, doc_count and log_count: how many /submit requests, osquery
+#   results and log events the host has sent
+#
+# An update is a dict with some of these keys, which is merged into the state by
+# merge_host_state(). ElasticsearchStorage merges updates with the same rules in a
+# script, because updates from different gateway processes can arrive in any order.
+
+LATEST_KEYS = ("last_seen", "last_result_at")
+
+
+def merge_host_state(state, update):
+    # Merge an update into a host's state, in place. Counts are added together,
+    # times only move forward, twigs are merged, and anything else is replaced.
+    for key, value in update.items():
+        if key == "twigs":
+            state.setdefault("twigs", {}).update(value)
+        elif key.endswith("_count"):
+            state[key] = state.get(key, 0) + value
+        elif key in LATEST_KEYS:
+            if key not in state or state[key] < value:
+                state[key] = value
+        else:
+            state[key] = value
+    return state
+
+
+def timestamp(dt=None):
+    # Format a UTC datetime like the @timestamp of osquery results
+    if dt is None:
+        dt = datetime.utcnow()
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03}Z"
+
+
+class HostStateTracker:
+    """
+    Coalesces updates to each host's state in memory and writes them to storage
+    every interval seconds, so a busy host costs at most one write per interval no
+    matter how often it submits. With an interval of 0, updates are written right
+    away.
+    """
+
+    def __init__(self, storage, interval=10):
+        self.storage = storage
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so start the writer in the process that uses it
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(
+                target=self._flush_forever, name="flock-host-states", daemon=True
+            )
+            thread.start()
+
+    def update(self, username, update):
+        update["last_seen"] = timestamp()
+        if not self.interval:
+            host_state_updates.labels(result="new").inc()
+            self.storage.update_host_states({username: update})
+            return
+
+        self._ensure_started()
+        with self._lock:
+            pending = self._pending.get(username)
+            if pending is None:
+                self._pending[username] = update
+                host_state_updates.labels(result="new").inc()
+            else:
+                merge_host_state(pending, update)
+                host_state_updates.labels(result="coalesced").inc()
+
+    @property
+    def pending_hosts(self):
+        return len(self._pending)
+
+    def flush(self):
+        # Write the pending updates. If that fails they're kept, and merged with any
+        # updates made in the meantime, for the next flush.
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return
+        try:
+            self.storage.update_host_states(pending)
+        except Exception:
+            with self._lock:
+                for username, update in self._pending.items():
+                    merge_host_state(pending.setdefault(username, {}), update)
+                self._pending = pending
+            raise
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(
+                    f"Failed to update the state of {self.pending_hosts} hosts"
+                )
@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from prometheus_client import Counter, Gauge
+
+
+logger = logging.getLogger(__name__)
+
+lookups = Counter(
+    "flock_identity_cache_lookups_total",
+    "Authenticated user lookups, by whether they were cached",
+    ["result"],
+)
+# Summed over the live gunicorn workers, each with its own cache
+cache_size = Gauge(
+    "flock_identity_cache_size",
+    "Number of cached authenticated users",
+    multiprocess_mode="livesum",
+)
+
+
+class IdentityCache:
+    """
+    A process-wide cache of authenticated users, keyed by username and token, so that
+    agents checking in don't cost a search of the user index on every request
+    """
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, username, token, load):
+        # Return the cached user, or call load() to look it up. load() should return
+        # the user, or None if the credentials are invalid (which is never cached).
+        generation = self.generation(username)
+        found, user = self.lookup(username, token)
+        if found:
+            return user
+        user = load()
+        self.store(username, token, user, generation)
+        return user
+
+    def generation(self, username):
+        # Changes every time the user is invalidated. Get it before loading a user,
+        # and pass it to store(), so a user that was deleted or renamed while it
+        # was being loaded isn't cached.
+        with self._lock:
+            return self._generations.get(username, 0)
+
+    def lookup(self, username, token):
+        # Returns a tuple of whether the credentials are cached, and the cached user
+        key = (username, token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                lookups.labels(result="hit").inc()
+                return True, entry[0]
+            self.misses += 1
+        lookups.labels(result="miss").inc()
+        return False, None
+
+    def store(self, username, token, user, generation=None):
+        if user is None:
+            return
+        key = (username, token)
+        with self._lock:
+            if (
+                generation is not None
+                and self._generations.get(username, 0) != generation
+            ):
+                return
+            self._entries[key] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            cache_size.set(len(self._entries))
+
+    def invalidate(self, username):
+        with self._lock:
+            self._generations[username] = self._generations.get(username, 0) + 1
+            for key in [key for key in self._entries if key[0] == username]:
+                del self._entries[key]
+            cache_size.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            cache_size.set(0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+identity_cache = IdentityCache(
+    ttl=float(os.environ.get("FLOCK_IDENTITY_CACHE_TTL", 60)),
+    max_size=int(os.environ.get("FLOCK_IDENTITY_CACHE_SIZE", 10000)),
+)
+
+class UserChangeWatcher:
+    """
+    Invalidates cached users that the Keybase bot renamed or deleted. The bot runs in
+    another process, so every gateway process checks storage for changed users every
+    interval seconds.
+    """
+
+    # How far back to look for changes, in case clocks differ or changes are
+    # found out of order
+    overlap = timedelta(seconds=60)
+
+    def __init__(self, storage, cache=identity_cache, interval=5):
+        self.storage = storage
+        self.cache = cache
+        self.interval = interval
+        self._since = datetime.utcnow()
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Threads don't survive a fork, so start the watcher in the process that
+        # uses it
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(
+                target=self._check_forever, name="flock-user-changes", daemon=True
+            )
+            thread.start()
+
+    def check(self):
+        # Invalidate the users that changed since the last check
+        since = self._since - self.overlap
+        for username, changed_at in self.storage.user_changes(since):
+            if (username, changed_at) in self._seen:
+                continue
+            self._seen[username, changed_at] = changed_at
+            self.cache.invalidate(username)
+            self._since = max(self._since, changed_at)
+
+        # Forget changes that are too old to be found again
+        since = self._since - self.overlap
+        for key, changed_at in list(self._seen.items()):
+            if changed_at < since:
+                del self._seen[key]
+
+    def _check_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Failed to check for renamed and deleted users")
@@ -0,0 +1,134 @@
+import os
+import time
+
+from elasticsearch.exceptions import RequestError
+
+from .elasticsearch import es
+
+
+# osquery docs are stored in flock-* indices: a daily index for the day each event
+# happened, or with rollover, indices that ElasticSearch rolls over by size and age
+template_name = "flock"
+rollover_policy_name = "flock"
+rollover_alias = "flock-write"
+
+
+def _env_bool(name):
+    return os.environ.get(name) == "1"
+
+
+class IndexRouter:
+    """
+    Picks the index for each osquery doc. Docs go into the daily index for the day
+    of their unixTime, so late uploads land in the right day. Docs without a
+    unixTime, or with a clock that's too far off, go into today's index.
+    """
+
+    def __init__(self, rollover=False, max_event_age_days=30):
+        self.rollover = rollover
+        self.max_event_age = max_event_age_days * 86400
+        self._index_names = {}
+
+    def index_for(self, doc, now=None):
+        if self.rollover:
+            return rollover_alias
+
+        if now is None:
+            now = time.time()
+        try:
+            event_time = int(doc["unixTime"])
+        except (KeyError, TypeError, ValueError):
+            event_time = now
+        if not now - self.max_event_age <= event_time <= now + 86400:
+            event_time = now
+
+        # Only a few days are ever in range, so cache their index names
+        day = int(event_time // 86400)
+        index_name = self._index_names.get(day)
+        if index_name is None:
+            index_name = "flock-{}".format(
+                time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+            )
+            if len(self._index_names) > 1000:
+                self._index_names.clear()
+            self._index_names[day] = index_name
+        return index_name
+
+
+def flock_template(
+    shards=None, replicas=None, refresh_interval=None, codec=None, rollover=None
+):
+    # Settings for write-heavy ingest: few shards, infrequent refreshes, and a
+    # codec that trades a little CPU for much smaller indices
+    if shards is None:
+        shards = int(os.environ.get("FLOCK_INDEX_SHARDS", 1))
+    if replicas is None:
+        replicas = int(os.environ.get("FLOCK_INDEX_REPLICAS", 1))
+    if refresh_interval is None:
+        refresh_interval = os.environ.get("FLOCK_INDEX_REFRESH_INTERVAL", "30s")
+    if codec is None:
+        codec = os.environ.get("FLOCK_INDEX_CODEC", "best_compression")
+    if rollover is None:
+        rollover = _env_bool("FLOCK_INDEX_ROLLOVER")
+
+    settings = {
+        "index.number_of_shards": shards,
+        "index.number_of_replicas": replicas,
+        "index.refresh_interval": refresh_interval,
+        "index.codec": codec,
+    }
+    if rollover:
+        settings["index.lifecycle.name"] = rollover_policy_name
+        settings["index.lifecycle.rollover_alias"] = rollover_alias
+
+    # Other fields are mapped dynamically, so strings like hostIdentifier and name
+    # keep their .keyword fields
+    return {
+        "index_patterns": ["flock-*"],
+        "settings": settings,
+        "mappings": {"properties": {"@timestamp": {"type": "date"}}},
+    }
+
+
+def install_flock_template(rollover=None, max_size=None, max_age=None, log=print):
+    # Install the flock-* index template, and with rollover, the lifecycle policy
+    # and the first index. Changes to the template apply to indices created after.
+    if rollover is None:
+        rollover = _env_bool("FLOCK_INDEX_ROLLOVER")
+    if max_size is None:
+        max_size = os.environ.get("FLOCK_INDEX_ROLLOVER_MAX_SIZE", "50gb")
+    if max_age is None:
+        max_age = os.environ.get("FLOCK_INDEX_ROLLOVER_MAX_AGE", "1d")
+
+    es.indices.put_template(name=template_name, body=flock_template(rollover=rollover))
+    log(f"Installed the {template_name} index template")
+
+    if not rollover:
+        return
+
+    es.ilm.put_lifecycle(
+        policy=rollover_policy_name,
+        body={
+            "policy": {
+                "phases": {
+                    "hot": {
+                        "actions": {
+                            "rollover": {"max_size": max_size, "max_age": max_age}
+                        }
+                    }
+                }
+            }
+        },
+    )
+
+    if not es.indices.exists_alias(name=rollover_alias):
+        try:
+            es.indices.create(
+                index="flock-000001",
+                body={"aliases": {rollover_alias: {"is_write_index": True}}},
+            )
+        except RequestError as e:
+            # Another process created it first
+            if e.error != "resource_already_exists_exception":
+                raise
+    log(f"Rolling over {rollover_alias} at {max_size} or {max_age}")
@@ -0,0 +1,603 @@
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict, deque
+
+from prometheus_client import Counter, Histogram
+
+from .streaming import iter_json_array, NotAnArrayError, BodyTooLargeError
+from .host_states import merge_host_state
+
+
+# The ingest pipeline shared by the Flask and asyncio APIs. Each submitted doc goes
+# through a list of stages in a single pass. A stage is a callable that takes the
+# doc's position, the doc and the Batch it's part of, and it can change the doc,
+# record something in the batch, or raise IngestError to reject the request.
+
+submitted_docs = Counter(
+    "flock_submitted_docs_total",
+    "Documents submitted to /submit, by what happened to them",
+    ["outcome"],
+)
+submit_batch_docs = Histogram(
+    "flock_submit_batch_docs",
+    "Number of documents submitted in each /submit request",
+    buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000),
+)
+
+
+class IngestError(Exception):
+    # A problem with the submitted data, reported back to the agent as an API error
+    pass
+
+
+def validate_username(username):
+    # Returns the username, or raises IngestError
+    if not username:
+        raise IngestError("You must provide a username")
+
+    valid_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ01234567890_-"
+    for c in username:
+        if c not in valid_chars:
+            raise IngestError(
+                "Usernames must only contain letters, numbers, '-', or '_'"
+            )
+    return username
+
+
+def clean_name(name):
+    # Strip invalid characters from name
+    new_name = ""
+    invalid_chars = "`{}!@#$%^&*_"
+    for c in name:
+        if c not in invalid_chars:
+            new_name += c
+    return new_name
+
+
+class SubmitCounts:
+    """
+    What happened to the docs of one /submit request, which both the Flask and
+    asyncio APIs respond with and record in metrics the same way
+    """
+
+    def __init__(self):
+        self.processed_count = 0
+        self.indexed_count = 0
+        self.spooled_count = 0
+        self.duplicate_count = 0
+        self.failures = []
+
+    def add_chunk(self, actions, indexed_count, failures, spooled_count, duplicates):
+        # Count a chunk that was forwarded, with the results of index_actions().
+        # Returns its failures and duplicates, numbered by their position in the
+        # request.
+        for failure in failures + duplicates:
+            failure["item"] += self.processed_count
+        self.failures.extend(failures)
+        self.indexed_count += indexed_count
+        self.spooled_count += spooled_count
+        self.duplicate_count += len(duplicates)
+        self.processed_count += len(actions)
+        return failures, duplicates
+
+    def add_queued(self, actions):
+        self.processed_count += len(actions)
+
+    def add_skipped(self, batch):
+        # Docs that were skipped as duplicates were processed without forwarding
+        # them
+        self.processed_count += batch.skipped_count
+        self.duplicate_count += batch.skipped_count
+
+    def response(self):
+        return {
+            "processed_count": self.processed_count,
+            "indexed_count": self.indexed_count,
+            "spooled_count": self.spooled_count,
+            "duplicate_count": self.duplicate_count,
+            "failed_count": len(self.failures),
+            "failures": self.failures,
+        }
+
+    def queued_response(self):
+        return {
+            "processed_count": self.processed_count,
+            "duplicate_count": self.duplicate_count,
+        }
+
+    def record(self, queued=False):
+        submit_batch_docs.observe(self.processed_count)
+        if queued:
+            # Docs that were indexed because the queue was full are counted as
+            # queued too
+            submitted_docs.labels(outcome="queued").inc(
+                self.processed_count - self.duplicate_count
+            )
+        else:
+            submitted_docs.labels(outcome="indexed").inc(self.indexed_count)
+            submitted_docs.labels(outcome="spooled").inc(self.spooled_count)
+            submitted_docs.labels(outcome="failed").inc(len(self.failures))
+        submitted_docs.labels(outcome="duplicate").inc(self.duplicate_count)
+
+
+def document_id(doc):
+    # A stable _id for an osquery result, so the same row sent twice is only
+    # indexed once
+    key = json.dumps(
+        [
+            doc.get("hostIdentifier"),
+            doc.get("name"),
+            doc.get("action"),
+            doc.get("unixTime", doc.get("calendarTime")),
+            doc.get("columns", doc.get("snapshot")),
+        ],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class RecentIds:
+    """
+    The _ids of the most recently indexed docs, so resent docs can be skipped
+    without asking ElasticSearch
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, doc_id):
+        return doc_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add_many(self, doc_ids):
+        with self._lock:
+            for doc_id in doc_ids:
+                self._ids[doc_id] = None
+                self._ids.move_to_end(doc_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+
+# How a summarized doc's action is counted: added, removed, or anything else
+SUMMARY_ACTIONS = {"added": 0, "removed": 1}
+OTHER_ACTION = 2
+
+
+class Batch:
+    """
+    The docs from one request, as they go through a pipeline: who sent them, and
+    the notifications they should trigger
+    """
+
+    def __init__(self, username, name):
+        self.username = username
+        self.name = name
+        self._notifications = []
+
+        # Each doc the pipeline yields is numbered by its position among them, so
+        # bulk failures can be matched back to it
+        self.action_count = 0
+
+        # The first osquery doc of each notification type, and how many of each
+        # action, for docs that have been committed. For docs that haven't been
+        # committed yet, only the first doc of each type is kept, with every doc's
+        # position and action, so a large body doesn't stay in memory.
+        self._summaries = {}
+        self._pending_summarized = {}
+
+        # Docs with an _id are created rather than indexed. Duplicates are skipped,
+        # and their _ids remembered once they're committed.
+        self.doc_count = 0
+        self.doc_id = None
+        self.duplicate_count = 0
+        self._pending_duplicate_count = 0
+        self._pending_ids = {}
+        self._batch_ids = set()
+        self._recent_ids = None
+
+        # What the committed docs say about the host's state, as an update for
+        # HostStateTracker, and what the docs that haven't been committed say
+        self.host_state = {}
+        self._pending_host_state = {}
+
+        # The pending state of each chunk that's been checkpointed, oldest first.
+        # Chunks can be committed by the ingest queue's threads.
+        self._checkpoints = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def skipped_count(self):
+        # Docs the pipeline dropped instead of yielding, which are duplicates
+        return self.doc_count - self.action_count
+
+    def notify(self, notification, details):
+        self._notifications.append((notification, details))
+
+    def summarize(self, notification, doc):
+        summarized = self._pending_summarized.get(notification)
+        if summarized is None:
+            summarized = {
+                "doc": doc,
+                "position": self.action_count,
+                "positions": array("q"),
+                "actions": bytearray(),
+            }
+            self._pending_summarized[notification] = summarized
+        summarized["positions"].append(self.action_count)
+        summarized["actions"].append(
+            SUMMARY_ACTIONS.get(doc.get("action"), OTHER_ACTION)
+        )
+
+    def add_id(self, doc_id, recent_ids):
+        self.doc_id = doc_id
+        self._pending_ids[doc_id] = self.action_count
+        self._batch_ids.add(doc_id)
+        self._recent_ids = recent_ids
+
+    def is_pending(self, doc_id):
+        # Whether the doc already appeared in this batch
+        return doc_id in self._batch_ids
+
+    def skip_duplicate(self):
+        self._pending_duplicate_count += 1
+
+    def update_host_state(self, **update):
+        merge_host_state(self._pending_host_state, update)
+
+    def checkpoint(self):
+        # Set aside the docs summarized so far, to be committed together by the
+        # next commit()
+        with self._lock:
+            self._checkpoints.append(self._take_pending())
+
+    def _take_pending(self):
+        pending = (
+            self._pending_duplicate_count,
+            self._pending_ids,
+            self._pending_host_state,
+            self._pending_summarized,
+        )
+        self._pending_duplicate_count = 0
+        self._pending_ids = {}
+        self._pending_host_state = {}
+        self._pending_summarized = {}
+        return pending
+
+    def next_checkpoint(self):
+        # Take the pending state of the oldest checkpoint, or of the docs summarized
+        # so far if there isn't one, to commit later
+        with self._lock:
+            if self._checkpoints:
+                return self._checkpoints.popleft()
+            return self._take_pending()
+
+    def commit(self, failures=(), duplicates=(), checkpoint=None):
+        # Include the docs summarized so far in notifications and the host's state,
+        # or only those of the oldest checkpoint if there is one, or of checkpoint.
+        # failures and duplicates are bulk failures whose "item" is a doc's
+        # position: docs that failed aren't remembered as indexed, and neither they
+        # nor docs that were already indexed trigger notifications. Docs that are
+        # never committed, like those in a chunk that wasn't forwarded, are left
+        # out.
+        if checkpoint is None:
+            checkpoint = self.next_checkpoint()
+        with self._lock:
+            self._commit(checkpoint, failures, duplicates)
+
+    def _commit(self, pending, failures, duplicates):
+        duplicate_count, pending_ids, pending_host_state, pending_summarized = pending
+        failed = {failure["item"] for failure in failures}
+        not_indexed = failed | {duplicate["item"] for duplicate in duplicates}
+
+        self.duplicate_count += duplicate_count
+        indexed_ids = [
+            doc_id for doc_id, position in pending_ids.items() if position not in failed
+        ]
+        if indexed_ids:
+            self._recent_ids.add_many(indexed_ids)
+        if pending_host_state:
+            merge_host_state(self.host_state, pending_host_state)
+
+        for notification, summarized in pending_summarized.items():
+            summary = self._summaries.get(notification)
+            for position, action in zip(summarized["positions"], summarized["actions"]):
+                if position in not_indexed:
+                    continue
+                if summary is None:
+                    # Only the first doc is kept, so if it wasn't indexed, a single
+                    # doc is reported as a summary
+                    summary = {
+                        "doc": (
+                            summarized["doc"]
+                            if position == summarized["position"]
+                            else None
+                        ),
+                        "count": 0,
+                        "action_counts": [0, 0, 0],
+                    }
+                    self._summaries[notification] = summary
+                summary["count"] += 1
+                summary["action_counts"][action] += 1
+
+    def notifications(self):
+        # A list of (notification, details) tuples: one for each committed osquery
+        # notification type, either the doc itself or a summary, then the rest
+        notifications = []
+        for notification, summary in self._summaries.items():
+            if summary["count"] == 1 and summary["doc"] is not None:
+                notifications.append((notification, summary["doc"]))
+            else:
+                added_count, removed_count, other_count = summary["action_counts"]
+                notifications.append(
+                    (
+                        notification,
+                        {
+                            "type": "summary",
+                            "username": self.username,
+                            "name": self.name,
+                            "added_count": added_count,
+                            "removed_count": removed_count,
+                            "other_count": other_count,
+                        },
+                    )
+                )
+        return notifications + self._notifications
+
+
+class Pipeline:
+    """
+    Runs each doc through the stages in order. A stage can return False to drop
+    the doc. With a router, it produces bulk actions for the index the router
+    picks for each doc.
+    """
+
+    # Chunks are buffered in memory up to this many bytes, and then on disk
+    max_buffer_memory = 8 * 1024 * 1024
+
+    def __init__(self, stages, router=None):
+        self.stages = list(stages)
+        self.router = router
+
+    def run(self, docs, batch):
+        stages = self.stages
+        router = self.router
+        i = -1
+        for i, doc in enumerate(docs):
+            for stage in stages:
+                if stage(i, doc, batch) is False:
+                    break
+            else:
+                batch.action_count += 1
+                if not router:
+                    yield doc
+                elif batch.doc_id:
+                    yield {
+                        "_op_type": "create",
+                        "_index": router.index_for(doc),
+                        "_id": batch.doc_id,
+                        "_source": doc,
+                    }
+                    batch.doc_id = None
+                else:
+                    yield {"_index": router.index_for(doc), "_source": doc}
+        batch.doc_count += i + 1
+
+    def chunks(self, stream, batch, chunk_size, max_bytes=None):
+        """
+        Parse a JSON array from a request body, run each item through the pipeline,
+        and yield the results in lists of up to chunk_size, checkpointing the batch
+        after each one. The whole body is validated before the first chunk is
+        yielded, so nothing is forwarded from a request that's rejected: chunks
+        after the first are buffered in a temporary file until then. Raises
+        IngestError when the data is invalid, and BodyTooLargeError.
+        """
+        first_chunk = None
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.max_buffer_memory)
+        with buffer:
+            chunk = []
+            try:
+                docs = iter_json_array(stream, max_bytes=max_bytes)
+                for result in self.run(docs, batch):
+                    chunk.append(result)
+                    if len(chunk) >= chunk_size:
+                        first_chunk = self._buffer(chunk, first_chunk, buffer)
+                        batch.checkpoint()
+                        chunk = []
+            except NotAnArrayError:
+                raise IngestError("Data is not an array")
+            except BodyTooLargeError:
+                raise
+            except ValueError:
+                raise IngestError("Invalid JSON object")
+
+            if chunk:
+                first_chunk = self._buffer(chunk, first_chunk, buffer)
+                batch.checkpoint()
+            if batch.doc_count == 0:
+                raise IngestError("Invalid JSON object")
+
+            if first_chunk is not None:
+                yield first_chunk
+            buffer.seek(0)
+            for line in buffer:
+                yield json.loads(line)
+
+    def _buffer(self, chunk, first_chunk, buffer):
+        # Keep the first chunk in memory, and write the rest to the buffer, one per
+        # line. Returns the first chunk.
+        if first_chunk is None:
+            return chunk
+        buffer.write(json.dumps(chunk, separators=(",", ":")).encode())
+        buffer.write(b"\n")
+        return first_chunk
+
+
+# Stages
+
+
+def require_object(i, doc, batch):
+    # Item should be an object
+    if type(doc) != dict:
+        raise IngestError("Item {} is not an object".format(i))
+
+
+def require_host_identifier(i, doc, batch):
+    # hostIdentifier should be the username
+    if doc.get("hostIdentifier") != batch.username:
+        raise IngestError(
+            "Item {} does not contain the correct hostIdentifier".format(i)
+        )
+
+
+class ConvertUnixTime:
+    """
+    Converts 'unixTime' to '@timestamp'. osquery reports every row of a query with
+    the same unixTime, so conversions are cached by the second.
+    """
+
+    def __init__(self, max_cached=4096):
+        self.max_cached = max_cached
+        self._cache = {}
+
+    def __call__(self, i, doc, batch):
+        if "unixTime" not in doc:
+            return
+        unix_time = int(doc["unixTime"])
+        timestamp = self._cache.get(unix_time)
+        if timestamp is None:
+            try:
+                timestamp = time.strftime(
+                    "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(unix_time)
+                )
+            except (OverflowError, OSError):
+                raise ValueError("unixTime is out of range")
+            if len(self._cache) >= self.max_cached:
+                self._cache.clear()
+            self._cache[unix_time] = timestamp
+        doc["@timestamp"] = timestamp
+
+
+class SkipDuplicates:
+    # Gives each doc a content-hash _id, and drops docs that were recently indexed
+    # or that already appeared in this batch
+    def __init__(self, recent_ids):
+        self.recent_ids = recent_ids
+
+    def __call__(self, i, doc, batch):
+        doc_id = document_id(doc)
+        if doc_id in self.recent_ids or batch.is_pending(doc_id):
+            batch.skip_duplicate()
+            return False
+        batch.add_id(doc_id, self.recent_ids)
+
+
+def tag_user(i, doc, batch):
+    doc["username"] = batch.username
+    doc["user_name"] = batch.name
+
+
+class SummarizeOsqueryNotifications:
+    # Summarizes docs from the osquery queries that trigger notifications
+    def __init__(self, notification_names):
+        self.notification_names = frozenset(notification_names)
+
+    def __call__(self, i, doc, batch):
+        name = doc.get("name")
+        if name in self.notification_names:
+            batch.summarize(name, doc)
+
+
+def track_host_state(i, doc, batch):
+    # Remember the time of the host's latest result, and its latest OS version
+    if "@timestamp" in doc:
+        batch.update_host_state(last_result_at=doc["@timestamp"])
+    if doc.get("name") == "os_version" and doc.get("action") != "removed":
+        columns = doc.get("columns")
+        snapshot = doc.get("snapshot")
+        if columns is None and isinstance(snapshot, list) and snapshot:
+            columns = snapshot[0]
+        if isinstance(columns, dict):
+            batch.update_host_state(os_version=columns)
+
+
+def require_flock_log_fields(i, doc, batch):
+    # Item should have type and timestamp, and maybe twig_id
+    if "type" not in doc:
+        raise IngestError("Item {} does not contain a type field".format(i))
+    if "timestamp" not in doc:
+        raise IngestError("Item {} does not contain a timestamp field".format(i))
+    if doc["type"] == "enable_twig" or doc["type"] == "disable_twig":
+        if "twig_id" not in doc:
+            raise IngestError(
+                "Item {} is about a twig, but does not contain a twig_id field".format(
+                    i
+                )
+            )
+
+
+def notify_flock_logs(i, doc, batch):
+    if doc["type"] in [
+        "server_enabled",
+        "server_disabled",
+        "twigs_enabled",
+        "twigs_disabled",
+    ]:
+        details = {"username": batch.username, "name": batch.name}
+        if doc["type"] in ["twigs_enabled", "twigs_disabled"]:
+            details["twig_ids"] = doc["twig_ids"]
+        batch.notify(doc["type"], details)
+
+
+def track_flock_log_state(i, doc, batch):
+    # Remember whether the host's server and twigs are enabled
+    log_type = doc["type"]
+    if log_type in ["server_enabled", "server_disabled"]:
+        batch.update_host_state(server_enabled=log_type == "server_enabled")
+    elif log_type in ["enable_twig", "disable_twig"]:
+        batch.update_host_state(twigs={str(doc["twig_id"]): log_type == "enable_twig"})
+    elif log_type in ["twigs_enabled", "twigs_disabled"]:
+        enabled = log_type == "twigs_enabled"
+        batch.update_host_state(
+            twigs={str(twig_id): enabled for twig_id in doc.get("twig_ids", [])}
+        )
+
+
+def osquery_pipeline(keybase_notifications, router=None, recent_ids=None):
+    # The pipeline for /submit. With recent_ids, docs get content-hash _ids so
+    # resent docs aren't indexed again.
+    notification_names = [
+        key
+        for key, notification in keybase_notifications.notifications.items()
+        if notification["type"] == "osquery"
+    ]
+    stages = [require_object, require_host_identifier]
+    if recent_ids is not None:
+        stages.append(SkipDuplicates(recent_ids))
+    stages += [
+        ConvertUnixTime(),
+        tag_user,
+        SummarizeOsqueryNotifications(notification_names),
+        track_host_state,
+    ]
+    return Pipeline(stages, router=router)
+
+
+def flock_log_pipeline():
+    # The pipeline for /submit_flock_logs
+    return Pipeline(
+        [
+            require_object,
+            require_flock_log_fields,
+            notify_flock_logs,
+            track_flock_log_state,
+        ]
+    )
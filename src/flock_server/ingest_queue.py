@@ -0,0 +1,138 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+from prometheus_client import Gauge
+
+
+logger = logging.getLogger(__name__)
+
+# Summed over the live gunicorn workers, each with its own queue
+ingest_queue_docs = Gauge(
+    "flock_ingest_queue_docs",
+    "Number of documents waiting in the ingest queue",
+    multiprocess_mode="livesum",
+)
+
+
+class IngestQueue:
+    """
+    A bounded in-process queue of bulk actions, drained into ElasticSearch by a pool of
+    background worker threads, so /submit can return before the documents are indexed
+    """
+
+    def __init__(
+        self, index_func, workers=4, max_batches=1000, high_water=100000, chunk_size=500
+    ):
+        # index_func(actions) indexes a list of bulk actions, and returns a tuple of
+        # the indexed count, a list of failures, and a list of the failures for
+        # docs that were already indexed
+        self.index_func = index_func
+        self.workers = workers
+        self.high_water = high_water
+        self.chunk_size = chunk_size
+
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._lock = threading.Lock()
+        self._pending_docs = 0
+        self._pid = None
+
+    @property
+    def pending_docs(self):
+        return self._pending_docs
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so start the workers in the process that uses them
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"flock-ingest-{i}", daemon=True
+                )
+                thread.start()
+
+    def put(self, actions, on_indexed=None):
+        # Queue a batch of actions, returning False if the queue is full. Once
+        # they're indexed, on_indexed(failures, duplicates) is called with the
+        # batch's failures, numbered by their position in actions.
+        self._ensure_started()
+        with self._lock:
+            if self._pending_docs + len(actions) > self.high_water:
+                return False
+            try:
+                self._queue.put_nowait((actions, on_indexed))
+            except queue.Full:
+                return False
+            self._pending_docs += len(actions)
+            ingest_queue_docs.set(self._pending_docs)
+        return True
+
+    def join(self):
+        # Block until every queued batch has been indexed
+        self._queue.join()
+
+    def drain(self, timeout):
+        # Wait up to timeout seconds for queued batches to be indexed, returning True
+        # if the queue is empty
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks > 0:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _work(self):
+        while True:
+            # Wait for a batch, and then merge whatever else is waiting into it, up
+            # to the chunk size
+            batches = [self._queue.get()]
+            actions = list(batches[0][0])
+            while len(actions) < self.chunk_size:
+                try:
+                    batch = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batches.append(batch)
+                actions.extend(batch[0])
+
+            try:
+                indexed_count, failures, duplicates = self.index_func(actions)
+                if failures:
+                    logger.warning(
+                        f"Failed to index {len(failures)} of {len(actions)} queued documents: {failures}"
+                    )
+                self._report(batches, failures, duplicates)
+            except Exception:
+                logger.exception(f"Failed to index {len(actions)} queued documents")
+            finally:
+                with self._lock:
+                    self._pending_docs -= len(actions)
+                    ingest_queue_docs.set(self._pending_docs)
+                for batch in batches:
+                    self._queue.task_done()
+
+    def _report(self, batches, failures, duplicates):
+        # Call each batch's on_indexed with its own failures
+        start = 0
+        for batch_actions, on_indexed in batches:
+            end = start + len(batch_actions)
+            if on_indexed:
+                on_indexed(
+                    [
+                        dict(failure, item=failure["item"] - start)
+                        for failure in failures
+                        if start <= failure["item"] < end
+                    ],
+                    [
+                        dict(duplicate, item=duplicate["item"] - start)
+                        for duplicate in duplicates
+                        if start <= duplicate["item"] < end
+                    ],
+                )
+            start = end
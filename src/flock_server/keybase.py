@@ -1,20 +1,99 @@
 import asyncio
+import itertools
 import logging
 import os
 import subprocess
 import shlex
+from datetime import datetime, timedelta
 
 import pykeybasebot
-from elasticsearch.exceptions import RequestError
-from elasticsearch_dsl import Index, Search
+from prometheus_client import Counter, Gauge, Histogram
 
-from .elasticsearch import es, User, KeybaseNotification
+from .identity_cache import identity_cache
 from .keybase_notifications import KeybaseNotifications
+from .storage import create_storage
+from .metrics import start_http_server
+
+
+notifications_delivered = Counter(
+    "flock_notifications_delivered_total", "Keybase notifications delivered"
+)
+notification_backlog = Gauge(
+    "flock_notification_backlog", "Keybase notifications waiting to be delivered"
+)
+notification_messages_sent = Counter(
+    "flock_notification_messages_total",
+    "Keybase chat messages sent, each with one or more notifications",
+)
+notification_send_retries = Counter(
+    "flock_notification_send_retries_total",
+    "Keybase chat messages that failed to send and were retried",
+)
+notifications_deferred = Counter(
+    "flock_notifications_deferred_total",
+    "Keybase notifications that failed to send too many times, and were set aside "
+    "to try again later",
+)
+notification_delivery_lag = Histogram(
+    "flock_notification_delivery_lag_seconds",
+    "Time from a Keybase notification being created to it being delivered",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+
+def format_host_state(host_state):
+    # The parts of a host's state that list_users shows
+    details = {}
+    if "last_seen" in host_state:
+        details["last_seen"] = host_state["last_seen"]
+    if "last_result_at" in host_state:
+        details["last_updated"] = host_state["last_result_at"]
+    os_version = host_state.get("os_version")
+    if os_version:
+        details["os_version"] = f"{os_version.get('name')} {os_version.get('version')}"
+    if "server_enabled" in host_state:
+        details["server"] = "enabled" if host_state["server_enabled"] else "disabled"
+    twigs = host_state.get("twigs", {})
+    if twigs:
+        details["twigs"] = (
+            ", ".join(sorted(twig_id for twig_id, enabled in twigs.items() if enabled))
+            or "none"
+        )
+    return details
+
+
+class ChatSender:
+    """
+    Sends the bot's chat messages, like notifications and replies to commands. Up
+    to concurrency messages are sent at once across conversations, but only one
+    at a time within each conversation, so they arrive in order.
+    """
+
+    def __init__(self, concurrency=None):
+        if concurrency is None:
+            concurrency = int(os.environ.get("FLOCK_NOTIFICATION_SEND_CONCURRENCY", 4))
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._conversations = {}
+
+    async def send(self, bot, conv_id, message):
+        # The semaphore and locks are created here, so they belong to the running
+        # event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        lock = self._conversations.get(conv_id)
+        if lock is None:
+            lock = self._conversations[conv_id] = asyncio.Lock()
+        async with lock:
+            async with self._semaphore:
+                await bot.chat.send(conv_id, message)
 
 
 class Handler:
-    def __init__(self):
-        self.keybase_notifications = KeybaseNotifications()
+    def __init__(self, storage=None, sender=None):
+        self.keybase_notifications = KeybaseNotifications(storage=storage)
+        self.sender = sender or ChatSender()
+        self.storage = self.keybase_notifications.storage
         self.cmds = {
             "help": {"exec": self.help, "args": [], "desc": "Show this message"},
             "list_users": {
@@ -70,7 +149,8 @@ class Handler:
                     )
                 )
                 try:
-                    await bot.chat.send(
+                    await self.sender.send(
+                        bot,
                         event.msg.conv_id,
                         "Sorry @{}. I'm not configured to talk to you.".format(
                             event.msg.sender.username
@@ -107,7 +187,7 @@ class Handler:
     async def _send(self, bot, event, message):
         print("Sending message to {}: {}".format(event.msg.conv_id, repr(message)))
         try:
-            await bot.chat.send(event.msg.conv_id, message)
+            await self.sender.send(bot, event.msg.conv_id, message)
         except asyncio.exceptions.TimeoutError:
             pass
 
@@ -147,8 +227,8 @@ class Handler:
             return False
 
         # Get the user
-        results = User.search().query("match", username=username).execute()
-        if len(results) == 0:
+        user = self.storage.get_user(username)
+        if user is None:
             await self._send(
                 bot,
                 event,
@@ -158,7 +238,6 @@ class Handler:
             )
             return False
 
-        user = results[0]
         return user
 
     async def _validate_notification(self, bot, event, notification_name):
@@ -185,49 +264,16 @@ class Handler:
 
     async def list_users(self, bot, event, args):
         # Get all users
-        user_r = Search(index="user").query("match_all").execute()
+        user_hits = self.storage.list_users()
 
         # Start gathering data on users
+        host_states = self.storage.host_states(
+            [user_hit.username for user_hit in user_hits]
+        )
         users = {}
-        for user_hit in user_r:
+        for user_hit in user_hits:
             key = (user_hit.name, user_hit.username)
-            users[key] = {}
-
-            # Get last updated
-            try:
-                r = (
-                    Search(index="flock-*")
-                    .query("match", hostIdentifier=user_hit.username)
-                    .sort("-@timestamp")[0:1]
-                    .execute()
-                )
-
-                if len(r) > 0:
-                    hit = r[0]
-                    users[key]["last_updated"] = hit.calendarTime
-            except RequestError:
-                # Ignoring this exception, because it will get triggered if an index it's searching doesn't
-                # have a mapping for @timestamp, which happens in the tests. And there doesn't seem to be
-                # a way to use elasticsearch_dsl to call `.sort` with `ignore_unmapped`...
-                # RequestError(400, 'search_phase_execution_exception', 'No mapping found for [@timestamp] in order to sort on')
-                pass
-
-            # Get OS version
-            try:
-                r = (
-                    Search(index="flock-*")
-                    .query("match", hostIdentifier=user_hit.username)
-                    .query("match", name="os_version")
-                    .sort("-@timestamp")[0:1]
-                    .execute()
-                )
-                if len(r) > 0:
-                    hit = r[0]
-                    users[key][
-                        "os_version"
-                    ] = f"{hit.columns.name} {hit.columns.version}"
-            except RequestError:
-                pass
+            users[key] = format_host_state(host_states.get(user_hit.username, {}))
 
         # Display response output, sorted by name
         response_str = ""
@@ -264,8 +310,8 @@ class Handler:
             return
 
         # Delete the user
-        user.delete()
-        Index("user").refresh()
+        self.storage.delete_user(username)
+        identity_cache.invalidate(username)
         await self._send(
             bot,
             event,
@@ -283,9 +329,8 @@ class Handler:
             return
 
         # Rename the user
-        user.update(name=name)
-        user.save()
-        Index("user").refresh()
+        self.storage.rename_user(username, name)
+        identity_cache.invalidate(username)
 
         await self._send(
             bot,
@@ -360,25 +405,235 @@ class Handler:
                 )
 
 
-async def notification_checker(conv_id, bot):
-    keybase_notifications = KeybaseNotifications()
-    while True:
-        await asyncio.sleep(30)
+# Notifications packed into one chat message are separated by a blank line
+MESSAGE_SEPARATOR = "\n\n"
+
+# Ends a notification that's cut short to fit in a chat message
+TRUNCATED = "\n...(truncated)"
+
+
+def truncate_message(message, max_bytes):
+    # Cut a message short to at most max_bytes, closing a code block it leaves
+    # open and without splitting a character
+    encoded = message.encode()
+    if len(encoded) <= max_bytes:
+        return message
+    suffix_bytes = len(TRUNCATED.encode()) + len("\n```")
+    message = encoded[: max(max_bytes - suffix_bytes, 0)].decode(errors="ignore")
+    if message.count("```") % 2:
+        message += "\n```"
+    return message + TRUNCATED
+
+
+def pack_messages(notifications, max_bytes):
+    # Join (keybase_notifications, formatted) tuples, where several notifications
+    # can be formatted as one summary, into as few chat messages as possible, in
+    # order, each at most max_bytes long. A notification that's longer on its own
+    # is truncated. Returns a list of (message, keybase_notifications) tuples.
+    messages = []
+    parts = []
+    packed = []
+    size = 0
+    for keybase_notifications, formatted in notifications:
+        formatted = truncate_message(formatted, max_bytes)
+        formatted_size = len(formatted.encode())
+        if parts and size + len(MESSAGE_SEPARATOR) + formatted_size > max_bytes:
+            messages.append((MESSAGE_SEPARATOR.join(parts), packed))
+            parts = []
+            packed = []
+            size = 0
+        if parts:
+            size += len(MESSAGE_SEPARATOR)
+        parts.append(formatted)
+        packed.extend(keybase_notifications)
+        size += formatted_size
+    if parts:
+        messages.append((MESSAGE_SEPARATOR.join(parts), packed))
+    return messages
+
+
+async def send_with_retries(
+    conv_id, bot, message, retries=5, retry_delay=1, max_retry_delay=60, sender=None
+):
+    # Send a chat message, retrying with exponential backoff. Returns True once
+    # Keybase acknowledges it, or False if every attempt failed.
+    if sender is None:
+        sender = ChatSender()
+    for attempt in range(retries + 1):
+        try:
+            await sender.send(bot, conv_id, message)
+            return True
+        except Exception as e:
+            if attempt == retries:
+                print(f"Failed to send notifications, giving up: {e!r}")
+                return False
+            delay = min(retry_delay * 2 ** attempt, max_retry_delay)
+            print(f"Failed to send notifications, retrying in {delay}s: {e!r}")
+            notification_send_retries.inc()
+            await asyncio.sleep(delay)
+
+
+async def deliver_notifications(
+    conv_id,
+    bot,
+    keybase_notifications,
+    page_size=100,
+    max_per_cycle=1000,
+    max_message_bytes=8000,
+    retries=5,
+    retry_delay=1,
+    max_attempts=3,
+    defer_delay=300,
+    max_defer_delay=3600,
+    sender=None,
+):
+    # Deliver undelivered notifications, oldest first, a page at a time. osquery
+    # notifications go through the notification window, which holds them until it
+    # closes and merges each host's into a summary. Each page is packed into chat
+    # messages of up to max_message_bytes, which are sent in order and retried,
+    # and notifications are marked delivered once Keybase acknowledges their
+    # message. Returns True if there are more notifications left to deliver, and
+    # False when they've all been delivered or sending failed, so the next cycle
+    # waits.
+    #
+    # A message that fails stops the cycle, so the next one sends it before
+    # anything newer. Each notification counts the cycles it failed in, and once
+    # it has failed max_attempts times, it's set aside until defer_delay seconds
+    # later, doubling each time it fails again, so it doesn't hold up the ones
+    # after it. It stays undelivered until Keybase accepts it.
+    storage = keybase_notifications.storage
+    if sender is None:
+        sender = ChatSender()
+
+    seen_count = 0
+    failed = False
+    after = None
+    closes_at = None
+    while not failed and seen_count < max_per_cycle:
+        results = storage.undelivered_notifications(
+            min(page_size, max_per_cycle - seen_count), after=after
+        )
+        seen_count += len(results)
+
+        # Skip the notifications that were set aside until later
+        now = datetime.now()
+        due = [
+            keybase_notification
+            for keybase_notification in results
+            if not keybase_notification.next_attempt_at
+            or keybase_notification.next_attempt_at <= now
+        ]
+
+        groups, page_closes_at = keybase_notifications.window.group(due)
+        if page_closes_at and (closes_at is None or page_closes_at < closes_at):
+            closes_at = page_closes_at
+
+        # Notifications that failed to send before get messages of their own, so
+        # setting one aside doesn't hold up the ones it was packed with
+        messages = []
+        for retried, formatted in itertools.groupby(
+            [
+                (packed, keybase_notifications.format(notification, details))
+                for notification, details, packed in groups
+            ],
+            key=lambda formatted: any(
+                keybase_notification.attempts
+                for keybase_notification in formatted[0]
+            ),
+        ):
+            if retried:
+                for notification in formatted:
+                    messages.extend(pack_messages([notification], max_message_bytes))
+            else:
+                messages.extend(pack_messages(list(formatted), max_message_bytes))
 
-        results = KeybaseNotification.search().query("match", delivered=False).execute()
-        for keybase_notification in results:
-            msg = keybase_notifications.format(
-                keybase_notification.notification_type, keybase_notification.details
+        # Only mark notifications delivered once their message was sent
+        delivered = []
+        for message, packed in messages:
+            if await send_with_retries(
+                conv_id,
+                bot,
+                message,
+                retries=retries,
+                retry_delay=retry_delay,
+                sender=sender,
+            ):
+                notification_messages_sent.inc()
+                delivered.extend(packed)
+                continue
+
+            deferred = False
+            for keybase_notification in packed:
+                attempts = (keybase_notification.attempts or 0) + 1
+                keybase_notification.attempts = attempts
+                if attempts >= max_attempts:
+                    delay = min(
+                        defer_delay * 2 ** (attempts - max_attempts), max_defer_delay
+                    )
+                    keybase_notification.next_attempt_at = now + timedelta(
+                        seconds=delay
+                    )
+                    deferred = True
+            storage.record_attempts(packed)
+            if not deferred:
+                failed = True
+                break
+            print(
+                f"Failed to send {len(packed)} notifications {max_attempts} or more "
+                "times, trying them again later"
             )
-            print("Sending notification: {}".format(repr(msg)))
-            try:
-                await bot.chat.send(conv_id, msg)
-            except asyncio.exceptions.TimeoutError:
-                pass
+            notifications_deferred.inc(len(packed))
+
+        if delivered:
+            storage.mark_delivered(delivered)
+        notifications_delivered.inc(len(delivered))
+        now = datetime.now()
+        for keybase_notification in delivered:
+            if keybase_notification.created_at:
+                notification_delivery_lag.observe(
+                    (now - keybase_notification.created_at).total_seconds()
+                )
 
-            keybase_notification.update(delivered=True)
-            keybase_notification.save()
-        Index("keybase_notification").refresh()
+        if len(results) < page_size:
+            break
+        after = results[-1]
+
+    # Count what's left, and remember when the next held notifications are due
+    notification_backlog.set(storage.count_undelivered())
+    keybase_notifications.window.closes_at = closes_at
+
+    return not failed and seen_count >= max_per_cycle
+
+
+async def notification_checker(conv_id, bot, storage=None, bus=None, sender=None):
+    # Deliver notifications as soon as the gateway says there are new ones, when
+    # held osquery notifications are due, and every poll_interval seconds in case a
+    # wake-up was missed
+    keybase_notifications = KeybaseNotifications(storage=storage, bus=bus)
+    await keybase_notifications.bus.start()
+    poll_interval = float(os.environ.get("FLOCK_NOTIFICATION_POLL_INTERVAL", 30))
+    options = dict(
+        max_message_bytes=int(os.environ.get("FLOCK_NOTIFICATION_MESSAGE_BYTES", 8000)),
+        retries=int(os.environ.get("FLOCK_NOTIFICATION_SEND_RETRIES", 5)),
+        max_attempts=int(os.environ.get("FLOCK_NOTIFICATION_SEND_ATTEMPTS", 3)),
+        defer_delay=float(os.environ.get("FLOCK_NOTIFICATION_DEFER_DELAY", 300)),
+        sender=sender or ChatSender(),
+    )
+    backlog = False
+    while True:
+        # Keep going without waiting while there's a backlog
+        if not backlog:
+            timeout = poll_interval
+            closes_at = keybase_notifications.window.closes_at
+            if closes_at is not None:
+                timeout = min(
+                    timeout, max((closes_at - datetime.now()).total_seconds(), 0)
+                )
+            if await keybase_notifications.bus.wait(timeout):
+                keybase_notifications.storage.refresh_notifications()
+        backlog = await deliver_notifications(
+            conv_id, bot, keybase_notifications, **options
+        )
 
 
 async def welcome_message(conv_id, bot):
@@ -400,10 +655,10 @@ async def welcome_message(conv_id, bot):
     )
 
 
-async def start(bot, conv_id):
+async def start(bot, conv_id, storage, sender=None):
     await asyncio.gather(
         bot.start({"convs": True}),
-        notification_checker(conv_id, bot),
+        notification_checker(conv_id, bot, storage, sender=sender),
         welcome_message(conv_id, bot),
     )
 
@@ -426,19 +681,27 @@ def start_keybase_bot():
     if not validated:
         return
 
+    # Serve metrics
+    metrics_port = int(os.environ.get("FLOCK_BOT_METRICS_PORT", 9100))
+    if metrics_port:
+        start_http_server(metrics_port)
+
     # Run keybase service
     subprocess.call(["run_keybase", "-g"])
 
-    # Create the bot
+    # Create the bot, sharing storage and how many messages it sends at once with
+    # the notification checker
+    storage = create_storage()
+    sender = ChatSender()
     bot = pykeybasebot.Bot(
         username=os.environ.get("KEYBASE_USERNAME"),
         paperkey=os.environ.get("KEYBASE_PAPERKEY"),
-        handler=Handler(),
+        handler=Handler(storage, sender),
     )
     conv_id = os.environ.get("KEYBASE_CONV_ID")
 
     # Start the bot
-    asyncio.run(start(bot, conv_id))
+    asyncio.run(start(bot, conv_id, storage, sender))
 
 
 if __name__ == "__main__":
@@ -1,12 +1,151 @@
+import os
 import json
-from datetime import datetime
-from elasticsearch_dsl import Index, Search
+import time
+import threading
+from datetime import datetime, timedelta
 
-from .elasticsearch import es, User, Setting, KeybaseNotification
+from elasticsearch.exceptions import TransportError
+from prometheus_client import Counter
+
+from .elasticsearch import KeybaseNotification, is_unavailable_error
+from .storage import create_storage
+from .notification_bus import create_notification_bus
+
+
+windowed_notifications = Counter(
+    "flock_windowed_notifications_total",
+    "osquery notifications held in the notification window, by whether they were "
+    "delivered on their own or merged into a summary",
+    ["result"],
+)
+
+
+def _summary_counts(details):
+    # The added, removed and other counts of an osquery notification, which is
+    # either a single doc or a summary of several
+    if details.get("type") == "summary":
+        return (
+            details["added_count"],
+            details["removed_count"],
+            details["other_count"],
+        )
+    action = details.get("action")
+    return (
+        int(action == "added"),
+        int(action == "removed"),
+        int(action not in ["added", "removed"]),
+    )
+
+
+class NotificationWindow:
+    """
+    Holds undelivered osquery notifications until window seconds after the first
+    one from each host of each type was created, and then merges them into a
+    single summary, so a host that sends several small batches triggers one
+    message. The bot applies it to what's in storage as it delivers notifications,
+    so it covers every gateway process, and held notifications are just ones that
+    haven't been delivered yet.
+    """
+
+    def __init__(self, window, notification_names):
+        self.window = window
+        self.notification_names = frozenset(notification_names)
+
+        # When the first window that was still open after the last delivery closes
+        self.closes_at = None
+
+    def group(self, keybase_notifications, now=None):
+        # Group a page of undelivered KeybaseNotifications, oldest first, into
+        # (notification_type, details, keybase_notifications) tuples to deliver in
+        # order, leaving out the ones whose window hasn't closed yet. Returns the
+        # groups, and when the first window that's still open closes, or None.
+        if now is None:
+            now = datetime.now()
+        window = timedelta(seconds=self.window)
+
+        groups = []
+        windows = {}
+        closes_at = None
+        for keybase_notification in keybase_notifications:
+            notification = keybase_notification.notification_type
+            if not self.window or notification not in self.notification_names:
+                groups.append(
+                    (notification, keybase_notification.details, [keybase_notification])
+                )
+                continue
+
+            details = json.loads(keybase_notification.details)
+            if details.get("type") == "summary":
+                key = (details["username"], notification)
+                name = details["name"]
+            else:
+                key = (details.get("hostIdentifier"), notification)
+                name = details.get("user_name")
+            pending = windows.get(key)
+            if pending is None:
+                # Notifications without a created_at can't be held
+                opened_at = keybase_notification.created_at or now
+                pending = windows[key] = {
+                    "key": key,
+                    "closes_at": opened_at + window,
+                    "name": name,
+                    "counts": [0, 0, 0],
+                    "keybase_notifications": [],
+                }
+                if pending["closes_at"] <= now:
+                    groups.append(pending)
+                elif closes_at is None or pending["closes_at"] < closes_at:
+                    closes_at = pending["closes_at"]
+            for i, count in enumerate(_summary_counts(details)):
+                pending["counts"][i] += count
+            pending["keybase_notifications"].append(keybase_notification)
+
+        for i, pending in enumerate(groups):
+            if not isinstance(pending, dict):
+                continue
+            packed = pending["keybase_notifications"]
+            username, notification = pending["key"]
+            if len(packed) == 1:
+                windowed_notifications.labels(result="single").inc()
+                groups[i] = (notification, packed[0].details, packed)
+                continue
+            windowed_notifications.labels(result="merged").inc(len(packed))
+            added_count, removed_count, other_count = pending["counts"]
+            details = {
+                "type": "summary",
+                "username": username,
+                "name": pending["name"],
+                "added_count": added_count,
+                "removed_count": removed_count,
+                "other_count": other_count,
+            }
+            groups[i] = (notification, json.dumps(details, indent=2), packed)
+        return groups, closes_at
 
 
 class KeybaseNotifications:
-    def __init__(self):
+    def __init__(
+        self,
+        settings_ttl=None,
+        storage=None,
+        window=None,
+        window_bypass=None,
+        bus=None,
+        spool=None,
+    ):
+        if storage is None:
+            storage = create_storage()
+        self.storage = storage
+
+        # With a spool, notifications are spooled along with osquery docs while
+        # ElasticSearch is unavailable, instead of failing
+        self.spool = spool
+
+        # Wakes up the bot when notifications are saved
+        if bus is None:
+            bus = create_notification_bus()
+        self.bus = bus
+
         self.notifications = {
             # User registration
             "user_registered": {
@@ -58,35 +197,60 @@ class KeybaseNotifications:
         }
         self.warnings = ["reverse_shell"]
 
+        # Cache the settings, so adding notifications doesn't search the setting index
+        # every time. Changes made by other processes take effect within settings_ttl
+        # seconds.
+        if settings_ttl is None:
+            settings_ttl = float(os.environ.get("FLOCK_SETTINGS_CACHE_TTL", 10))
+        self.settings_ttl = settings_ttl
+        self._cached_settings = None
+        self._cached_settings_expire = 0
+        self._cached_settings_lock = threading.Lock()
+
+        # osquery notifications from each host are held by the bot for window
+        # seconds, and merged with the ones of the same type that arrive in the
+        # meantime. The notifications in window_bypass, warnings by default, are
+        # never held.
+        if window is None:
+            window = float(os.environ.get("FLOCK_NOTIFICATION_WINDOW", 0))
+        if window_bypass is None:
+            window_bypass = os.environ.get("FLOCK_NOTIFICATION_WINDOW_BYPASS")
+            window_bypass = window_bypass.split(",") if window_bypass else self.warnings
+        self.window = NotificationWindow(
+            window,
+            [
+                key
+                for key, notification in self.notifications.items()
+                if notification["type"] == "osquery" and key not in window_bypass
+            ],
+        )
+
     def _get_default_settings(self):
         default_settings = {}
         for notification in self.notifications:
             default_settings[notification] = True
         return default_settings
 
-    def _get_setting(self):
+    def _get_setting(self, refresh=True):
         # We must refresh the index before loading the settings for tests to pass -- this shouldn't be
         # necessary because _save_settings() refreshes it, but since the setting index is so small it
-        # doesn't hurt
-        Index("setting").refresh()
-
-        results = Setting.search().query("match", key="keybase_notifications").execute()
-        if len(results) == 0:
+        # doesn't hurt. The exception is the ingest path, which uses the cache instead.
+        value = self.storage.get_setting("keybase_notifications", refresh)
+        if value is None:
             # There are no keybase settings, so default everything to on
-            default_settings = self._get_default_settings()
-            setting = Setting(
-                key="keybase_notifications", value=json.dumps(default_settings)
-            )
-            setting.save()
-            return setting
+            value = json.dumps(self._get_default_settings())
+            self.storage.save_setting("keybase_notifications", value)
+        return value
 
-        setting = results[0]
-        return setting
+    def _load_settings(self, refresh=True):
+        notification_settings = self._load_settings_without_caching(refresh)
+        self._cache_settings(notification_settings)
+        return notification_settings
 
-    def _load_settings(self):
-        setting = self._get_setting()
+    def _load_settings_without_caching(self, refresh):
+        value = self._get_setting(refresh)
         try:
-            notification_settings = json.loads(setting.value)
+            notification_settings = json.loads(value)
 
             # Make sure they have all of the right notifications
             update = False
@@ -102,32 +266,58 @@ class KeybaseNotifications:
             for notification in to_del:
                 del notification_settings[notification]
             if update:
-                setting.update(value=json.dumps(notification_settings))
-                setting.save()
+                self.storage.save_setting(
+                    "keybase_notifications", json.dumps(notification_settings)
+                )
 
             return notification_settings
         except:
             # Failed json decoding, so update the settings to the defaults
             default_settings = self._get_default_settings()
-            setting.update(value=json.dumps(default_settings))
-            setting.save()
+            self.storage.save_setting(
+                "keybase_notifications", json.dumps(default_settings)
+            )
             return default_settings
 
     def _save_settings(self, notification_settings):
-        setting = self._get_setting()
-        setting.update(value=json.dumps(notification_settings))
-        setting.save()
-        Index("setting").refresh()
+        self.storage.save_setting(
+            "keybase_notifications", json.dumps(notification_settings), refresh=True
+        )
+        self._cache_settings(notification_settings)
+
+    def _cache_settings(self, notification_settings):
+        with self._cached_settings_lock:
+            self._cached_settings = dict(notification_settings)
+            self._cached_settings_expire = time.monotonic() + self.settings_ttl
+
+    def _get_cached_settings(self):
+        with self._cached_settings_lock:
+            if (
+                self._cached_settings is not None
+                and time.monotonic() < self._cached_settings_expire
+            ):
+                return self._cached_settings
+        return self._load_settings(refresh=False)
 
-    def _is_enabled(self, notification):
+    def fallback_settings(self):
+        # The settings to use when they can't be loaded: the last ones that were,
+        # however old, or the defaults
+        with self._cached_settings_lock:
+            if self._cached_settings is not None:
+                return self._cached_settings
+        return self._get_default_settings()
+
+    def _is_enabled(self, notification, notification_settings=None):
         if notification not in self.notifications:
             return False
 
-        notification_settings = self._load_settings()
+        if notification_settings is None:
+            notification_settings = self._get_cached_settings()
         if notification in notification_settings:
             return notification_settings[notification]
         else:
             # This notification is not in the settings, set it to true
+            notification_settings = dict(notification_settings)
             notification_settings[notification] = True
             self._save_settings(notification_settings)
             return True
@@ -150,16 +340,55 @@ class KeybaseNotifications:
                 self._save_settings(notification_settings)
 
     def add(self, notification, details):
-        details_obj = json.dumps(details, indent=2)
-        if self._is_enabled(notification):
-            # Create a new keybase notification
-            keybase_notification = KeybaseNotification(
-                notification_type=notification,
-                details=details_obj,
-                delivered=False,
-                created_at=datetime.now(),
+        self.add_many([(notification, details)])
+
+    def add_many(self, notifications):
+        # Add a list of (notification, details) tuples, checking which are enabled
+        # once and saving them all in a single bulk request
+        try:
+            keybase_notifications = self.new_notifications(notifications)
+            if keybase_notifications:
+                self.storage.add_notifications(keybase_notifications)
+                self.bus.publish()
+        except TransportError as e:
+            if self.spool is None or not is_unavailable_error(e):
+                raise
+            self.spool.append(
+                self.notification_actions(notifications, self.fallback_settings())
+            )
+
+    def new_notifications(self, notifications, notification_settings=None):
+        # KeybaseNotification documents for a list of (notification, details) tuples,
+        # skipping the ones that are disabled
+        if not notifications:
+            return []
+
+        if notification_settings is None:
+            notification_settings = self._get_cached_settings()
+        created_at = datetime.now()
+        keybase_notifications = []
+        for notification, details in notifications:
+            if self._is_enabled(notification, notification_settings):
+                # Create a new keybase notification
+                keybase_notifications.append(
+                    KeybaseNotification(
+                        notification_type=notification,
+                        details=json.dumps(details, indent=2),
+                        delivered=False,
+                        created_at=created_at,
+                    )
+                )
+        return keybase_notifications
+
+    def notification_actions(self, notifications, notification_settings=None):
+        # The bulk actions to save a list of (notification, details) tuples in
+        # ElasticSearch, skipping the ones that are disabled
+        return [
+            keybase_notification.to_dict(include_meta=True)
+            for keybase_notification in self.new_notifications(
+                notifications, notification_settings
             )
-            keybase_notification.save()
+        ]
 
     def format(self, notification, details):
         details_obj = json.loads(details)
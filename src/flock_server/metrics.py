@@ -0,0 +1,40 @@
+import os
+import glob
+
+from prometheus_client import REGISTRY, CollectorRegistry, generate_latest, multiprocess
+from prometheus_client import start_http_server as _start_http_server
+
+
+def multiprocess_dir():
+    # Under gunicorn, every process keeps its metrics in files in this directory,
+    # through prometheus_client's multiprocess mode. It has to be set before
+    # prometheus_client is imported.
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+
+def collector_registry():
+    # The metrics to serve: those of every process sharing the multiprocess
+    # directory, if there is one, or else this process's
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def clear_multiprocess_dir():
+    # Forget the metrics of an earlier server
+    for filename in glob.glob(os.path.join(multiprocess_dir(), "*.db")):
+        os.remove(filename)
+
+
+def render(registry=None):
+    return generate_latest(registry or collector_registry()).decode()
+
+
+def start_http_server(port, host="0.0.0.0", registry=None):
+    # Serve /metrics from a background thread, on a port of its own
+    server, _ = _start_http_server(
+        port, addr=host, registry=registry or collector_registry()
+    )
+    return server
@@ -0,0 +1,168 @@
+"""
+Migrate the user, user_change, setting and keybase_notification indices to their
+current mappings, without downtime:
+
+    pipenv run python -m flock_server.migrate
+
+Each index is reindexed into a new versioned index (like user-20200420120000),
+and the old name becomes an alias to it. Documents keep their versions when
+they're copied, so catch-up copies only overwrite documents that were created or
+updated in the old index since they were last copied, and documents that were
+deleted from the old index are deleted from the new one. The old index accepts
+writes throughout: catch-up copies repeat until there's nothing left to copy,
+the alias is atomically swapped over, and a last catch-up copies whatever was
+written to the old index before the swap.
+
+The only exception is an index that isn't an alias yet, like the user index of a
+deployment that was never migrated. Its name can only become an alias by deleting
+it, so it's briefly made read-only for the last catch-up and the swap.
+
+The gateway and bot can keep running throughout, and because match queries still
+work on keyword fields, the old code keeps working after the migration too. Run
+the migration before deploying code that depends on the new mappings.
+"""
+from datetime import datetime
+
+from elasticsearch.helpers import scan
+
+from .elasticsearch import es, User, UserChange, Setting, KeybaseNotification
+
+
+# Catch-up copies to make before swapping the alias, if documents keep changing
+MAX_CATCH_UP_PASSES = 5
+
+
+def _field_types(mapping):
+    return {
+        field: properties.get("type", "object")
+        for field, properties in mapping.get("properties", {}).items()
+    }
+
+
+def needs_migration(document_cls, index_name):
+    mapping = es.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    current = _field_types(mapping)
+    wanted = _field_types(document_cls._doc_type.mapping.to_dict())
+    for field, field_type in wanted.items():
+        if field in current and current[field] != field_type:
+            return True
+    return False
+
+
+def _ids(index_name):
+    return {
+        hit["_id"] for hit in scan(es, index=index_name, query={"_source": False})
+    }
+
+
+def _copy(old_index, new_index):
+    # Copy documents that are new or newer than their copies, keeping their
+    # versions. Returns the number of documents created and updated.
+    r = es.reindex(
+        body={
+            "conflicts": "proceed",
+            "source": {"index": old_index},
+            "dest": {"index": new_index, "version_type": "external"},
+        },
+        refresh=True,
+        wait_for_completion=True,
+    )
+    return r["created"] + r["updated"]
+
+
+def _delete(new_index, ids):
+    for doc_id in ids:
+        es.delete(index=new_index, id=doc_id, ignore=404)
+    if ids:
+        es.indices.refresh(index=new_index)
+    return len(ids)
+
+
+def _catch_up(old_index, new_index):
+    # Copy what changed in the old index, and delete what was deleted from it.
+    # Nothing writes to the new index before the alias is swapped, so anything in
+    # it that isn't in the old index was deleted. Returns the number of changes,
+    # and the ids in the old index.
+    changed_count = _copy(old_index, new_index)
+    old_ids = _ids(old_index)
+    changed_count += _delete(new_index, _ids(new_index) - old_ids)
+    return changed_count, old_ids
+
+
+def _swap(alias, old_index, new_index):
+    # Point the alias at the new index
+    if old_index == alias:
+        actions = [
+            {"remove_index": {"index": old_index}},
+            {"add": {"index": new_index, "alias": alias}},
+        ]
+    else:
+        actions = [
+            {"remove": {"index": old_index, "alias": alias}},
+            {"add": {"index": new_index, "alias": alias}},
+        ]
+    es.indices.update_aliases(body={"actions": actions})
+
+
+def migrate(document_cls, log=print):
+    alias = document_cls._index._name
+
+    # Find the index that currently holds the documents
+    if es.indices.exists_alias(name=alias):
+        old_index = list(es.indices.get_alias(name=alias).keys())[0]
+    elif es.indices.exists(index=alias):
+        old_index = alias
+    else:
+        log(f"{alias}: does not exist, creating it")
+        document_cls.init()
+        return
+
+    if not needs_migration(document_cls, old_index):
+        log(f"{alias}: mappings are up to date")
+        return
+
+    new_index = "{}-{}".format(alias, datetime.now().strftime("%Y%m%d%H%M%S"))
+    log(f"{alias}: migrating {old_index} to {new_index}")
+    document_cls._index.clone(name=new_index).create()
+
+    # Copy everything while the old index is still accepting writes, and then
+    # whatever changed in the meantime, until nothing does
+    log(f"{alias}: copied {_copy(old_index, new_index)} documents")
+    for _ in range(MAX_CATCH_UP_PASSES):
+        changed_count, old_ids = _catch_up(old_index, new_index)
+        log(f"{alias}: caught up {changed_count} changes")
+        if changed_count == 0:
+            break
+
+    if old_index == alias:
+        # Swapping deletes the old index, so stop writes to it for the last
+        # catch-up
+        es.indices.put_settings(index=old_index, body={"index.blocks.write": True})
+        try:
+            changed_count, _ = _catch_up(old_index, new_index)
+            log(f"{alias}: caught up {changed_count} changes")
+            _swap(alias, old_index, new_index)
+        except Exception:
+            es.indices.put_settings(
+                index=old_index, body={"index.blocks.write": False}
+            )
+            raise
+    else:
+        # Writes go to the new index from here on, so only copy and delete what
+        # changed in the old index before the swap
+        _swap(alias, old_index, new_index)
+        changed_count = _copy(old_index, new_index)
+        changed_count += _delete(new_index, old_ids - _ids(old_index))
+        log(f"{alias}: caught up {changed_count} changes")
+        es.indices.delete(index=old_index)
+
+    log(f"{alias}: now points to {new_index}")
+
+
+def main():
+    for document_cls in [User, UserChange, Setting, KeybaseNotification]:
+        migrate(document_cls)
+
+
+if __name__ == "__main__":
+    main()
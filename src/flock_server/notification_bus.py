@@ -0,0 +1,187 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+from urllib.parse import urlparse
+
+from prometheus_client import Counter
+
+
+wake_ups = Counter(
+    "flock_notification_wake_ups_total",
+    "Wake-ups sent to the Keybase bot when notifications are saved, and received",
+    ["direction"],
+)
+
+
+class NotificationBus:
+    """
+    Tells the Keybase bot right away when the gateway saves notifications, so it
+    doesn't have to wait for its next poll. Notifications are always saved to
+    storage first, and the bot keeps polling, so a lost wake-up only delays
+    delivery until the next poll. This one does nothing, so the bot only polls.
+    """
+
+    def publish(self):
+        # Called by the gateway after it saves notifications
+        pass
+
+    async def start(self):
+        # Called by the bot before it waits for wake-ups
+        pass
+
+    async def wait(self, timeout):
+        # Wait until notifications are published, or timeout seconds pass. Returns
+        # True if the bot was woken up.
+        await asyncio.sleep(timeout)
+        return False
+
+
+class LocalBus(NotificationBus):
+    """
+    Wakes up a bot in the same process, like in tests, or with memory storage
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._event = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def publish(self):
+        # The gateway publishes from its own threads
+        if self._loop is not None:
+            wake_ups.labels(direction="sent").inc()
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        wake_ups.labels(direction="received").inc()
+        self._event.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            woken = True
+        except asyncio.TimeoutError:
+            woken = False
+        self._event.clear()
+        return woken
+
+
+class _WakeUpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, wake):
+        self.wake = wake
+
+    def datagram_received(self, data, addr):
+        self.wake()
+
+
+class SocketBus(LocalBus):
+    """
+    Sends wake-ups from the gateway to the bot as datagrams, over UDP to
+    (host, port), or over a Unix socket at path. Sending never blocks the gateway,
+    and a datagram that's lost because the bot is down or busy is harmless. The bot
+    listens on the port on every interface, or at the path.
+
+    The bot's hostname is looked up again every resolve_interval seconds, since
+    sending to an address the bot no longer has, like after its container is
+    recreated, doesn't fail. The lookup blocks, so call publish() from a thread,
+    not an event loop.
+    """
+
+    def __init__(self, family, address, resolve_interval=None):
+        super().__init__()
+        self.family = family
+        self.address = address
+        if resolve_interval is None:
+            resolve_interval = float(
+                os.environ.get("FLOCK_NOTIFICATION_BUS_RESOLVE_INTERVAL", 5)
+            )
+        self.resolve_interval = resolve_interval
+        self._socket = None
+        self._socket_address = None
+        self._resolve_at = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        if self.family == socket.AF_UNIX:
+            self._socket_address = self.address
+        else:
+            self._resolve()
+
+    def _resolve(self):
+        # Look up the bot's hostname every resolve_interval seconds, rather than
+        # for every wake-up
+        host, port = self.address
+        addresses = socket.getaddrinfo(host, port, self.family, socket.SOCK_DGRAM)
+        self._socket_address = addresses[0][4]
+        self._resolve_at = time.monotonic() + self.resolve_interval
+
+    def publish(self):
+        # Each process opens its own socket, since they don't survive a fork. The
+        # gateway publishes from several threads, so only one opens the socket or
+        # looks up the bot's address at a time.
+        try:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+                    self._pid = os.getpid()
+                elif (
+                    self.family != socket.AF_UNIX
+                    and time.monotonic() >= self._resolve_at
+                ):
+                    self._resolve()
+                sock, address = self._socket, self._socket_address
+            sock.sendto(b"notify", address)
+            wake_ups.labels(direction="sent").inc()
+        except OSError:
+            # The bot will find the notifications when it polls. Open the socket
+            # again next time, in case the bot moved.
+            self._pid = None
+
+    async def start(self):
+        await super().start()
+        if self.family == socket.AF_UNIX:
+            # Remove the socket a previous bot left behind
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+            local_addr = self.address
+        else:
+            local_addr = ("0.0.0.0", self.address[1])
+        await self._loop.create_datagram_endpoint(
+            lambda: _WakeUpProtocol(self._wake),
+            local_addr=local_addr,
+            family=self.family,
+        )
+
+
+# Shared by everything in this process that uses the "local" bus
+local_bus = LocalBus()
+
+
+def create_notification_bus(url=None):
+    # Create the bus that FLOCK_NOTIFICATION_BUS describes: empty for none,
+    # "local", "udp://host:port", or "unix:///path/to/socket"
+    if url is None:
+        url = os.environ.get("FLOCK_NOTIFICATION_BUS", "")
+    if not url:
+        return NotificationBus()
+    if url == "local":
+        return local_bus
+
+    parsed = urlparse(url)
+    if parsed.scheme == "udp":
+        return SocketBus(socket.AF_INET, (parsed.hostname, parsed.port))
+    if parsed.scheme == "unix":
+        return SocketBus(socket.AF_UNIX, parsed.path)
+    raise ValueError(f"Unknown notification bus: {url}")
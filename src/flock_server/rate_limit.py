@@ -0,0 +1,132 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+
+throttled_requests = Counter(
+    "flock_throttled_requests_total",
+    "Requests rejected by the rate limiter, by which limit they hit",
+    ["limit"],
+)
+
+
+class _Limits:
+    __slots__ = (
+        "requests_per_second",
+        "requests_burst",
+        "docs_per_second",
+        "docs_burst",
+    )
+
+    def __init__(
+        self,
+        requests_per_second=0,
+        requests_burst=None,
+        docs_per_second=0,
+        docs_burst=None,
+    ):
+        # A rate of 0 means unlimited. Bursts default to a minute's worth.
+        self.requests_per_second = requests_per_second
+        self.requests_burst = requests_burst or max(requests_per_second * 60, 1)
+        self.docs_per_second = docs_per_second
+        self.docs_burst = docs_burst or max(docs_per_second * 60, 1)
+
+
+class _Buckets:
+    __slots__ = ("requests", "docs", "updated")
+
+    def __init__(self, limits, now):
+        self.requests = limits.requests_burst
+        self.docs = limits.docs_burst
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    Token buckets for each username, limiting how many requests and how many
+    documents each host can submit. A request is admitted while the host has a
+    request token and isn't in debt for documents. Its documents are counted once
+    they're processed, which can put the host in debt, so a large batch is never
+    cut off halfway through.
+    """
+
+    def __init__(self, overrides=None, max_hosts=100000, **limits):
+        # overrides maps usernames to their own limits
+        self.default_limits = _Limits(**limits)
+        self.overrides = {
+            username: _Limits(**host_limits)
+            for username, host_limits in (overrides or {}).items()
+        }
+        self.max_hosts = max_hosts
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_buckets(self, username, limits, now):
+        # Refill the host's buckets for the time since they were last used. Hosts
+        # that haven't been seen in a while are forgotten, which fills their buckets.
+        buckets = self._buckets.get(username)
+        if buckets is None:
+            buckets = _Buckets(limits, now)
+            self._buckets[username] = buckets
+            while len(self._buckets) > self.max_hosts:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(username)
+            elapsed = now - buckets.updated
+            buckets.requests = min(
+                limits.requests_burst,
+                buckets.requests + elapsed * limits.requests_per_second,
+            )
+            buckets.docs = min(
+                limits.docs_burst, buckets.docs + elapsed * limits.docs_per_second
+            )
+            buckets.updated = now
+        return buckets
+
+    def admit(self, username):
+        # Take a request token, returning 0 if the request is admitted, or else how
+        # many seconds to wait before trying again
+        limits = self.overrides.get(username, self.default_limits)
+        if not limits.requests_per_second and not limits.docs_per_second:
+            return 0
+
+        with self._lock:
+            buckets = self._get_buckets(username, limits, time.monotonic())
+
+            if limits.docs_per_second and buckets.docs < 0:
+                throttled_requests.labels(limit="docs").inc()
+                return math.ceil(-buckets.docs / limits.docs_per_second)
+
+            if limits.requests_per_second:
+                if buckets.requests < 1:
+                    throttled_requests.labels(limit="requests").inc()
+                    return math.ceil(
+                        (1 - buckets.requests) / limits.requests_per_second
+                    )
+                buckets.requests -= 1
+        return 0
+
+    def consume_docs(self, username, count):
+        # Count documents from an admitted request
+        limits = self.overrides.get(username, self.default_limits)
+        if not limits.docs_per_second or not count:
+            return
+
+        with self._lock:
+            buckets = self._get_buckets(username, limits, time.monotonic())
+            buckets.docs -= count
+
+
+def create_rate_limiter(config):
+    # Create a RateLimiter from the RATE_LIMIT_* app config
+    return RateLimiter(
+        requests_per_second=config["RATE_LIMIT_REQUESTS"],
+        requests_burst=config["RATE_LIMIT_REQUESTS_BURST"],
+        docs_per_second=config["RATE_LIMIT_DOCS"],
+        docs_burst=config["RATE_LIMIT_DOCS_BURST"],
+        overrides=config["RATE_LIMIT_HOSTS"],
+        max_hosts=config["RATE_LIMIT_MAX_HOSTS"],
+    )
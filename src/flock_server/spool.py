@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+
+from elasticsearch.serializer import JSONSerializer
+
+
+logger = logging.getLogger(__name__)
+
+# Serializes actions like the ElasticSearch client does, including datetimes
+serializer = JSONSerializer()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Slot:
+    """
+    A directory of spool segments, owned by one process at a time
+    """
+
+    def __init__(self, path, lock_fd):
+        self.path = path
+        self._lock_fd = lock_fd
+
+        # Spooled documents get IDs that are unique to this slot, so replaying them
+        # twice overwrites them instead of duplicating them
+        spool_id_path = os.path.join(path, "spool_id")
+        if not os.path.exists(spool_id_path):
+            with open(spool_id_path, "w") as f:
+                f.write(uuid.uuid4().hex)
+                f.flush()
+                os.fsync(f.fileno())
+        with open(spool_id_path) as f:
+            self.spool_id = f.read().strip()
+
+    @classmethod
+    def try_lock(cls, path):
+        # Returns the slot, or None if another process owns it
+        os.makedirs(path, exist_ok=True)
+        lock_fd = os.open(os.path.join(path, "lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+        return cls(path, lock_fd)
+
+    def release(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        os.close(self._lock_fd)
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"segment-{segment:08d}.ndjson")
+
+    def segments(self):
+        segments = []
+        for filename in os.listdir(self.path):
+            if filename.startswith("segment-") and filename.endswith(".ndjson"):
+                segments.append(int(filename[len("segment-") : -len(".ndjson")]))
+        return sorted(segments)
+
+    def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, "checkpoint.json")) as f:
+                checkpoint = json.load(f)
+            return checkpoint["segment"], checkpoint["offset"]
+        except FileNotFoundError:
+            return 0, 0
+
+    def write_checkpoint(self, segment, offset):
+        checkpoint_path = os.path.join(self.path, "checkpoint.json")
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, checkpoint_path)
+        _fsync_dir(self.path)
+
+
+class Spool:
+    """
+    An append-only, segmented spool of bulk actions on local disk, for when
+    ElasticSearch is unavailable. A background thread replays spooled actions into
+    ElasticSearch once it's available again, checkpointing its progress as it goes.
+
+    Each process that uses the spool claims its own numbered slot directory inside
+    the spool directory, and the replayer also drains slots that no process owns.
+    """
+
+    def __init__(
+        self,
+        directory,
+        index_func,
+        is_available,
+        segment_bytes=64 * 1024 * 1024,
+        replay_interval=10,
+        replay_batch_size=500,
+    ):
+        # index_func(actions) indexes a list of bulk actions, and returns a tuple of
+        # the indexed count and a list of failures. is_available() returns True when
+        # ElasticSearch can accept writes.
+        self.directory = directory
+        self.index_func = index_func
+        self.is_available = is_available
+        self.segment_bytes = segment_bytes
+        self.replay_interval = replay_interval
+        self.replay_batch_size = replay_batch_size
+
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Claim a slot and start the replayer. Threads and locks don't survive a
+        # fork, so this happens in the process that uses the spool.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            os.makedirs(self.directory, exist_ok=True)
+            slot_number = 0
+            while True:
+                self._slot = _Slot.try_lock(
+                    os.path.join(self.directory, str(slot_number))
+                )
+                if self._slot:
+                    break
+                slot_number += 1
+
+            self._file = None
+            self._segment = None
+            self._written = 0
+            self._synced = 0
+            self._pid = os.getpid()
+
+            thread = threading.Thread(
+                target=self._replay_forever, name="flock-spool-replayer", daemon=True
+            )
+            thread.start()
+
+    def append(self, actions):
+        # Durably write actions to the spool. Appends from concurrent requests are
+        # flushed to disk together with a single fsync.
+        self.start()
+        with self._lock:
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._open_next_segment()
+
+            for action in actions:
+                action = dict(action)
+                action.setdefault(
+                    "_id", f"{self._slot.spool_id}-{self._segment}-{self._file.tell()}"
+                )
+                self._file.write(
+                    json.dumps(action, default=serializer.default).encode() + b"\n"
+                )
+            self._file.flush()
+            self._written += 1
+            sequence = self._written
+
+        with self._lock:
+            if self._synced < sequence:
+                os.fsync(self._file.fileno())
+                self._synced = self._written
+
+    def _open_next_segment(self):
+        # Each process starts a new segment, so it never appends to a segment that a
+        # crashed process might have left with a partial line at the end
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._synced = self._written
+
+        segments = self._slot.segments()
+        checkpoint_segment, _ = self._slot.read_checkpoint()
+        if segments:
+            self._segment = max(segments[-1], checkpoint_segment) + 1
+        else:
+            self._segment = checkpoint_segment + 1
+        self._file = open(self._slot.segment_path(self._segment), "ab")
+        _fsync_dir(self._slot.path)
+
+    def replay(self):
+        # Replay everything that's spooled, returning the number of actions replayed.
+        # Raises an exception if ElasticSearch fails, and the next replay continues
+        # from the last checkpoint.
+        self.start()
+        with self._replay_lock:
+            replayed_count = self._replay_slot(self._slot, True)
+            for filename in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, filename)
+                if path == self._slot.path or not os.path.isdir(path):
+                    continue
+                slot = _Slot.try_lock(path)
+                if slot:
+                    try:
+                        replayed_count += self._replay_slot(slot, False)
+                    finally:
+                        slot.release()
+            return replayed_count
+
+    def _replay_slot(self, slot, is_own_slot):
+        replayed_count = 0
+        checkpoint_segment, offset = slot.read_checkpoint()
+        for segment in slot.segments():
+            path = slot.segment_path(segment)
+            if segment < checkpoint_segment:
+                os.remove(path)
+                continue
+            if segment > checkpoint_segment:
+                offset = 0
+
+            with self._lock:
+                is_active = is_own_slot and segment == self._segment
+
+            with open(path, "rb") as f:
+                f.seek(offset)
+                actions = []
+                while True:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        # Either the end of the segment, or a line that's still being
+                        # written (or was cut off by a crash)
+                        if line and not is_active:
+                            logger.warning(f"Skipping partial line at the end of {path}")
+                        break
+                    offset += len(line)
+                    actions.append(json.loads(line))
+                    if len(actions) >= self.replay_batch_size:
+                        self._index(actions)
+                        slot.write_checkpoint(segment, offset)
+                        replayed_count += len(actions)
+                        actions = []
+                if actions:
+                    self._index(actions)
+                    slot.write_checkpoint(segment, offset)
+                    replayed_count += len(actions)
+
+            if not is_active:
+                # This segment won't grow anymore, so it's done
+                os.remove(path)
+                slot.write_checkpoint(segment + 1, 0)
+                checkpoint_segment, offset = segment + 1, 0
+
+        return replayed_count
+
+    def _index(self, actions):
+        indexed_count, failures = self.index_func(actions)
+        rejected = [failure for failure in failures if failure["status"] == 429]
+        if rejected:
+            # ElasticSearch is overloaded, so try this batch again later
+            raise Exception(f"ElasticSearch rejected {len(rejected)} spooled documents")
+
+        # Docs created with an _id that's already indexed don't need indexing again
+        failures = [failure for failure in failures if failure["status"] != 409]
+        if failures:
+            logger.warning(
+                f"Failed to index {len(failures)} of {len(actions)} spooled documents: {failures}"
+            )
+
+    def _replay_forever(self):
+        while True:
+            time.sleep(self.replay_interval)
+            try:
+                if self.is_available():
+                    replayed_count = self.replay()
+                    if replayed_count > 0:
+                        logger.info(f"Replayed {replayed_count} spooled documents")
+            except Exception:
+                logger.exception("Failed to replay spooled documents")
@@ -0,0 +1,1021 @@
+import os
+import copy
+import glob
+import json
+import time
+import uuid
+import fcntl
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Index, Search
+
+from .elasticsearch import (
+    es,
+    User,
+    UserChange,
+    Setting,
+    KeybaseNotification,
+    HostState,
+    bulk_index,
+    is_available,
+    es_request_seconds,
+    request_timeout,
+    elasticsearch_url,
+)
+from .indices import install_flock_template
+from .host_states import merge_host_state
+
+
+# Where the gateway and the Keybase bot keep users, settings, Keybase notifications
+# and osquery docs. Users are User documents and notifications are
+# KeybaseNotification documents, whichever backend they're stored in.
+
+
+class Storage(ABC):
+    """
+    The interface that storage backends implement. A backend that's missing a
+    method can't be created.
+    """
+
+    def setup(self, log=print):
+        # Prepare the backend when the gateway or bot starts
+        pass
+
+    def is_available(self):
+        return True
+
+    # Users
+
+    @abstractmethod
+    def get_user(self, username, token=None):
+        # The user with this username (and token, if given), or None
+        pass
+
+    @abstractmethod
+    def list_users(self):
+        pass
+
+    @abstractmethod
+    def add_user(self, username, name, token):
+        pass
+
+    @abstractmethod
+    def rename_user(self, username, name):
+        pass
+
+    @abstractmethod
+    def delete_user(self, username):
+        pass
+
+    @abstractmethod
+    def user_changes(self, since):
+        # A list of (username, changed_at) tuples for the users that were renamed or
+        # deleted at or after since, a UTC datetime, oldest first
+        pass
+
+    # Settings
+
+    @abstractmethod
+    def get_setting(self, key, refresh=True):
+        # The setting's value, or None. refresh makes sure recently saved settings
+        # are included, which costs more with ElasticSearch.
+        pass
+
+    @abstractmethod
+    def save_setting(self, key, value, refresh=False):
+        pass
+
+    # osquery docs
+
+    @abstractmethod
+    def index_docs(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024):
+        # Store bulk actions. Returns the number of documents that were indexed, and
+        # a list describing each document that failed, like bulk_index().
+        pass
+
+    # Host states
+
+    @abstractmethod
+    def update_host_states(self, updates):
+        # Merge updates into hosts' states, with merge_host_state()'s rules. updates
+        # is a dict that maps usernames to updates.
+        pass
+
+    @abstractmethod
+    def host_states(self, usernames):
+        # A dict that maps usernames to their states, for hosts that have one
+        pass
+
+    # Keybase notifications
+
+    @abstractmethod
+    def add_notifications(self, keybase_notifications):
+        pass
+
+    @abstractmethod
+    def undelivered_notifications(self, size, after=None):
+        # Up to size undelivered notifications, oldest first, starting after the
+        # notification after
+        pass
+
+    @abstractmethod
+    def mark_delivered(self, keybase_notifications):
+        pass
+
+    @abstractmethod
+    def record_attempts(self, keybase_notifications):
+        # Save the attempts and next_attempt_at of notifications that failed to
+        # send, which stay undelivered
+        pass
+
+    @abstractmethod
+    def count_undelivered(self):
+        pass
+
+    def refresh_notifications(self):
+        # Make sure notifications that were just added are found
+        pass
+
+
+# Merges an update into a host state document, like merge_host_state()
+UPDATE_HOST_STATE_SCRIPT = """
+ctx._source.username = params.username;
+for (entry in params.update.entrySet()) {
+  String key = entry.getKey();
+  def value = entry.getValue();
+  def current = ctx._source[key];
+  if (key == 'twigs') {
+    if (current == null) {
+      ctx._source[key] = value;
+    } else {
+      current.putAll(value);
+    }
+  } else if (key.endsWith('_count')) {
+    ctx._source[key] = (current == null ? 0 : current) + value;
+  } else if (key == 'last_seen' || key == 'last_result_at') {
+    if (current == null || current.compareTo(value) < 0) {
+      ctx._source[key] = value;
+    }
+  } else {
+    ctx._source[key] = value;
+  }
+}
+"""
+
+
+class ElasticsearchStorage(Storage):
+    def setup(self, log=print):
+        # Wait for ElasticSearch to start
+        log("Waiting for ElasticSearch")
+        while not es.ping():
+            log("{} not ready, waiting ...".format(elasticsearch_url))
+            time.sleep(5)
+        log("{} is ready".format(elasticsearch_url))
+
+        # Initialize models
+        log("Initializing user model")
+        for model in [User, UserChange, Setting, KeybaseNotification, HostState]:
+            try:
+                model.init()
+            except:
+                pass
+
+        # Configure the indices that osquery data goes into
+        install_flock_template(log=log)
+
+    def is_available(self):
+        return is_available()
+
+    def get_user(self, username, token=None):
+        s = Search(index="user").filter("term", username=username)
+        if token is not None:
+            s = s.filter("term", token=token)
+        operation = "user_search" if token is None else "auth_search"
+        with es_request_seconds.labels(operation=operation).time():
+            r = s.params(request_timeout=request_timeout(operation)).execute()
+        if len(r) == 0:
+            return None
+        return r[0]
+
+    def list_users(self):
+        return list(Search(index="user").query("match_all").scan())
+
+    def add_user(self, username, name, token):
+        # Add user, and force a refresh of the index
+        user = User(username=username, name=name, token=token)
+        timeout = request_timeout("user_save")
+        with es_request_seconds.labels(operation="user_save").time():
+            user.save(request_timeout=timeout)
+            Index("user").refresh(request_timeout=timeout)
+        return user
+
+    def _find_user(self, username):
+        results = User.search().filter("term", username=username).execute()
+        for user in results:
+            return user
+        return None
+
+    def rename_user(self, username, name):
+        user = self._find_user(username)
+        if user:
+            user.update(name=name)
+            Index("user").refresh()
+            self._add_user_change(username)
+
+    def delete_user(self, username):
+        user = self._find_user(username)
+        if user:
+            user.delete()
+            Index("user").refresh()
+            self._add_user_change(username)
+        es.delete(index="host_state", id=username, ignore=404)
+
+    def _add_user_change(self, username):
+        UserChange(username=username, changed_at=datetime.utcnow()).save(
+            refresh=True
+        )
+
+    def user_changes(self, since):
+        s = (
+            UserChange.search()
+            .filter("range", changed_at={"gte": since})
+            .sort("changed_at")
+            .extra(size=1000)
+            .params(
+                ignore_unavailable=True,
+                request_timeout=request_timeout("user_change_search"),
+            )
+        )
+        with es_request_seconds.labels(operation="user_change_search").time():
+            r = s.execute()
+        return [(hit.username, hit.changed_at) for hit in r]
+
+    def _find_setting(self, key):
+        results = Setting.search().filter("term", key=key).execute()
+        for setting in results:
+            return setting
+        return None
+
+    def get_setting(self, key, refresh=True):
+        with es_request_seconds.labels(operation="settings_refresh").time():
+            if refresh:
+                Index("setting").refresh(
+                    request_timeout=request_timeout("settings_refresh")
+                )
+            setting = self._find_setting(key)
+        if setting is None:
+            return None
+        return setting.value
+
+    def save_setting(self, key, value, refresh=False):
+        setting = self._find_setting(key)
+        if setting is None:
+            Setting(key=key, value=value).save()
+        else:
+            setting.update(value=value)
+        if refresh:
+            Index("setting").refresh()
+
+    def index_docs(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024):
+        return bulk_index(
+            actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes
+        )
+
+    def update_host_states(self, updates):
+        # Each update is merged by a script, so updates from different processes
+        # and hosts that don't have a state yet are handled by ElasticSearch
+        with es_request_seconds.labels(operation="host_state_update").time():
+            bulk(
+                es,
+                [
+                    {
+                        "_op_type": "update",
+                        "_index": "host_state",
+                        "_id": username,
+                        "script": {
+                            "source": UPDATE_HOST_STATE_SCRIPT,
+                            "params": {"username": username, "update": update},
+                        },
+                        "scripted_upsert": True,
+                        "upsert": {},
+                        "retry_on_conflict": 3,
+                    }
+                    for username, update in updates.items()
+                ],
+                request_timeout=request_timeout("host_state_update"),
+            )
+
+    def host_states(self, usernames, batch_size=500):
+        # Look up each host's state by its _id. Hosts that haven't submitted
+        # anything since the gateway started keeping host states are looked up in
+        # their osquery results instead.
+        host_states = {}
+        for i in range(0, len(usernames), batch_size):
+            batch = usernames[i : i + batch_size]
+            with es_request_seconds.labels(operation="host_state_get").time():
+                r = es.mget(
+                    index="host_state",
+                    body={"ids": batch},
+                    request_timeout=request_timeout("host_state_get"),
+                )
+            for doc in r["docs"]:
+                if doc.get("found"):
+                    host_state = doc["_source"]
+                    host_state.pop("username", None)
+                    host_states[doc["_id"]] = host_state
+
+        missing = [username for username in usernames if username not in host_states]
+        if missing:
+            host_states.update(self._search_host_states(missing, batch_size))
+        return host_states
+
+    def _search_host_states(self, usernames, batch_size):
+        # Find when each host last submitted data, and its latest OS version, with
+        # one aggregation query per batch of hosts
+        latest = {"@timestamp": {"order": "desc", "unmapped_type": "date"}}
+        host_states = {}
+        for i in range(0, len(usernames), batch_size):
+            batch = usernames[i : i + batch_size]
+            s = (
+                Search(index="flock-*")
+                .filter("terms", **{"hostIdentifier.keyword": batch})
+                .extra(size=0)
+            )
+            hosts = s.aggs.bucket(
+                "hosts", "terms", field="hostIdentifier.keyword", size=len(batch)
+            )
+            hosts.metric(
+                "last_updated",
+                "top_hits",
+                size=1,
+                sort=[latest],
+                _source=["@timestamp"],
+            )
+            hosts.bucket(
+                "os_version", "filter", term={"name.keyword": "os_version"}
+            ).metric("latest", "top_hits", size=1, sort=[latest], _source=["columns"])
+            s = s.params(request_timeout=request_timeout("host_state_search"))
+            with es_request_seconds.labels(operation="host_state_search").time():
+                r = s.execute()
+            if "hosts" not in r.aggregations:
+                continue
+
+            for bucket in r.aggregations.hosts.buckets:
+                host_state = {}
+                hits = bucket.last_updated.hits.hits
+                if len(hits) > 0 and "@timestamp" in hits[0]._source:
+                    host_state["last_result_at"] = hits[0]._source["@timestamp"]
+                hits = bucket.os_version.latest.hits.hits
+                if len(hits) > 0 and "columns" in hits[0]._source:
+                    host_state["os_version"] = hits[0]._source.columns.to_dict()
+                host_states[bucket.key] = host_state
+
+        return host_states
+
+    def add_notifications(self, keybase_notifications):
+        with es_request_seconds.labels(operation="notification_save").time():
+            bulk(
+                es,
+                [
+                    keybase_notification.to_dict(include_meta=True)
+                    for keybase_notification in keybase_notifications
+                ],
+                request_timeout=request_timeout("notification_save"),
+            )
+
+    def undelivered_notifications(self, size, after=None):
+        s = (
+            KeybaseNotification.search()
+            .filter("term", delivered=False)
+            .sort("created_at", "_id")
+            .extra(size=size)
+        )
+        if after is not None:
+            s = s.extra(search_after=list(after.meta.sort))
+        s = s.params(request_timeout=request_timeout("notification_search"))
+        with es_request_seconds.labels(operation="notification_search").time():
+            return list(s.execute())
+
+    def mark_delivered(self, keybase_notifications):
+        with es_request_seconds.labels(operation="notification_update").time():
+            bulk(
+                es,
+                [
+                    {
+                        "_op_type": "update",
+                        "_index": keybase_notification.meta.index,
+                        "_id": keybase_notification.meta.id,
+                        "doc": {"delivered": True},
+                    }
+                    for keybase_notification in keybase_notifications
+                ],
+                refresh=True,
+                request_timeout=request_timeout("notification_update"),
+            )
+
+    def record_attempts(self, keybase_notifications):
+        with es_request_seconds.labels(operation="notification_update").time():
+            bulk(
+                es,
+                [
+                    {
+                        "_op_type": "update",
+                        "_index": keybase_notification.meta.index,
+                        "_id": keybase_notification.meta.id,
+                        "doc": {
+                            "attempts": keybase_notification.attempts,
+                            "next_attempt_at": keybase_notification.next_attempt_at,
+                        },
+                    }
+                    for keybase_notification in keybase_notifications
+                ],
+                refresh=True,
+                request_timeout=request_timeout("notification_update"),
+            )
+
+    def count_undelivered(self):
+        s = (
+            KeybaseNotification.search()
+            .filter("term", delivered=False)
+            .params(request_timeout=request_timeout("notification_count"))
+        )
+        with es_request_seconds.labels(operation="notification_count").time():
+            return s.count()
+
+    def refresh_notifications(self):
+        with es_request_seconds.labels(operation="notification_refresh").time():
+            Index("keybase_notification").refresh(
+                request_timeout=request_timeout("notification_refresh")
+            )
+
+
+def _parse_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _latest_changes(user_changes):
+    # Only the latest of each user's changes, oldest first
+    latest = {}
+    for username, changed_at in user_changes:
+        latest.pop(username, None)
+        latest[username] = changed_at
+    return list(latest.items())
+
+
+def _attempts_record(keybase_notification):
+    # A notification's failed attempts, for a change log, if it has any
+    if not keybase_notification.attempts:
+        return {}
+    next_attempt_at = keybase_notification.next_attempt_at
+    return {
+        "attempts": keybase_notification.attempts,
+        "next_attempt_at": next_attempt_at.isoformat() if next_attempt_at else None,
+    }
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps everything in this process, and forgets it when the process exits. Only
+    the most recent max_docs osquery docs are kept. For tests and benchmarks.
+    """
+
+    def __init__(self, max_docs=100000):
+        self.max_docs = max_docs
+        self._lock = threading.RLock()
+        self._users = {}
+        self._user_changes = []
+        self._settings = {}
+        self._notifications = OrderedDict()
+        self._notification_sequence = 0
+        self._host_states = {}
+        self._docs = OrderedDict()
+
+    # Every change is a record that's applied to the state in memory. NdjsonStorage
+    # also appends them to files, and replays other processes' records.
+
+    def _record(self, log_name, records):
+        with self._lock:
+            for record in records:
+                self._apply(log_name, record)
+
+    def _sync(self, log_name):
+        pass
+
+    def _reset(self, log_name):
+        # Forget the state that a log's records were applied to
+        if log_name == "users":
+            self._users = {}
+            self._user_changes = []
+        elif log_name == "settings":
+            self._settings = {}
+        elif log_name == "notifications":
+            self._notifications = OrderedDict()
+            self._notification_sequence = 0
+        elif log_name == "hosts":
+            self._host_states = {}
+
+    def _snapshot(self, log_name, changes_since):
+        # Records that recreate the state a log's records were applied to, with each
+        # user's latest change if it was made at or after changes_since
+        if log_name == "users":
+            return [
+                {
+                    "op": "add",
+                    "username": user.username,
+                    "name": user.name,
+                    "token": user.token,
+                    "created_at": user.created_at.isoformat(),
+                }
+                for user in self._users.values()
+            ] + [
+                {
+                    "op": "change",
+                    "username": username,
+                    "changed_at": changed_at.isoformat(),
+                }
+                for username, changed_at in _latest_changes(self._user_changes)
+                if changed_at >= changes_since
+            ]
+        if log_name == "settings":
+            return [
+                {"key": key, "value": value} for key, value in self._settings.items()
+            ]
+        if log_name == "notifications":
+            return [
+                {
+                    "op": "add",
+                    "id": notification_id,
+                    "sequence": keybase_notification.meta.sort[0],
+                    "notification_type": keybase_notification.notification_type,
+                    "details": keybase_notification.to_dict()["details"],
+                    "created_at": keybase_notification.created_at.isoformat(),
+                    **_attempts_record(keybase_notification),
+                }
+                for notification_id, keybase_notification in (
+                    self._notifications.items()
+                )
+            ]
+        if log_name == "hosts":
+            return [
+                {"op": "update", "username": username, "update": host_state}
+                for username, host_state in self._host_states.items()
+            ]
+        return []
+
+    def _apply(self, log_name, record):
+        if log_name == "users":
+            if record["op"] == "add":
+                self._users[record["username"]] = User(
+                    meta={"id": record["username"]},
+                    username=record["username"],
+                    name=record["name"],
+                    token=record["token"],
+                    created_at=_parse_datetime(record["created_at"]),
+                )
+            elif record["op"] == "rename":
+                if record["username"] in self._users:
+                    self._users[record["username"]].name = record["name"]
+            elif record["op"] == "delete":
+                self._users.pop(record["username"], None)
+            if "changed_at" in record:
+                self._user_changes.append(
+                    (record["username"], _parse_datetime(record["changed_at"]))
+                )
+
+        elif log_name == "settings":
+            self._settings[record["key"]] = record["value"]
+
+        elif log_name == "notifications":
+            if record["op"] == "add":
+                self._notification_sequence = max(
+                    self._notification_sequence + 1, record.get("sequence", 0)
+                )
+                self._notifications[record["id"]] = KeybaseNotification(
+                    meta={"id": record["id"], "sort": [self._notification_sequence]},
+                    notification_type=record["notification_type"],
+                    details=record["details"],
+                    delivered=False,
+                    created_at=_parse_datetime(record["created_at"]),
+                )
+                if "attempts" in record:
+                    self._apply_attempts(record)
+            elif record["op"] == "delivered":
+                for notification_id in record["ids"]:
+                    self._notifications.pop(notification_id, None)
+            elif record["op"] == "attempts":
+                for attempts in record["notifications"]:
+                    self._apply_attempts(attempts)
+
+        elif log_name == "hosts":
+            if record["op"] == "update":
+                merge_host_state(
+                    self._host_states.setdefault(record["username"], {}),
+                    record["update"],
+                )
+            elif record["op"] == "delete":
+                self._host_states.pop(record["username"], None)
+
+    def get_user(self, username, token=None):
+        self._sync("users")
+        user = self._users.get(username)
+        if user is None or (token is not None and user.token != token):
+            return None
+        return user
+
+    def list_users(self):
+        self._sync("users")
+        with self._lock:
+            return list(self._users.values())
+
+    def add_user(self, username, name, token):
+        self._record(
+            "users",
+            [
+                {
+                    "op": "add",
+                    "username": username,
+                    "name": name,
+                    "token": token,
+                    "created_at": datetime.now().isoformat(),
+                }
+            ],
+        )
+        return self.get_user(username)
+
+    def rename_user(self, username, name):
+        self._record(
+            "users",
+            [
+                {
+                    "op": "rename",
+                    "username": username,
+                    "name": name,
+                    "changed_at": datetime.utcnow().isoformat(),
+                }
+            ],
+        )
+
+    def delete_user(self, username):
+        self._record(
+            "users",
+            [
+                {
+                    "op": "delete",
+                    "username": username,
+                    "changed_at": datetime.utcnow().isoformat(),
+                }
+            ],
+        )
+        self._record("hosts", [{"op": "delete", "username": username}])
+
+    def user_changes(self, since):
+        self._sync("users")
+        with self._lock:
+            return [
+                (username, changed_at)
+                for username, changed_at in self._user_changes
+                if changed_at >= since
+            ]
+
+    def get_setting(self, key, refresh=True):
+        self._sync("settings")
+        return self._settings.get(key)
+
+    def save_setting(self, key, value, refresh=False):
+        self._record("settings", [{"key": key, "value": value}])
+
+    def index_docs(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024):
+        indexed_count = 0
+        failures = []
+        with self._lock:
+            for i, action in enumerate(actions):
+                key = (action.get("_index"), action.get("_id") or uuid.uuid4().hex)
+                if action.get("_op_type") == "create" and key in self._docs:
+                    failures.append(
+                        {
+                            "item": i,
+                            "status": 409,
+                            "error": {
+                                "type": "version_conflict_engine_exception",
+                                "reason": "document already exists",
+                            },
+                        }
+                    )
+                    continue
+                self._docs[key] = action["_source"]
+                indexed_count += 1
+            while len(self._docs) > self.max_docs:
+                self._docs.popitem(last=False)
+        return indexed_count, failures
+
+    def docs(self, index=None):
+        # The stored docs, optionally only those in one index
+        with self._lock:
+            return [
+                doc
+                for (doc_index, _), doc in self._docs.items()
+                if index is None or doc_index == index
+            ]
+
+    def update_host_states(self, updates):
+        self._record(
+            "hosts",
+            [
+                {"op": "update", "username": username, "update": update}
+                for username, update in updates.items()
+            ],
+        )
+
+    def host_states(self, usernames):
+        self._sync("hosts")
+        with self._lock:
+            return {
+                username: copy.deepcopy(self._host_states[username])
+                for username in usernames
+                if username in self._host_states
+            }
+
+    def add_notifications(self, keybase_notifications):
+        self._record(
+            "notifications",
+            [
+                {
+                    "op": "add",
+                    "id": uuid.uuid4().hex,
+                    "notification_type": keybase_notification.notification_type,
+                    "details": keybase_notification.details,
+                    "created_at": keybase_notification.created_at.isoformat(),
+                }
+                for keybase_notification in keybase_notifications
+            ],
+        )
+
+    def undelivered_notifications(self, size, after=None):
+        self._sync("notifications")
+        after_sequence = after.meta.sort[0] if after is not None else 0
+        results = []
+        with self._lock:
+            for keybase_notification in self._notifications.values():
+                if keybase_notification.meta.sort[0] > after_sequence:
+                    results.append(keybase_notification)
+                    if len(results) >= size:
+                        break
+        return results
+
+    def mark_delivered(self, keybase_notifications):
+        self._record(
+            "notifications",
+            [
+                {
+                    "op": "delivered",
+                    "ids": [
+                        keybase_notification.meta.id
+                        for keybase_notification in keybase_notifications
+                    ],
+                }
+            ],
+        )
+
+    def record_attempts(self, keybase_notifications):
+        self._record(
+            "notifications",
+            [
+                {
+                    "op": "attempts",
+                    "notifications": [
+                        dict(
+                            _attempts_record(keybase_notification),
+                            id=keybase_notification.meta.id,
+                        )
+                        for keybase_notification in keybase_notifications
+                    ],
+                }
+            ],
+        )
+
+    def _apply_attempts(self, record):
+        keybase_notification = self._notifications.get(record["id"])
+        if keybase_notification is None:
+            return
+        keybase_notification.attempts = record.get("attempts", 0)
+        keybase_notification.next_attempt_at = _parse_datetime(
+            record.get("next_attempt_at")
+        )
+
+    def count_undelivered(self):
+        self._sync("notifications")
+        return len(self._notifications)
+
+
+class NdjsonStorage(MemoryStorage):
+    """
+    Appends everything to newline-delimited JSON files in a directory, for
+    deployments without ElasticSearch. osquery docs are written to a file for each
+    index in the bulk API's format, so they can be loaded into ElasticSearch later.
+    Users, settings, notifications and host states are logs of changes, which each
+    process replays, so the gateway and the bot can share a directory.
+
+    Once a log grows past compact_bytes, and twice its size when it was last
+    compacted, it's replaced by a snapshot: a header with a unique id, and then the
+    records that recreate its current state, like one add for each undelivered
+    notification. Other processes notice that the log's first line changed and
+    replay the snapshot instead.
+    """
+
+    log_names = ["users", "settings", "notifications", "hosts"]
+
+    # Renames and deletes are kept in snapshots for this long, for user_changes()
+    user_change_retention = timedelta(days=1)
+
+    def __init__(self, path, compact_bytes=4 * 1024 * 1024):
+        super().__init__(max_docs=0)
+        self.path = path
+        self.compact_bytes = compact_bytes
+        os.makedirs(os.path.join(path, "docs"), exist_ok=True)
+        self._offsets = {log_name: 0 for log_name in self.log_names}
+        self._first_lines = {log_name: None for log_name in self.log_names}
+        self._compacted_sizes = {log_name: 0 for log_name in self.log_names}
+        for log_name in self.log_names:
+            self._sync(log_name)
+            self._compact_if_needed(log_name)
+
+    def _log_path(self, log_name):
+        return os.path.join(self.path, f"{log_name}.ndjson")
+
+    def _append(self, path, data):
+        # Appends from different processes are serialized with a lock, so lines are
+        # never interleaved. A log that was compacted while waiting for the lock
+        # has been replaced, so append to the new one.
+        while True:
+            with open(path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if not _is_current(f, path):
+                        continue
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    return
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _record(self, log_name, records):
+        if not records:
+            return
+        data = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+        self._append(self._log_path(log_name), data)
+
+        # Apply it along with anything other processes appended first
+        self._sync(log_name)
+        self._compact_if_needed(log_name)
+
+    def _sync(self, log_name):
+        # Apply records appended since the last sync, up to the last complete line.
+        # If the log was compacted, replay the new one from the start.
+        path = self._log_path(log_name)
+        with self._lock:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                return
+            with f:
+                first_line = f.readline()
+                if not first_line.endswith(b"\n"):
+                    return
+                size = os.fstat(f.fileno()).st_size
+                if first_line != self._first_lines[log_name]:
+                    self._reset(log_name)
+                    self._first_lines[log_name] = first_line
+                    self._offsets[log_name] = 0
+                    self._compacted_sizes[log_name] = size
+                if size <= self._offsets[log_name]:
+                    return
+                f.seek(self._offsets[log_name])
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get("op") != "snapshot":
+                        self._apply(log_name, record)
+            self._offsets[log_name] += end
+
+    def _compact_if_needed(self, log_name):
+        size = self._offsets[log_name]
+        if size > self.compact_bytes and size > 2 * self._compacted_sizes[log_name]:
+            self.compact(log_name)
+
+    def compact(self, log_name):
+        # Replace a log with a snapshot of its state. Appends wait for the lock on
+        # the old log, so none are lost.
+        path = self._log_path(log_name)
+        with self._lock, open(path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if not _is_current(f, path):
+                    return
+                self._sync(log_name)
+                changes_since = datetime.utcnow() - self.user_change_retention
+                header = {"op": "snapshot", "id": uuid.uuid4().hex}
+                data = b"".join(
+                    json.dumps(record).encode() + b"\n"
+                    for record in [header] + self._snapshot(log_name, changes_since)
+                )
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as tmp_f:
+                    tmp_f.write(data)
+                    tmp_f.flush()
+                    os.fsync(tmp_f.fileno())
+                os.replace(tmp_path, path)
+
+                # What's in the snapshot is already applied
+                self._first_lines[log_name] = data[: data.index(b"\n") + 1]
+                self._offsets[log_name] = len(data)
+                self._compacted_sizes[log_name] = len(data)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def index_docs(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024):
+        # Resent docs with the same _id aren't detected here, but they are when the
+        # files are loaded into ElasticSearch
+        lines = {}
+        for action in actions:
+            index = action.get("_index") or "flock"
+            meta = {"_index": index}
+            if "_id" in action:
+                meta["_id"] = action["_id"]
+            op_type = action.get("_op_type", "index")
+            lines.setdefault(index, []).append(
+                json.dumps({op_type: meta}).encode()
+                + b"\n"
+                + json.dumps(action["_source"]).encode()
+                + b"\n"
+            )
+        for index, index_lines in lines.items():
+            filename = os.path.basename(index) + ".ndjson"
+            self._append(
+                os.path.join(self.path, "docs", filename), b"".join(index_lines)
+            )
+
+        return len(actions), []
+
+    def docs(self, index=None):
+        # Read the docs back from the bulk files, like ElasticSearch would load them:
+        # a doc created with an _id that's already loaded is skipped
+        if index is None:
+            filenames = sorted(glob.glob(os.path.join(self.path, "docs", "*.ndjson")))
+        else:
+            filenames = [
+                os.path.join(self.path, "docs", os.path.basename(index) + ".ndjson")
+            ]
+
+        docs = []
+        for filename in filenames:
+            ids = set()
+            try:
+                with open(filename, "rb") as f:
+                    lines = f.read().splitlines(keepends=True)
+            except FileNotFoundError:
+                continue
+            for action_line, source_line in zip(lines[::2], lines[1::2]):
+                if not source_line.endswith(b"\n"):
+                    break
+                op_type, meta = next(iter(json.loads(action_line).items()))
+                if "_id" in meta:
+                    if op_type == "create" and meta["_id"] in ids:
+                        continue
+                    ids.add(meta["_id"])
+                docs.append(json.loads(source_line))
+        return docs
+
+
+def _is_current(f, path):
+    # Whether the open file f is still the file at path, rather than one that was
+    # replaced
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def create_storage(backend=None, path=None):
+    # Create the storage backend named by FLOCK_STORAGE: elasticsearch (the
+    # default), memory, or ndjson, which writes to the FLOCK_STORAGE_PATH directory
+    if backend is None:
+        backend = os.environ.get("FLOCK_STORAGE", "elasticsearch")
+    if path is None:
+        path = os.environ.get("FLOCK_STORAGE_PATH", "/var/lib/flock")
+
+    if backend == "elasticsearch":
+        return ElasticsearchStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "ndjson":
+        return NdjsonStorage(path)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,91 @@
+import json
+import codecs
+
+
+class NotAnArrayError(ValueError):
+    pass
+
+
+class BodyTooLargeError(ValueError):
+    pass
+
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+
+def iter_json_array(stream, read_size=64 * 1024, max_bytes=None):
+    """
+    Parse a JSON array from a file-like object of bytes, yielding one item at a time,
+    so memory use depends on the size of the largest item rather than the whole body.
+    Raises NotAnArrayError if the JSON isn't an array, BodyTooLargeError if more than
+    max_bytes are read, and ValueError if it isn't valid JSON.
+    """
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    state = {"buffer": "", "pos": 0, "eof": False, "bytes_read": 0}
+
+    def read_more(size):
+        # Drop what's already been parsed, and append more of the stream
+        data = stream.read(size)
+        state["bytes_read"] += len(data)
+        if max_bytes is not None and state["bytes_read"] > max_bytes:
+            raise BodyTooLargeError(f"Body is larger than {max_bytes} bytes")
+        state["buffer"] = state["buffer"][state["pos"] :] + utf8_decoder.decode(
+            data, final=not data
+        )
+        state["pos"] = 0
+        if not data:
+            state["eof"] = True
+
+    def next_char():
+        # Skip whitespace and return the next character, or None at the end
+        while True:
+            buffer, pos = state["buffer"], state["pos"]
+            while pos < len(buffer) and buffer[pos] in _whitespace:
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if state["eof"]:
+                return None
+            read_more(read_size)
+
+    def parse_item():
+        size = read_size
+        while True:
+            try:
+                item, end = _decoder.raw_decode(state["buffer"], state["pos"])
+                # A number at the very end of the buffer might continue in the
+                # next read
+                if end < len(state["buffer"]) or state["eof"]:
+                    state["pos"] = end
+                    return item
+            except json.JSONDecodeError:
+                if state["eof"]:
+                    raise
+            # Read more than what's pending, so a huge item isn't parsed over and
+            # over from the start
+            size = max(size, len(state["buffer"]) - state["pos"])
+            read_more(size)
+
+    if next_char() != "[":
+        raise NotAnArrayError("Data is not an array")
+    state["pos"] += 1
+
+    if next_char() == "]":
+        state["pos"] += 1
+    else:
+        while True:
+            if next_char() is None:
+                raise ValueError("Unexpected end of data")
+            yield parse_item()
+
+            c = next_char()
+            state["pos"] += 1
+            if c == "]":
+                break
+            if c != ",":
+                raise ValueError("Expected ',' or ']'")
+
+    if next_char() is not None:
+        raise ValueError("Extra data after the array")
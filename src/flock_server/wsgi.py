@@ -0,0 +1,4 @@
+# WSGI entry point for the gateway, used by gunicorn (see gunicorn.conf.py)
+from .api import create_api_app
+
+app = create_api_app()
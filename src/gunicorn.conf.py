@@ -0,0 +1,85 @@
+# gunicorn settings for the gateway. app.py starts it like:
+#
+#     gunicorn -c gunicorn.conf.py flock_server.wsgi:app
+#
+# The app is loaded once in the master process and then forked, and each worker
+# serves requests with a pool of threads. Send SIGHUP to gracefully replace the
+# workers, and SIGTERM to stop accepting connections and drain in-flight requests
+# before shutting down.
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+bind = "0.0.0.0:{}".format(os.environ.get("FLOCK_PORT", "5000"))
+workers = int(os.environ.get("FLOCK_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("FLOCK_THREADS", 4))
+preload_app = True
+
+# Seconds a worker may spend on a request, and seconds it gets to finish in-flight
+# requests (and drain the async ingest queue) when shutting down
+timeout = int(os.environ.get("FLOCK_WORKER_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("FLOCK_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("FLOCK_KEEPALIVE", 5))
+
+# Optionally recycle workers after this many requests, with some jitter so they
+# don't all restart at once
+max_requests = int(os.environ.get("FLOCK_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+# Each worker keeps its metrics in files in this directory, through prometheus_client's
+# multiprocess mode, and the master serves their sum at /metrics on a port of its
+# own, away from agents. prometheus_client only reads PROMETHEUS_MULTIPROC_DIR when
+# it's imported, so it's set here, before the app is loaded.
+temporary_metrics_dir = not os.environ.get("FLOCK_METRICS_DIR")
+metrics_dir = os.environ.get("FLOCK_METRICS_DIR") or tempfile.mkdtemp(
+    prefix="flock-metrics-"
+)
+os.makedirs(metrics_dir, exist_ok=True)
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+metrics_port = int(os.environ.get("FLOCK_METRICS_PORT", 9102))
+
+
+def when_ready(server):
+    from flock_server.metrics import clear_multiprocess_dir, start_http_server
+
+    clear_multiprocess_dir()
+    if metrics_port:
+        start_http_server(metrics_port)
+
+
+def post_fork(server, worker):
+    from flock_server.elasticsearch import reset_connections
+
+    reset_connections()
+
+
+def child_exit(server, worker):
+    # Drop the gauges of a worker that's gone, like its queued documents. Its
+    # counters and histograms are kept, so they never go backwards.
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if temporary_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def worker_exit(server, worker):
+    from flock_server.wsgi import app
+
+    try:
+        app.extensions["flock_host_states"].flush()
+    except Exception:
+        server.log.exception(f"Worker {worker.pid} failed to write host states")
+
+    ingest_queue = app.extensions.get("flock_ingest_queue")
+    if ingest_queue and not ingest_queue.drain(max(graceful_timeout - 5, 1)):
+        server.log.warning(
+            f"Worker {worker.pid} exited with {ingest_queue.pending_docs} documents still queued"
+        )
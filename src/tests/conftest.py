@@ -3,7 +3,13 @@ import json
 import pytest
 
 from elasticsearch_dsl import Index, Search
-from flock_server import create_api_app, KeybaseHandler, KeybaseNotifications, Setting
+from flock_server import (
+    create_api_app,
+    KeybaseHandler,
+    KeybaseNotifications,
+    Setting,
+    identity_cache,
+)
 
 
 class BotStub:
@@ -16,10 +22,12 @@ class BotStub:
             def __init__(self):
                 self.sent_channel = None
                 self.sent_message = None
+                self.sent_messages = []
 
             async def send(self, channel, message):
                 self.sent_channel = channel
                 self.sent_message = message
+                self.sent_messages.append(message)
 
         self.chat = Chat()
 
@@ -53,6 +61,7 @@ def client(app):
     # Delete all users
     Search(index="user").query("match_all").delete()
     Index("user").refresh()
+    identity_cache.clear()
 
     return client
 
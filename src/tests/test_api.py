@@ -1,5 +1,12 @@
 import json
 import base64
+import secrets
+import threading
+
+from elasticsearch.exceptions import ConnectionError
+
+from flock_server import create_api_app
+from flock_server.metrics import render
 
 
 def get_auth_header(client, username="UUID1"):
@@ -140,6 +147,17 @@ def test_submit_list(client):
     )
     assert res.status_code == 400
 
+    # Nothing is indexed from a batch with an invalid item, even in earlier chunks
+    app = create_api_app({"TESTING": True, "STORAGE": "memory", "BULK_CHUNK_SIZE": 2})
+    memory_client = app.test_client()
+    res = memory_client.post(
+        "/submit",
+        json=[{"hostIdentifier": username}] * 4 + ["bad"],
+        headers=get_auth_header(memory_client, username),
+    )
+    assert res.status_code == 400
+    assert app.extensions["flock_storage"].docs() == []
+
     # Submit 3 log objects
     res = submit(
         [
@@ -150,3 +168,331 @@ def test_submit_list(client):
     )
     assert res.status_code == 200
     assert json.loads(res.data)["processed_count"] == 3
+
+
+def test_submit_reports_indexed_count(client):
+    username = "UUID1"
+    auth_header = get_auth_header(client, username)
+
+    res = client.post(
+        "/submit",
+        json=[{"hostIdentifier": username, "name": "test"} for _ in range(10)],
+        headers=auth_header,
+    )
+    assert res.status_code == 200
+    data = json.loads(res.data)
+    assert data["processed_count"] == 10
+    assert data["indexed_count"] == 10
+    assert data["failed_count"] == 0
+    assert data["failures"] == []
+
+
+def test_submit_async_ingest(client):
+    username = "UUID1"
+    auth_header = get_auth_header(client, username)
+
+    app = create_api_app({"TESTING": True, "ASYNC_INGEST": True})
+    res = app.test_client().post(
+        "/submit", json=[{"hostIdentifier": username}] * 3, headers=auth_header,
+    )
+    assert res.status_code == 202
+    assert json.loads(res.data)["processed_count"] == 3
+    app.extensions["flock_ingest_queue"].join()
+
+
+def test_submit_spools_notifications(client, tmp_path):
+    username = "UUID1"
+    auth_header = get_auth_header(client, username)
+
+    app = create_api_app({"TESTING": True, "SPOOL_DIR": str(tmp_path)})
+    client = app.test_client()
+    assert client.get("/ping", headers=auth_header).status_code == 200
+
+    # ElasticSearch goes down after the user was cached
+    def unavailable(*args, **kwargs):
+        raise ConnectionError("N/A", "Connection refused", None)
+
+    storage = app.extensions["flock_storage"]
+    storage.index_docs = unavailable
+    storage.add_notifications = unavailable
+    storage.get_setting = unavailable
+
+    res = client.post(
+        "/submit",
+        json=[{"hostIdentifier": username, "name": "launchd", "action": "added"}],
+        headers=auth_header,
+    )
+    assert res.status_code == 200
+    assert res.json["spooled_count"] == 1
+
+    # The notification was spooled along with the doc
+    spooled = [
+        json.loads(line)
+        for path in tmp_path.glob("*/segment-*.ndjson")
+        for line in path.read_text().splitlines()
+    ]
+    assert len(spooled) == 2
+    assert spooled[1]["_index"] == "keybase_notification"
+    assert spooled[1]["_source"]["notification_type"] == "launchd"
+
+    # Users who aren't cached are asked to try again later
+    storage.get_user = unavailable
+    credentials = base64.b64encode(b"UUID2:token").decode()
+    res = client.get("/ping", headers={"Authorization": f"Basic {credentials}"})
+    assert res.status_code == 503
+
+
+def test_submit_rate_limit(client):
+    username = "UUID1"
+    auth_header = get_auth_header(client, username)
+
+    app = create_api_app(
+        {
+            "TESTING": True,
+            "RATE_LIMIT_DOCS": 0.1,
+            "RATE_LIMIT_DOCS_BURST": 2,
+        }
+    )
+    client = app.test_client()
+
+    # The first batch puts the host in debt, and the next is throttled
+    res = client.post(
+        "/submit", json=[{"hostIdentifier": username}] * 3, headers=auth_header,
+    )
+    assert res.status_code == 200
+    res = client.post(
+        "/submit", json=[{"hostIdentifier": username}], headers=auth_header,
+    )
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "10"
+
+
+def test_submit_idempotent(client):
+    username = "UUID1"
+    auth_header = get_auth_header(client, username)
+
+    app = create_api_app({"TESTING": True, "IDEMPOTENT_INGEST": True})
+    client = app.test_client()
+
+    # Docs from earlier test runs are still indexed, so make these unique
+    columns = {"run": secrets.token_hex(8)}
+    docs = [
+        {"hostIdentifier": username, "name": "uptime", "unixTime": 1587000000},
+        {"hostIdentifier": username, "name": "uptime", "unixTime": 1587000001},
+        {"hostIdentifier": username, "name": "uptime", "unixTime": 1587000001},
+    ]
+    for doc in docs:
+        doc["columns"] = columns
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 200
+    assert res.json["processed_count"] == 3
+    assert res.json["indexed_count"] == 2
+    assert res.json["duplicate_count"] == 1
+
+    # Resending the batch doesn't index anything again
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 200
+    assert res.json["processed_count"] == 3
+    assert res.json["indexed_count"] == 0
+    assert res.json["duplicate_count"] == 3
+
+    # So does resending it to a server that hasn't seen it, like another worker
+    app = create_api_app({"TESTING": True, "IDEMPOTENT_INGEST": True})
+    client = app.test_client()
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 200
+    assert res.json["indexed_count"] == 0
+    assert res.json["duplicate_count"] == 3
+    assert res.json["failed_count"] == 0
+
+
+def test_submit_idempotent_after_failures(client):
+    app = create_api_app(
+        {"TESTING": True, "STORAGE": "memory", "IDEMPOTENT_INGEST": True}
+    )
+    client = app.test_client()
+    auth_header = get_auth_header(client, "UUID1")
+    storage = app.extensions["flock_storage"]
+    notifications = []
+    app.extensions["flock_keybase_notifications"].add_many = notifications.extend
+    docs = [
+        {"hostIdentifier": "UUID1", "name": "launchd", "columns": {"n": n}}
+        for n in range(3)
+    ]
+
+    # Docs that failed aren't remembered, so resending them indexes them
+    index_docs = storage.index_docs
+    storage.index_docs = lambda actions, **kwargs: (
+        0,
+        [{"item": i, "status": 429, "error": "busy"} for i in range(len(actions))],
+    )
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.json["failed_count"] == 3
+    assert notifications == []
+
+    storage.index_docs = index_docs
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.json["indexed_count"] == 3
+    assert res.json["duplicate_count"] == 0
+    assert len(storage.docs()) == 3
+    assert [notification for notification, _ in notifications] == ["launchd"]
+
+    # Docs that ElasticSearch says were already indexed don't trigger notifications
+    app = create_api_app(
+        {"TESTING": True, "STORAGE": "memory", "IDEMPOTENT_INGEST": True}
+    )
+    app.extensions["flock_storage"].index_docs = index_docs
+    app.extensions["flock_keybase_notifications"].add_many = notifications.extend
+    res = app.test_client().post("/submit", json=docs, headers=auth_header)
+    assert res.json["duplicate_count"] == 3
+    assert [notification for notification, _ in notifications] == ["launchd"]
+
+
+def test_submit_async_ingest_idempotent(client):
+    app = create_api_app(
+        {
+            "TESTING": True,
+            "STORAGE": "memory",
+            "IDEMPOTENT_INGEST": True,
+            "ASYNC_INGEST": True,
+        }
+    )
+    client = app.test_client()
+    auth_header = get_auth_header(client, "UUID1")
+    storage = app.extensions["flock_storage"]
+    ingest_queue = app.extensions["flock_ingest_queue"]
+    notifications = []
+    app.extensions["flock_keybase_notifications"].add_many = notifications.extend
+    docs = [{"hostIdentifier": "UUID1", "name": "launchd", "columns": {"n": 1}}]
+
+    # Queued docs are remembered once they're indexed, if they're indexed
+    index_docs = storage.index_docs
+    storage.index_docs = lambda actions, **kwargs: (
+        0,
+        [{"item": i, "status": 400, "error": "bad"} for i in range(len(actions))],
+    )
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 202
+    ingest_queue.join()
+    assert notifications == []
+
+    storage.index_docs = index_docs
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.json["duplicate_count"] == 0
+    ingest_queue.join()
+    assert len(storage.docs()) == 1
+    assert [notification for notification, _ in notifications] == ["launchd"]
+
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.json["duplicate_count"] == 1
+    ingest_queue.join()
+    assert len(notifications) == 1
+
+
+def test_submit_async_ingest_queues_each_chunk(client):
+    app = create_api_app(
+        {
+            "TESTING": True,
+            "STORAGE": "memory",
+            "ASYNC_INGEST": True,
+            "BULK_CHUNK_SIZE": 2,
+            "INGEST_QUEUE_HIGH_WATER": 3,
+        }
+    )
+    client = app.test_client()
+    auth_header = get_auth_header(client, "UUID1")
+    storage = app.extensions["flock_storage"]
+    ingest_queue = app.extensions["flock_ingest_queue"]
+    notifications = []
+    app.extensions["flock_keybase_notifications"].add_many = notifications.extend
+
+    # The ingest queue's threads are stuck until the test lets them go
+    stuck = threading.Event()
+    index_docs = storage.index_docs
+
+    def stuck_index_docs(actions, **kwargs):
+        if threading.current_thread().name.startswith("flock-ingest"):
+            stuck.wait(5)
+        return index_docs(actions, **kwargs)
+
+    storage.index_docs = stuck_index_docs
+
+    # A body with more docs than the queue holds is accepted: the chunks that
+    # don't fit are indexed right away
+    docs = [{"hostIdentifier": "UUID1", "name": "launchd"}] * 7
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 202
+    assert res.json["processed_count"] == 7
+    assert ingest_queue.pending_docs == 3
+    assert len(storage.docs()) == 4
+    assert notifications == []
+
+    # While the queue is full, a new body is rejected before anything is queued
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 503
+    assert ingest_queue.pending_docs == 3
+
+    # Notifications are sent once every chunk is indexed
+    stuck.set()
+    ingest_queue.join()
+    assert len(storage.docs()) == 7
+    assert [notification for notification, _ in notifications] == ["launchd"]
+    assert notifications[0][1]["other_count"] == 7
+
+
+def test_submit_updates_host_state(client):
+    # Host states from earlier test runs are still indexed, so use a new host
+    username = f"UUID-{secrets.token_hex(4)}"
+    auth_header = get_auth_header(client, username)
+
+    app = create_api_app({"TESTING": True, "HOST_STATE_INTERVAL": 0})
+    client = app.test_client()
+    docs = [
+        {"hostIdentifier": username, "name": "uptime", "unixTime": 1587384000},
+        {
+            "hostIdentifier": username,
+            "name": "os_version",
+            "columns": {"name": "Mac OS X", "version": "10.15.4"},
+        },
+    ]
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 200
+    logs = [
+        {"type": "server_enabled", "timestamp": "2020-04-20T12:00:00"},
+        {"type": "enable_twig", "timestamp": "2020-04-20T12:00:00", "twig_id": "a"},
+    ]
+    res = client.post("/submit_flock_logs", json=logs, headers=auth_header)
+    assert res.status_code == 200
+
+    storage = app.extensions["flock_storage"]
+    host_state = storage.host_states([username])[username]
+    assert host_state["last_result_at"] == "2020-04-20T12:00:00.000Z"
+    assert host_state["os_version"] == {"name": "Mac OS X", "version": "10.15.4"}
+    assert host_state["server_enabled"] is True
+    assert host_state["twigs"] == {"a": True}
+    assert host_state["submit_count"] == 1
+    assert host_state["doc_count"] == 2
+    assert host_state["log_count"] == 2
+
+
+def test_metrics(client):
+    auth_header = get_auth_header(client)
+    client.post(
+        "/submit",
+        headers=auth_header,
+        json=[{"hostIdentifier": "UUID1", "name": "uptime"}],
+    )
+
+    # Metrics aren't served to agents
+    res = client.get("/metrics")
+    assert res.status_code == 404
+
+    metrics = render()
+    assert (
+        'flock_http_request_seconds_count{method="POST",route="/register",status="200"}'
+        in metrics
+    )
+    assert 'flock_elasticsearch_request_seconds_count{operation="auth_search"}' in metrics
+    assert 'flock_elasticsearch_request_seconds_count{operation="index"}' in metrics
+    assert 'flock_submitted_docs_total{outcome="indexed"}' in metrics
+    assert "flock_submit_batch_docs_count" in metrics
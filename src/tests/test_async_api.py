@@ -0,0 +1,127 @@
+import gzip
+import json
+import base64
+import pytest
+
+from elasticsearch_dsl import Index, Search
+from flock_server import identity_cache
+from flock_server import async_api
+
+if async_api.web is None:
+    pytest.skip("aiohttp isn't installed", allow_module_level=True)
+
+from aiohttp.test_utils import TestClient, TestServer
+
+
+async def start_client():
+    # Delete all users
+    Search(index="user").query("match_all").delete()
+    Index("user").refresh()
+    identity_cache.clear()
+
+    # Bodies are decompressed by the app, not aiohttp
+    server = TestServer(async_api.create_async_api_app({"TESTING": True}))
+    await server.start_server(auto_decompress=False)
+    client = TestClient(server)
+    await client.start_server()
+    return client
+
+
+async def get_auth_header(client, username="UUID1"):
+    res = await client.post("/register", json={"username": username})
+    auth_token = (await res.json())["auth_token"]
+
+    # Create authorization header
+    encoded_credentials = base64.b64encode(f"{username}:{auth_token}".encode()).decode()
+    return {"Authorization": f"Basic {encoded_credentials}"}
+
+
+@pytest.mark.asyncio
+async def test_async_register_and_ping():
+    client = await start_client()
+    try:
+        res = await client.get("/ping")
+        assert res.status == 401
+
+        auth_header = await get_auth_header(client)
+        res = await client.get("/ping", headers=auth_header)
+        assert res.status == 200
+        assert (await res.json())["error"] == False
+
+        res = await client.post("/register", json={"username": "UUID1"})
+        assert res.status == 400
+
+        res = await client.post("/register", json={"username": "no spaces"})
+        assert res.status == 400
+
+        res = await client.post(
+            "/register", headers={"Content-Type": "application/json"}, data="not json"
+        )
+        assert res.status == 400
+        assert (await res.json())["error"] == True
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_async_submit():
+    client = await start_client()
+    try:
+        auth_header = await get_auth_header(client)
+        docs = [
+            {"hostIdentifier": "UUID1", "name": "uptime", "unixTime": 1587000000},
+            {"hostIdentifier": "UUID1", "name": "uptime", "unixTime": 1587000001},
+        ]
+
+        res = await client.post("/submit", headers=auth_header, json=docs)
+        assert res.status == 200
+        data = await res.json()
+        assert data["processed_count"] == 2
+        assert data["indexed_count"] == 2
+        assert data["failed_count"] == 0
+
+        res = await client.post(
+            "/submit",
+            headers={**auth_header, "Content-Encoding": "gzip"},
+            data=gzip.compress(json.dumps(docs).encode()),
+        )
+        assert res.status == 200
+        assert (await res.json())["indexed_count"] == 2
+
+        res = await client.post(
+            "/submit", headers={**auth_header, "Content-Encoding": "br"}, data=b"[]"
+        )
+        assert res.status == 415
+
+        res = await client.post(
+            "/submit", headers=auth_header, json=[{"hostIdentifier": "UUID2"}]
+        )
+        assert res.status == 400
+        assert (await res.json())["error_msg"] == (
+            "Item 0 does not contain the correct hostIdentifier"
+        )
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_async_submit_flock_logs():
+    client = await start_client()
+    try:
+        auth_header = await get_auth_header(client)
+
+        res = await client.post(
+            "/submit_flock_logs",
+            headers=auth_header,
+            json=[{"type": "server_enabled", "timestamp": "2020-04-20T12:00:00"}],
+        )
+        assert res.status == 200
+        assert (await res.json())["processed_count"] == 1
+
+        res = await client.post(
+            "/submit_flock_logs", headers=auth_header, json={"type": "server_enabled"}
+        )
+        assert res.status == 400
+        assert (await res.json())["error_msg"] == "Data is not an array"
+    finally:
+        await client.close()
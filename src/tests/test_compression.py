@@ -0,0 +1,58 @@
+import gzip
+import json
+import pytest
+from flask import Flask, request
+
+from flock_server.compression import DecompressionMiddleware, zstandard
+
+
+@pytest.fixture
+def echo_client():
+    app = Flask(__name__)
+
+    @app.route("/submit", methods=["POST"])
+    def submit():
+        return {"body": request.get_data().decode()}
+
+    app.wsgi_app = DecompressionMiddleware(app.wsgi_app, ["/submit"], 4096)
+    return app.test_client()
+
+
+def test_uncompressed(echo_client):
+    res = echo_client.post("/submit", data="[]")
+    assert json.loads(res.data)["body"] == "[]"
+
+
+def test_gzip(echo_client):
+    res = echo_client.post(
+        "/submit", data=gzip.compress(b"[1, 2, 3]"), headers={"Content-Encoding": "gzip"}
+    )
+    assert res.status_code == 200
+    assert json.loads(res.data)["body"] == "[1, 2, 3]"
+
+
+@pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")
+def test_zstd(echo_client):
+    data = zstandard.ZstdCompressor().compress(b"[1, 2, 3]")
+    res = echo_client.post("/submit", data=data, headers={"Content-Encoding": "zstd"})
+    assert res.status_code == 200
+    assert json.loads(res.data)["body"] == "[1, 2, 3]"
+
+
+def test_unsupported_encoding(echo_client):
+    res = echo_client.post("/submit", data="[]", headers={"Content-Encoding": "br"})
+    assert res.status_code == 415
+
+
+def test_invalid_gzip(echo_client):
+    res = echo_client.post(
+        "/submit", data="not gzip", headers={"Content-Encoding": "gzip"}
+    )
+    assert res.status_code == 400
+
+
+def test_decompression_bomb(echo_client):
+    data = gzip.compress(b" " * 1024 * 1024)
+    assert len(data) < 4096
+    res = echo_client.post("/submit", data=data, headers={"Content-Encoding": "gzip"})
+    assert res.status_code == 413
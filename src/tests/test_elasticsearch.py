@@ -0,0 +1,35 @@
+import socket
+
+from elasticsearch_dsl import connections
+
+from flock_server.elasticsearch import (
+    es,
+    operation_timeouts,
+    request_timeout,
+    reset_connections,
+)
+
+
+def test_clients_share_one_pool():
+    assert connections.get_connection() is es
+
+    # Like a gateway worker after it's forked
+    pool = es.transport.connection_pool
+    reset_connections()
+    assert es.transport.connection_pool is not pool
+    assert connections.get_connection().transport.connection_pool is (
+        es.transport.connection_pool
+    )
+    assert es.ping()
+
+
+def test_connections_keep_alive():
+    connection = es.transport.get_connection()
+    options = connection.pool.conn_kw["socket_options"]
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in options
+
+
+def test_request_timeout(monkeypatch):
+    monkeypatch.setitem(operation_timeouts, "index", 60)
+    assert request_timeout("index") == 60
+    assert request_timeout("auth_search") == 20
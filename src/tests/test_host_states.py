@@ -0,0 +1,89 @@
+import pytest
+
+from flock_server import MemoryStorage
+from flock_server.host_states import HostStateTracker, merge_host_state
+
+
+class FailingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.fail = True
+
+    def update_host_states(self, updates):
+        if self.fail:
+            raise ConnectionError("ElasticSearch is down")
+        super().update_host_states(updates)
+
+
+def test_merge_host_state():
+    state = {}
+    merge_host_state(
+        state,
+        {
+            "last_seen": "2020-04-20T12:00:00.000Z",
+            "os_version": {"name": "Mac OS X", "version": "10.15.3"},
+            "twigs": {"a": True, "b": True},
+            "submit_count": 1,
+        },
+    )
+    merge_host_state(
+        state,
+        {
+            "last_seen": "2020-04-20T11:59:59.000Z",
+            "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+            "twigs": {"b": False},
+            "submit_count": 2,
+        },
+    )
+    assert state == {
+        "last_seen": "2020-04-20T12:00:00.000Z",
+        "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+        "twigs": {"a": True, "b": False},
+        "submit_count": 3,
+    }
+
+
+def test_tracker_coalesces_updates():
+    storage = MemoryStorage()
+    tracker = HostStateTracker(storage, interval=3600)
+
+    for i in range(10):
+        tracker.update("UUID1", {"submit_count": 1, "doc_count": i})
+    tracker.update("UUID2", {"log_count": 1, "server_enabled": True})
+    assert tracker.pending_hosts == 2
+    assert storage.host_states(["UUID1", "UUID2"]) == {}
+
+    tracker.flush()
+    assert tracker.pending_hosts == 0
+    host_states = storage.host_states(["UUID1", "UUID2"])
+    assert host_states["UUID1"]["submit_count"] == 10
+    assert host_states["UUID1"]["doc_count"] == 45
+    assert "last_seen" in host_states["UUID1"]
+    assert host_states["UUID2"]["server_enabled"] is True
+
+    # Nothing is written when nothing changed
+    tracker.flush()
+    assert storage.host_states(["UUID1"])["UUID1"]["submit_count"] == 10
+
+
+def test_tracker_keeps_updates_that_fail():
+    storage = FailingStorage()
+    tracker = HostStateTracker(storage, interval=3600)
+
+    tracker.update("UUID1", {"submit_count": 1, "server_enabled": True})
+    with pytest.raises(ConnectionError):
+        tracker.flush()
+    tracker.update("UUID1", {"submit_count": 1, "server_enabled": False})
+
+    storage.fail = False
+    tracker.flush()
+    host_state = storage.host_states(["UUID1"])["UUID1"]
+    assert host_state["submit_count"] == 2
+    assert host_state["server_enabled"] is False
+
+
+def test_tracker_without_interval():
+    storage = MemoryStorage()
+    tracker = HostStateTracker(storage, interval=0)
+    tracker.update("UUID1", {"submit_count": 1})
+    assert storage.host_states(["UUID1"])["UUID1"]["submit_count"] == 1
@@ -0,0 +1,95 @@
+import time
+
+from flock_server.identity_cache import IdentityCache, UserChangeWatcher
+from flock_server.storage import MemoryStorage
+
+
+class UserStub:
+    def __init__(self, name):
+        self.name = name
+
+
+def test_caches_valid_users():
+    cache = IdentityCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return UserStub("Nick Fury")
+
+    assert cache.get("UUID1", "token", load).name == "Nick Fury"
+    assert cache.get("UUID1", "token", load).name == "Nick Fury"
+    assert len(loads) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_does_not_cache_invalid_credentials():
+    cache = IdentityCache()
+    assert cache.get("UUID1", "bad_token", lambda: None) is None
+    assert cache.get("UUID1", "bad_token", lambda: UserStub("Nick Fury")) is not None
+    assert cache.stats()["misses"] == 2
+
+
+def test_entries_expire():
+    cache = IdentityCache(ttl=0.01)
+    cache.get("UUID1", "token", lambda: UserStub("Nick Fury"))
+    time.sleep(0.02)
+    assert cache.get("UUID1", "token", lambda: UserStub("Jessica Jones")).name == (
+        "Jessica Jones"
+    )
+
+
+def test_size_is_bounded():
+    cache = IdentityCache(max_size=2)
+    for username in ["UUID1", "UUID2", "UUID3"]:
+        cache.get(username, "token", lambda: UserStub(username))
+    assert cache.stats()["size"] == 2
+
+    # The least recently used user was evicted
+    assert cache.get("UUID1", "token", lambda: None) is None
+
+
+def test_invalidate():
+    cache = IdentityCache()
+    cache.get("UUID1", "token", lambda: UserStub("Nick Fury"))
+    cache.get("UUID2", "token", lambda: UserStub("Jessica Jones"))
+    cache.invalidate("UUID1")
+    assert cache.get("UUID1", "token", lambda: UserStub("Luke Cage")).name == (
+        "Luke Cage"
+    )
+    assert cache.get("UUID2", "token", lambda: None).name == "Jessica Jones"
+
+
+def test_invalidate_while_loading():
+    cache = IdentityCache()
+
+    # The bot deletes the user while a lookup is in flight
+    def load():
+        cache.invalidate("UUID1")
+        return UserStub("Nick Fury")
+
+    assert cache.get("UUID1", "token", load).name == "Nick Fury"
+    assert cache.get("UUID1", "token", lambda: None) is None
+
+
+def test_user_change_watcher():
+    storage = MemoryStorage()
+    storage.add_user("UUID1", "Nick Fury", "token1")
+    storage.add_user("UUID2", "Jessica Jones", "token2")
+    cache = IdentityCache()
+    watcher = UserChangeWatcher(storage, cache)
+    for username, token in [("UUID1", "token1"), ("UUID2", "token2")]:
+        cache.get(username, token, lambda: storage.get_user(username, token))
+
+    # Like the Keybase bot, in another process
+    storage.rename_user("UUID1", "Carol Danvers")
+    storage.delete_user("UUID2")
+    watcher.check()
+    assert cache.stats()["size"] == 0
+    assert cache.get("UUID1", "token1", lambda: storage.get_user("UUID1")).name == (
+        "Carol Danvers"
+    )
+
+    # Changes are only acted on once
+    watcher.check()
+    assert cache.stats()["size"] == 1
@@ -0,0 +1,60 @@
+import time
+import calendar
+
+from flock_server.elasticsearch import es
+from flock_server.indices import (
+    IndexRouter,
+    flock_template,
+    install_flock_template,
+    rollover_alias,
+)
+
+
+def test_routes_by_event_time():
+    router = IndexRouter()
+    now = calendar.timegm((2020, 4, 20, 12, 0, 0))
+
+    # Late uploads go into the day they happened
+    doc = {"unixTime": str(calendar.timegm((2020, 4, 18, 23, 59, 59)))}
+    assert router.index_for(doc, now) == "flock-2020-04-18"
+    assert router.index_for({"unixTime": now}, now) == "flock-2020-04-20"
+
+    # Docs without a usable time go into today's index
+    assert router.index_for({}, now) == "flock-2020-04-20"
+    assert router.index_for({"unixTime": "yesterday"}, now) == "flock-2020-04-20"
+
+
+def test_routes_bad_clocks_to_today():
+    router = IndexRouter(max_event_age_days=30)
+    now = calendar.timegm((2020, 4, 20, 12, 0, 0))
+
+    assert router.index_for({"unixTime": 0}, now) == "flock-2020-04-20"
+    assert router.index_for({"unixTime": now + 7 * 86400}, now) == "flock-2020-04-20"
+    assert router.index_for({"unixTime": now - 29 * 86400}, now) == "flock-2020-03-22"
+
+
+def test_routes_to_rollover_alias():
+    router = IndexRouter(rollover=True)
+    assert router.index_for({"unixTime": time.time()}) == rollover_alias
+
+
+def test_template_settings():
+    template = flock_template(
+        shards=2, replicas=0, refresh_interval="60s", codec="default", rollover=False
+    )
+    assert template["index_patterns"] == ["flock-*"]
+    assert template["settings"]["index.number_of_shards"] == 2
+    assert template["settings"]["index.number_of_replicas"] == 0
+    assert template["settings"]["index.refresh_interval"] == "60s"
+    assert "index.lifecycle.name" not in template["settings"]
+
+    template = flock_template(rollover=True)
+    assert template["settings"]["index.codec"] == "best_compression"
+    assert template["settings"]["index.lifecycle.rollover_alias"] == rollover_alias
+
+
+def test_install_flock_template():
+    install_flock_template(rollover=False, log=lambda msg: None)
+    template = es.indices.get_template(name="flock")["flock"]
+    assert template["index_patterns"] == ["flock-*"]
+    assert template["settings"]["index"]["codec"] == "best_compression"
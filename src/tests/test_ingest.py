@@ -0,0 +1,236 @@
+import io
+import json
+import pytest
+
+from flock_server.indices import IndexRouter
+from flock_server.ingest import (
+    IngestError,
+    Batch,
+    ConvertUnixTime,
+    RecentIds,
+    osquery_pipeline,
+    flock_log_pipeline,
+)
+from flock_server.keybase_notifications import KeybaseNotifications
+
+
+def chunks(pipeline, docs, batch, chunk_size=2):
+    body = io.BytesIO(json.dumps(docs).encode())
+    results = []
+    for chunk in pipeline.chunks(body, batch, chunk_size):
+        results.append(chunk)
+        batch.commit()
+    return results
+
+
+def test_osquery_pipeline():
+    pipeline = osquery_pipeline(
+        KeybaseNotifications(), router=IndexRouter(max_event_age_days=100000)
+    )
+    batch = Batch("UUID1", "Test User")
+    docs = [
+        {"hostIdentifier": "UUID1", "name": "uptime", "unixTime": 1587384000},
+        {"hostIdentifier": "UUID1", "name": "launchd", "action": "added"},
+        {"hostIdentifier": "UUID1", "name": "launchd", "action": "removed"},
+        {
+            "hostIdentifier": "UUID1",
+            "name": "os_version",
+            "action": "snapshot",
+            "unixTime": 1587383000,
+            "snapshot": [{"name": "Mac OS X", "version": "10.15.4"}],
+        },
+    ]
+
+    results = chunks(pipeline, docs, batch)
+    assert [len(chunk) for chunk in results] == [2, 2]
+    action = results[0][0]
+    assert action["_index"] == "flock-2020-04-20"
+    assert action["_source"]["@timestamp"] == "2020-04-20T12:00:00.000Z"
+    assert action["_source"]["username"] == "UUID1"
+    assert action["_source"]["user_name"] == "Test User"
+
+    notifications = batch.notifications()
+    assert [notification for notification, _ in notifications] == [
+        "launchd",
+        "os_version",
+    ]
+    assert notifications[0][1] == {
+        "type": "summary",
+        "username": "UUID1",
+        "name": "Test User",
+        "added_count": 1,
+        "removed_count": 1,
+        "other_count": 0,
+    }
+    assert batch.host_state == {
+        "last_result_at": "2020-04-20T12:00:00.000Z",
+        "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+    }
+
+
+def test_osquery_pipeline_errors():
+    pipeline = osquery_pipeline(KeybaseNotifications())
+    batch = Batch("UUID1", "Test User")
+
+    with pytest.raises(IngestError, match="Data is not an array"):
+        chunks(pipeline, {"hostIdentifier": "UUID1"}, batch)
+    with pytest.raises(IngestError, match="Invalid JSON object"):
+        chunks(pipeline, [], batch)
+    with pytest.raises(IngestError, match="Item 1 is not an object"):
+        chunks(pipeline, [{"hostIdentifier": "UUID1"}, "uptime"], batch)
+    with pytest.raises(IngestError, match="Invalid JSON object"):
+        chunks(pipeline, [{"hostIdentifier": "UUID1", "unixTime": "soon"}], batch)
+
+    # Nothing is yielded before the whole body is validated
+    batch = Batch("UUID1", "Test User")
+    docs = [
+        {"hostIdentifier": "UUID1", "name": "launchd"},
+        {"hostIdentifier": "UUID1", "name": "launchd"},
+        {"hostIdentifier": "UUID1", "name": "os_version"},
+        {"hostIdentifier": "UUID2", "name": "os_version"},
+    ]
+    results = []
+    with pytest.raises(IngestError, match="Item 3 does not contain the correct"):
+        for chunk in pipeline.chunks(io.BytesIO(json.dumps(docs).encode()), batch, 2):
+            results.append(chunk)
+    assert results == []
+    assert batch.notifications() == []
+
+
+def test_osquery_pipeline_chunks():
+    pipeline = osquery_pipeline(KeybaseNotifications())
+    pipeline.max_buffer_memory = 10
+    docs = [{"hostIdentifier": "UUID1", "name": "launchd"}] * 4 + [
+        {"hostIdentifier": "UUID1", "name": "os_version"}
+    ]
+
+    # Chunks are buffered until the whole body is validated, and each chunk's docs
+    # are committed in order
+    batch = Batch("UUID1", "Test User")
+    body = io.BytesIO(json.dumps(docs).encode())
+    chunk_iter = pipeline.chunks(body, batch, 2)
+    assert len(next(chunk_iter)) == 2
+    assert batch.doc_count == 5
+    assert batch.notifications() == []
+    batch.commit()
+    assert [notification for notification, _ in batch.notifications()] == [
+        "launchd"
+    ]
+    assert [len(chunk) for chunk in chunk_iter] == [2, 1]
+
+    # Docs in chunks that were never committed don't trigger notifications
+    batch.commit()
+    assert [notification for notification, _ in batch.notifications()] == [
+        "launchd"
+    ]
+    assert batch.notifications()[0][1]["other_count"] == 4
+
+
+def test_osquery_pipeline_commits_only_indexed_docs():
+    pipeline = osquery_pipeline(KeybaseNotifications())
+    docs = [
+        {"hostIdentifier": "UUID1", "name": "launchd", "action": "added"},
+        {"hostIdentifier": "UUID1", "name": "launchd", "action": "removed"},
+        {"hostIdentifier": "UUID1", "name": "crontab", "action": "added"},
+        {"hostIdentifier": "UUID1", "name": "crontab", "action": "added"},
+    ]
+    batch = Batch("UUID1", "Test User")
+    list(pipeline.chunks(io.BytesIO(json.dumps(docs).encode()), batch, 10))
+
+    # The first launchd doc failed, and the second crontab one was already indexed
+    batch.commit(failures=[{"item": 0}], duplicates=[{"item": 3}])
+    notifications = dict(batch.notifications())
+    assert notifications["crontab"]["action"] == "added"
+
+    # Only the first doc of each type is kept, so the remaining launchd doc is
+    # reported as a summary
+    assert notifications["launchd"] == {
+        "type": "summary",
+        "username": "UUID1",
+        "name": "Test User",
+        "added_count": 0,
+        "removed_count": 1,
+        "other_count": 0,
+    }
+
+
+def test_osquery_pipeline_skips_duplicates():
+    recent_ids = RecentIds(max_size=3)
+    pipeline = osquery_pipeline(
+        KeybaseNotifications(), router=IndexRouter(), recent_ids=recent_ids
+    )
+    docs = [
+        {"hostIdentifier": "UUID1", "name": "launchd", "columns": {"n": 1}},
+        {"hostIdentifier": "UUID1", "name": "launchd", "columns": {"n": 1}},
+        {"hostIdentifier": "UUID1", "name": "launchd", "columns": {"n": 2}},
+    ]
+
+    batch = Batch("UUID1", "Test User")
+    actions = [action for chunk in chunks(pipeline, docs, batch) for action in chunk]
+    assert len(actions) == 2
+    assert actions[0]["_op_type"] == "create"
+    assert actions[0]["_id"] != actions[1]["_id"]
+    assert batch.duplicate_count == 1
+    assert len(recent_ids) == 2
+
+    # The same docs sent again are all skipped, and don't trigger notifications
+    batch = Batch("UUID1", "Test User")
+    assert chunks(pipeline, docs, batch) == []
+    batch.commit()
+    assert batch.duplicate_count == 3
+    assert batch.notifications() == []
+
+    # Docs that weren't committed can be sent again
+    batch = Batch("UUID1", "Test User")
+    new_docs = [{"hostIdentifier": "UUID1", "name": "launchd", "columns": {"n": 3}}]
+    list(pipeline.run(new_docs, batch))
+    assert len(recent_ids) == 2
+    assert len(list(pipeline.run(new_docs, Batch("UUID1", "Test User")))) == 1
+
+
+def test_track_host_state_ignores_odd_snapshots():
+    pipeline = osquery_pipeline(KeybaseNotifications())
+    batch = Batch("UUID1", "Test User")
+    docs = [
+        {"hostIdentifier": "UUID1", "name": "os_version", "snapshot": snapshot}
+        for snapshot in [{"name": "Mac OS X"}, "10.15.4", [], ["10.15.4"]]
+    ]
+    chunks(pipeline, docs, batch)
+    assert batch.host_state == {}
+
+
+def test_convert_unix_time():
+    convert = ConvertUnixTime(max_cached=2)
+    for unix_time in [0, 1587384000, 1587384000, 1587384001, "1587384002"]:
+        doc = {"unixTime": unix_time}
+        convert(0, doc, None)
+        assert doc["@timestamp"].endswith(".000Z")
+    assert doc["@timestamp"] == "2020-04-20T12:00:02.000Z"
+    assert len(convert._cache) <= 2
+
+    doc = {}
+    convert(0, doc, None)
+    assert "@timestamp" not in doc
+
+    with pytest.raises(ValueError):
+        convert(0, {"unixTime": 10 ** 20}, None)
+
+
+def test_flock_log_pipeline():
+    pipeline = flock_log_pipeline()
+    batch = Batch("UUID1", "Test User")
+    docs = [
+        {"type": "server_enabled", "timestamp": "2020-04-20T12:00:00"},
+        {"type": "enable_twig", "timestamp": "2020-04-20T12:00:00", "twig_id": "a"},
+        {"type": "twigs_enabled", "timestamp": "2020-04-20T12:00:00", "twig_ids": []},
+    ]
+    assert list(pipeline.run(docs, batch)) == docs
+    batch.commit()
+    assert batch.host_state == {"server_enabled": True, "twigs": {"a": True}}
+    assert batch.notifications() == [
+        ("server_enabled", {"username": "UUID1", "name": "Test User"}),
+        ("twigs_enabled", {"username": "UUID1", "name": "Test User", "twig_ids": []}),
+    ]
+
+    with pytest.raises(IngestError, match="does not contain a twig_id field"):
+        list(pipeline.run([{"type": "disable_twig", "timestamp": "now"}], batch))
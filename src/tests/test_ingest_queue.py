@@ -0,0 +1,102 @@
+import threading
+
+from flock_server.ingest_queue import IngestQueue
+
+
+def test_indexes_queued_batches():
+    indexed = []
+
+    def index_func(actions):
+        indexed.extend(actions)
+        return len(actions), [], []
+
+    ingest_queue = IngestQueue(index_func, workers=2)
+    for i in range(10):
+        assert ingest_queue.put([{"_source": {"batch": i}}] * 3)
+    ingest_queue.join()
+
+    assert len(indexed) == 30
+    assert ingest_queue.pending_docs == 0
+
+
+def test_rejects_batches_when_full():
+    release = threading.Event()
+
+    def index_func(actions):
+        release.wait()
+        return len(actions), [], []
+
+    ingest_queue = IngestQueue(index_func, workers=1, max_batches=2, high_water=100)
+
+    # The worker takes the first batch, and the queue holds the next two
+    assert ingest_queue.put([{}])
+    while ingest_queue._queue.qsize() > 0:
+        pass
+    assert ingest_queue.put([{}])
+    assert ingest_queue.put([{}])
+    assert not ingest_queue.put([{}])
+
+    release.set()
+    ingest_queue.join()
+    assert ingest_queue.put([{}])
+    ingest_queue.join()
+
+
+def test_rejects_batches_above_high_water():
+    release = threading.Event()
+
+    def index_func(actions):
+        release.wait()
+        return len(actions), [], []
+
+    ingest_queue = IngestQueue(index_func, workers=1, high_water=5)
+    assert ingest_queue.put([{}] * 4)
+    assert not ingest_queue.put([{}] * 2)
+    assert ingest_queue.put([{}])
+
+    release.set()
+    ingest_queue.join()
+
+
+def test_survives_index_errors():
+    calls = []
+
+    def index_func(actions):
+        calls.append(actions)
+        raise Exception("ElasticSearch is down")
+
+    ingest_queue = IngestQueue(index_func, workers=1)
+    assert ingest_queue.put([{}])
+    ingest_queue.join()
+    assert ingest_queue.put([{}])
+    ingest_queue.join()
+    assert len(calls) == 2
+    assert ingest_queue.pending_docs == 0
+
+
+def test_reports_each_batchs_failures():
+    release = threading.Event()
+    reports = []
+
+    def index_func(actions):
+        release.wait()
+        failures = [{"item": i, "status": 400} for i in [1, 3]]
+        duplicates = [{"item": 2, "status": 409}]
+        return len(actions) - 3, failures, duplicates
+
+    ingest_queue = IngestQueue(index_func, workers=1)
+
+    # The worker takes the first batch, and merges the next two
+    assert ingest_queue.put([{}], lambda *report: reports.append(("a", report)))
+    while ingest_queue._queue.qsize() > 0:
+        pass
+    assert ingest_queue.put([{}] * 2, lambda *report: reports.append(("b", report)))
+    assert ingest_queue.put([{}] * 2, lambda *report: reports.append(("c", report)))
+    release.set()
+    ingest_queue.join()
+
+    assert reports == [
+        ("a", ([], [])),
+        ("b", ([{"item": 1, "status": 400}], [])),
+        ("c", ([{"item": 1, "status": 400}], [{"item": 0, "status": 409}])),
+    ]
@@ -1,8 +1,21 @@
 import os
+import json
 import time
 import pytest
 import asyncio
 import pykeybasebot
+from datetime import datetime, timedelta
+from elasticsearch_dsl import Index, Search
+
+from flock_server import KeybaseNotifications, MemoryStorage
+from flock_server.elasticsearch import KeybaseNotification
+from flock_server.keybase import (
+    ChatSender,
+    deliver_notifications,
+    format_host_state,
+    pack_messages,
+    truncate_message,
+)
 
 
 def create_event(sender_username, body, members_type=None):
@@ -98,6 +111,26 @@ async def test_list_users_with_users(client, handler, bot):
     assert bot.said("Jessica Jones")
 
 
+def test_format_host_state():
+    assert format_host_state({}) == {}
+    assert format_host_state(
+        {
+            "last_seen": "2020-04-20T12:01:00.000Z",
+            "last_result_at": "2020-04-20T12:00:00.000Z",
+            "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+            "server_enabled": False,
+            "twigs": {"b": True, "a": True, "c": False},
+            "submit_count": 10,
+        }
+    ) == {
+        "last_seen": "2020-04-20T12:01:00.000Z",
+        "last_updated": "2020-04-20T12:00:00.000Z",
+        "os_version": "Mac OS X 10.15.4",
+        "server": "disabled",
+        "twigs": "a, b",
+    }
+
+
 @pytest.mark.asyncio
 async def test_rename_user_invalid_username(client, handler, bot):
     res = client.post("/register", json={"username": "UUID1", "name": "Nick Fury"})
@@ -244,3 +277,248 @@ async def test_disable_notification(keybase_notifications, handler, bot):
     await handler.__call__(bot, event)
     assert bot.said(":x: **user_registered**")
     assert bot.said(":white_check_mark: **user_already_exists**")
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_backlog(keybase_notifications, bot):
+    Search(index="keybase_notification").query("match_all").delete()
+    keybase_notifications.add_many(
+        [("user_registered", {"username": f"UUID{i}", "name": ""}) for i in range(25)]
+    )
+    Index("keybase_notification").refresh()
+
+    # Deliver in pages of 10, with at most 20 per cycle. Each page fits in one
+    # message.
+    backlog = await deliver_notifications(
+        "conv_id", bot, keybase_notifications, page_size=10, max_per_cycle=20
+    )
+    assert backlog
+    assert len(bot.chat.sent_messages) == 2
+
+    backlog = await deliver_notifications(
+        "conv_id", bot, keybase_notifications, page_size=10, max_per_cycle=20
+    )
+    assert not backlog
+    assert len(bot.chat.sent_messages) == 3
+    for i in range(25):
+        assert (
+            sum(f"UUID{i}\"" in message for message in bot.chat.sent_messages) == 1
+        )
+
+
+def notification(i):
+    return KeybaseNotification(
+        notification_type="user_registered",
+        details=json.dumps({"username": f"UUID{i}", "name": ""}),
+        delivered=False,
+        created_at=datetime.now(),
+    )
+
+
+class FlakyBot:
+    """
+    Stub for pykeybasebot.Bot, where sending fails the first failures times
+    """
+
+    def __init__(self, failures):
+        bot = self
+
+        class Chat:
+            async def send(self, channel, message):
+                if bot.failures > 0:
+                    bot.failures -= 1
+                    raise asyncio.exceptions.TimeoutError()
+                bot.sent_messages.append(message)
+
+        self.failures = failures
+        self.sent_messages = []
+        self.chat = Chat()
+
+
+def test_pack_messages():
+    notifications = [([i], "x" * size) for i, size in enumerate([8, 8, 20, 6, 40])]
+    assert [
+        (len(message), packed) for message, packed in pack_messages(notifications, 20)
+    ] == [(18, [0, 1]), (20, [2]), (6, [3]), (16, [4])]
+    assert pack_messages([], 20) == []
+
+
+def test_truncate_message():
+    assert truncate_message("short", 100) == "short"
+    message = truncate_message("```\n" + "é" * 100 + "```", 50)
+    assert len(message.encode()) <= 50
+    assert message.count("```") == 2
+    assert message.endswith("(truncated)")
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_retries():
+    storage = MemoryStorage()
+    keybase_notifications = KeybaseNotifications(storage=storage)
+    storage.add_notifications([notification(i) for i in range(5)])
+
+    bot = FlakyBot(failures=2)
+    backlog = await deliver_notifications(
+        "conv_id", bot, keybase_notifications, retries=2, retry_delay=0
+    )
+    assert not backlog
+    assert len(bot.sent_messages) == 1
+    assert storage.count_undelivered() == 0
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_only_marks_sent_messages():
+    storage = MemoryStorage()
+    keybase_notifications = KeybaseNotifications(storage=storage)
+    storage.add_notifications([notification(i) for i in range(6)])
+
+    # Each message fits two notifications, and the first one can't be sent, so
+    # nothing newer is sent before it
+    formatted = keybase_notifications.format("user_registered", notification(0).details)
+    options = dict(
+        max_message_bytes=2 * len(formatted) + 2,
+        retries=1,
+        retry_delay=0,
+    )
+    bot = FlakyBot(failures=2)
+    backlog = await deliver_notifications(
+        "conv_id", bot, keybase_notifications, **options
+    )
+    assert not backlog
+    assert bot.sent_messages == []
+    assert storage.count_undelivered() == 6
+
+    # They're delivered in order in the next cycle, with the ones that failed
+    # sent on their own
+    await deliver_notifications("conv_id", bot, keybase_notifications, **options)
+    assert storage.count_undelivered() == 0
+    assert [
+        [f"UUID{i}\"" in message for i in range(6)].index(True)
+        for message in bot.sent_messages
+    ] == [0, 1, 2, 4]
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_sets_failing_ones_aside():
+    storage = MemoryStorage()
+    keybase_notifications = KeybaseNotifications(storage=storage)
+    storage.add_notifications([notification(i) for i in range(25)])
+
+    class Chat:
+        def __init__(self):
+            self.sent_messages = []
+            self.broken = True
+
+        async def send(self, channel, message):
+            # The first notification can't be sent until Keybase is fixed
+            if self.broken and "UUID0\"" in message:
+                raise asyncio.exceptions.TimeoutError()
+            self.sent_messages.append(message)
+
+    class Bot:
+        chat = Chat()
+
+    bot = Bot()
+    options = dict(page_size=10, retries=0, retry_delay=0, max_attempts=2)
+    await deliver_notifications("conv_id", bot, keybase_notifications, **options)
+    assert bot.chat.sent_messages == []
+    assert storage.count_undelivered() == 25
+
+    # Then the first page is sent one notification at a time, and the one that
+    # keeps failing is set aside, but not marked delivered
+    await deliver_notifications("conv_id", bot, keybase_notifications, **options)
+    assert storage.count_undelivered() == 1
+    assert len(bot.chat.sent_messages) == 11
+    for i in range(1, 10):
+        assert f"UUID{i}\"" in bot.chat.sent_messages[i - 1]
+    assert "UUID10\"" in bot.chat.sent_messages[9]
+    assert "UUID20\"" in bot.chat.sent_messages[10]
+    (failing,) = storage.undelivered_notifications(10)
+    assert failing.attempts == 2
+    assert failing.next_attempt_at > datetime.now()
+
+    # It isn't tried again until it's due
+    bot.chat.broken = False
+    await deliver_notifications("conv_id", bot, keybase_notifications, **options)
+    assert len(bot.chat.sent_messages) == 11
+
+    failing.next_attempt_at = datetime.now()
+    await deliver_notifications("conv_id", bot, keybase_notifications, **options)
+    assert storage.count_undelivered() == 0
+    assert "UUID0\"" in bot.chat.sent_messages[11]
+
+
+@pytest.mark.asyncio
+async def test_chat_sender():
+    sender = ChatSender(concurrency=2)
+    sending = []
+    max_sending = [0]
+    sent = []
+
+    class Chat:
+        async def send(self, channel, message):
+            sending.append(channel)
+            max_sending[0] = max(max_sending[0], len(sending))
+            await asyncio.sleep(0.01)
+            sending.remove(channel)
+            sent.append((channel, message))
+
+    class Bot:
+        chat = Chat()
+
+    # Up to two messages are sent at once, but only one per conversation
+    await asyncio.gather(
+        *[
+            sender.send(Bot(), channel, i)
+            for i in range(3)
+            for channel in ["a", "b", "c"]
+        ]
+    )
+    assert max_sending[0] == 2
+    for channel in ["a", "b", "c"]:
+        assert [message for c, message in sent if c == channel] == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_window():
+    storage = MemoryStorage()
+    keybase_notifications = KeybaseNotifications(storage=storage, window=3600)
+
+    def doc(action, created_at):
+        return KeybaseNotification(
+            notification_type="installed_applications",
+            details=json.dumps(
+                {
+                    "hostIdentifier": "UUID1",
+                    "user_name": "Nick Fury",
+                    "action": action,
+                    "calendarTime": "",
+                    "columns": {},
+                }
+            ),
+            delivered=False,
+            created_at=created_at,
+        )
+
+    # Held until an hour after the first one
+    storage.add_notifications([doc("added", datetime.now())])
+    bot = FlakyBot(failures=0)
+    await deliver_notifications("conv_id", bot, keybase_notifications)
+    assert bot.sent_messages == []
+    assert storage.count_undelivered() == 1
+    assert keybase_notifications.window.closes_at > datetime.now()
+
+    # Then merged into one summary
+    storage = MemoryStorage()
+    keybase_notifications = KeybaseNotifications(storage=storage, window=3600)
+    created_at = datetime.now() - timedelta(seconds=3600)
+    storage.add_notifications(
+        [doc("added", created_at), doc("removed", created_at), notification(0)]
+    )
+    await deliver_notifications("conv_id", bot, keybase_notifications)
+    assert len(bot.sent_messages) == 1
+    assert "**1** added" in bot.sent_messages[0]
+    assert "**1** removed" in bot.sent_messages[0]
+    assert "UUID0" in bot.sent_messages[0]
+    assert storage.count_undelivered() == 0
+    assert keybase_notifications.window.closes_at is None
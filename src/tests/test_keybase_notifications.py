@@ -0,0 +1,159 @@
+import json
+from datetime import timedelta
+
+from flock_server import KeybaseNotifications, MemoryStorage
+
+
+def test_settings_are_cached(monkeypatch):
+    keybase_notifications = KeybaseNotifications(settings_ttl=60)
+    loads = []
+
+    def load_settings(refresh):
+        loads.append(refresh)
+        return keybase_notifications._get_default_settings()
+
+    monkeypatch.setattr(
+        keybase_notifications, "_load_settings_without_caching", load_settings
+    )
+
+    for _ in range(10):
+        assert keybase_notifications._is_enabled("reverse_shell")
+    assert not keybase_notifications._is_enabled("not_a_notification")
+
+    # The settings were loaded once, without refreshing the index
+    assert loads == [False]
+
+
+def test_settings_cache_expires(monkeypatch):
+    keybase_notifications = KeybaseNotifications(settings_ttl=0)
+    loads = []
+
+    def load_settings(refresh):
+        loads.append(refresh)
+        return keybase_notifications._get_default_settings()
+
+    monkeypatch.setattr(
+        keybase_notifications, "_load_settings_without_caching", load_settings
+    )
+
+    keybase_notifications._is_enabled("reverse_shell")
+    keybase_notifications._is_enabled("reverse_shell")
+    assert loads == [False, False]
+
+
+def test_add_many_is_one_bulk_request(monkeypatch):
+    keybase_notifications = KeybaseNotifications(settings_ttl=60)
+    settings = keybase_notifications._get_default_settings()
+    settings["os_version"] = False
+    monkeypatch.setattr(
+        keybase_notifications, "_load_settings_without_caching", lambda r: settings
+    )
+
+    bulk_requests = []
+    monkeypatch.setattr(
+        "flock_server.storage.bulk",
+        lambda es, actions, **kwargs: bulk_requests.append(actions),
+    )
+
+    keybase_notifications.add_many(
+        [
+            ("launchd", {"username": "UUID1"}),
+            ("os_version", {"username": "UUID1"}),
+            ("crontab", {"username": "UUID1"}),
+        ]
+    )
+    assert len(bulk_requests) == 1
+    assert [action["_source"]["notification_type"] for action in bulk_requests[0]] == [
+        "launchd",
+        "crontab",
+    ]
+
+    # Nothing to add, so no request
+    keybase_notifications.add_many([("os_version", {"username": "UUID1"})])
+    assert len(bulk_requests) == 1
+
+
+def test_notification_window():
+    storage = MemoryStorage()
+
+    # Two gateway workers, and the bot, share the storage
+    workers = [
+        KeybaseNotifications(settings_ttl=60, storage=storage) for _ in range(2)
+    ]
+    keybase_notifications = KeybaseNotifications(
+        settings_ttl=60, storage=storage, window=3600
+    )
+
+    def doc(username, action):
+        return {
+            "hostIdentifier": username,
+            "user_name": "Nick Fury",
+            "name": "installed_applications",
+            "action": action,
+            "columns": {},
+        }
+
+    # Five small batches from one host, that land on both workers, and one from
+    # another host
+    workers[0].add_many([("installed_applications", doc("UUID1", "added"))])
+    for i in range(3):
+        workers[i % 2].add_many([("installed_applications", doc("UUID1", "removed"))])
+    workers[1].add_many(
+        [
+            (
+                "installed_applications",
+                {
+                    "type": "summary",
+                    "username": "UUID1",
+                    "name": "Nick Fury",
+                    "added_count": 2,
+                    "removed_count": 0,
+                    "other_count": 1,
+                },
+            )
+        ]
+    )
+    workers[0].add_many([("installed_applications", doc("UUID2", "added"))])
+
+    # Warnings and other notifications aren't held
+    workers[1].add_many(
+        [
+            ("reverse_shell", doc("UUID1", "added")),
+            ("user_registered", {"username": "UUID3", "name": ""}),
+        ]
+    )
+
+    # Everything is saved right away
+    undelivered = storage.undelivered_notifications(10)
+    assert len(undelivered) == 8
+    created_at = undelivered[0].created_at
+
+    # Windows that haven't closed yet are held
+    groups, closes_at = keybase_notifications.window.group(undelivered, created_at)
+    assert [(notification, len(packed)) for notification, _, packed in groups] == [
+        ("reverse_shell", 1),
+        ("user_registered", 1),
+    ]
+    assert closes_at == created_at + timedelta(seconds=3600)
+
+    groups, closes_at = keybase_notifications.window.group(
+        undelivered, undelivered[-1].created_at + timedelta(seconds=3600)
+    )
+    assert closes_at is None
+    assert [(notification, len(packed)) for notification, _, packed in groups] == [
+        ("installed_applications", 5),
+        ("installed_applications", 1),
+        ("reverse_shell", 1),
+        ("user_registered", 1),
+    ]
+    assert [json.loads(details) for _, details, _ in groups[:2]] == [
+        {
+            "type": "summary",
+            "username": "UUID1",
+            "name": "Nick Fury",
+            "added_count": 3,
+            "removed_count": 3,
+            "other_count": 1,
+        },
+        doc("UUID2", "added"),
+    ]
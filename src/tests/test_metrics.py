@@ -0,0 +1,78 @@
+import os
+import sys
+import subprocess
+import urllib.request
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import multiprocess
+
+from flock_server.metrics import clear_multiprocess_dir, render, start_http_server
+
+
+def test_renders_metrics():
+    r = CollectorRegistry()
+    counter = Counter("test_requests_total", "Requests", ["route"], registry=r)
+    counter.labels(route="/ping").inc()
+    counter.labels(route="/ping").inc(2)
+    histogram = Histogram("test_seconds", "Seconds", buckets=(1, 5), registry=r)
+    histogram.observe(0.5)
+    histogram.observe(3)
+    Gauge("test_backlog", "Backlog", registry=r).set(7)
+
+    text = render(r)
+    assert "# TYPE test_requests_total counter" in text
+    assert 'test_requests_total{route="/ping"} 3.0' in text
+    assert 'test_seconds_bucket{le="1.0"} 1.0' in text
+    assert 'test_seconds_bucket{le="+Inf"} 2.0' in text
+    assert "test_seconds_sum 3.5" in text
+    assert "test_backlog 7.0" in text
+
+
+def test_http_server():
+    r = CollectorRegistry()
+    Counter("test_http_server_total", "Test", registry=r).inc()
+    server = start_http_server(0, host="127.0.0.1", registry=r)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        with urllib.request.urlopen(url) as res:
+            assert res.status == 200
+            assert "test_http_server_total 1.0" in res.read().decode()
+    finally:
+        server.shutdown()
+
+
+def test_multiprocess_metrics(tmp_path, monkeypatch):
+    # Each gunicorn worker writes its metrics to files in PROMETHEUS_MULTIPROC_DIR
+    def worker(indexed, queued):
+        code = (
+            "from flock_server.ingest import submitted_docs\n"
+            "from flock_server.ingest_queue import ingest_queue_docs\n"
+            f"submitted_docs.labels(outcome='indexed').inc({indexed})\n"
+            f"ingest_queue_docs.set({queued})\n"
+        )
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+        process = subprocess.Popen(
+            [sys.executable, "-c", code],
+            env=env,
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+        )
+        assert process.wait() == 0
+        return process.pid
+
+    first = worker(2, 10)
+    worker(3, 20)
+
+    # The master adds up every worker's metrics
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    text = render()
+    assert 'flock_submitted_docs_total{outcome="indexed"} 5.0' in text
+    assert "flock_ingest_queue_docs 30.0" in text
+
+    # Counters don't go backwards when a worker exits, but its gauges are dropped
+    multiprocess.mark_process_dead(first)
+    text = render()
+    assert 'flock_submitted_docs_total{outcome="indexed"} 5.0' in text
+    assert "flock_ingest_queue_docs 20.0" in text
+
+    clear_multiprocess_dir()
+    assert "flock_submitted_docs_total" not in render()
@@ -0,0 +1,76 @@
+from elasticsearch_dsl import Document, Index, Keyword, Search, Text
+
+from flock_server.elasticsearch import es
+from flock_server.migrate import _catch_up, _copy, migrate, needs_migration
+
+
+class OldUser(Document):
+    username = Text()
+
+    class Index:
+        name = "test_migrate_user"
+
+
+class NewUser(Document):
+    username = Keyword()
+
+    class Index:
+        name = "test_migrate_user"
+
+
+def test_migrate():
+    es.indices.delete(index="test_migrate_user*", ignore=[404])
+    es.indices.delete_alias(index="_all", name="test_migrate_user", ignore=[404])
+
+    OldUser.init()
+    OldUser(username="UUID1").save(refresh=True)
+    assert needs_migration(NewUser, "test_migrate_user")
+
+    # Term queries don't match analyzed text
+    r = Search(index="test_migrate_user").filter("term", username="UUID1").execute()
+    assert len(r) == 0
+
+    migrate(NewUser, log=lambda msg: None)
+    assert es.indices.exists_alias(name="test_migrate_user")
+    r = Search(index="test_migrate_user").filter("term", username="UUID1").execute()
+    assert len(r) == 1
+
+    # Migrating again does nothing
+    index_name = list(es.indices.get_alias(name="test_migrate_user").keys())[0]
+    assert not needs_migration(NewUser, index_name)
+    migrate(NewUser, log=lambda msg: None)
+    assert list(es.indices.get_alias(name="test_migrate_user").keys()) == [index_name]
+
+    # Writes go to the new index
+    NewUser(username="UUID2").save(refresh=True)
+    Index("test_migrate_user").refresh()
+    r = Search(index="test_migrate_user").filter("term", username="UUID2").execute()
+    assert len(r) == 1
+
+    es.indices.delete(index="test_migrate_user*", ignore=[404])
+
+
+def test_catch_up():
+    es.indices.delete(index="test_migrate_user*", ignore=[404])
+    es.indices.delete_alias(index="_all", name="test_migrate_user", ignore=[404])
+
+    OldUser.init()
+    OldUser(meta={"id": "1"}, username="UUID1").save(refresh=True)
+    OldUser(meta={"id": "2"}, username="UUID2").save(refresh=True)
+    NewUser._index.clone(name="test_migrate_user-new").create()
+    assert _copy("test_migrate_user", "test_migrate_user-new") == 2
+
+    # Updates and deletes made to the old index during the copy are caught up
+    OldUser(meta={"id": "1"}, username="UUID1-renamed").save(refresh=True)
+    OldUser.get(id="2").delete(refresh=True)
+    changed_count, old_ids = _catch_up("test_migrate_user", "test_migrate_user-new")
+    assert changed_count == 2
+    assert old_ids == {"1"}
+    user = NewUser.get(id="1", index="test_migrate_user-new")
+    assert user.username == "UUID1-renamed"
+    assert not NewUser.exists(id="2", index="test_migrate_user-new")
+
+    # Nothing left to catch up
+    assert _catch_up("test_migrate_user", "test_migrate_user-new")[0] == 0
+
+    es.indices.delete(index="test_migrate_user*", ignore=[404])
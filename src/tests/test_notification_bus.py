@@ -0,0 +1,175 @@
+import time
+import socket
+import asyncio
+import threading
+import pytest
+
+from flock_server import KeybaseNotifications, MemoryStorage
+from flock_server.keybase import notification_checker
+from flock_server.notification_bus import (
+    NotificationBus,
+    LocalBus,
+    SocketBus,
+    create_notification_bus,
+    local_bus,
+)
+
+
+def test_create_notification_bus():
+    assert type(create_notification_bus("")) == NotificationBus
+    assert create_notification_bus("local") is local_bus
+
+    bus = create_notification_bus("udp://keybase:9101")
+    assert (bus.family, bus.address) == (socket.AF_INET, ("keybase", 9101))
+    bus = create_notification_bus("unix:///run/flock/notify.sock")
+    assert (bus.family, bus.address) == (socket.AF_UNIX, "/run/flock/notify.sock")
+
+    with pytest.raises(ValueError):
+        create_notification_bus("carrier-pigeon://bot")
+
+
+@pytest.mark.asyncio
+async def test_local_bus():
+    bus = LocalBus()
+    bus.publish()
+    await bus.start()
+    assert not await bus.wait(0.01)
+
+    # The gateway publishes from its own threads
+    thread = threading.Thread(target=bus.publish)
+    thread.start()
+    thread.join()
+    assert await bus.wait(5)
+    assert not await bus.wait(0.01)
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("transport", ["udp", "unix"])
+async def test_socket_bus(transport, tmp_path):
+    if transport == "udp":
+        url = f"udp://127.0.0.1:{free_udp_port()}"
+    else:
+        url = f"unix://{tmp_path}/notify.sock"
+
+    # Publishing before the bot listens is harmless
+    gateway_bus = create_notification_bus(url)
+    gateway_bus.publish()
+
+    bot_bus = create_notification_bus(url)
+    await bot_bus.start()
+    gateway_bus.publish()
+    assert await bot_bus.wait(5)
+    assert not await bot_bus.wait(0.01)
+
+
+def test_socket_bus_resolves_again(monkeypatch):
+    # Two addresses the bot's hostname can point to, like before and after its
+    # container is recreated
+    receivers = []
+    for _ in range(2):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        receivers.append(receiver)
+
+    current = [receivers[0].getsockname()]
+    lookups = []
+
+    def getaddrinfo(host, port, family, type):
+        lookups.append(host)
+        return [(family, type, 0, "", current[0])]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    bus = SocketBus(socket.AF_INET, ("keybase", 9101), resolve_interval=3600)
+    bus.publish()
+    assert receivers[0].recv(16) == b"notify"
+
+    # The address isn't looked up again until resolve_interval has passed
+    current[0] = receivers[1].getsockname()
+    bus.publish()
+    assert receivers[0].recv(16) == b"notify"
+    assert lookups == ["keybase"]
+
+    bus.resolve_interval = 0
+    bus._resolve_at = 0
+    bus.publish()
+    assert receivers[1].recv(16) == b"notify"
+    assert lookups == ["keybase", "keybase"]
+
+    for receiver in receivers:
+        receiver.close()
+
+
+def test_socket_bus_publishes_from_threads(monkeypatch):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+    lookups = []
+
+    def getaddrinfo(host, port, family, type):
+        lookups.append(host)
+        time.sleep(0.05)
+        return [(family, type, 0, "", receiver.getsockname())]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    # Only one thread opens the socket and looks up the bot
+    bus = SocketBus(socket.AF_INET, ("keybase", 9101), resolve_interval=3600)
+    threads = [threading.Thread(target=bus.publish) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert lookups == ["keybase"]
+    for _ in range(8):
+        assert receiver.recv(16) == b"notify"
+    receiver.close()
+
+
+@pytest.mark.asyncio
+async def test_notification_checker_is_woken_up(monkeypatch):
+    monkeypatch.setenv("FLOCK_NOTIFICATION_POLL_INTERVAL", "3600")
+    storage = MemoryStorage()
+    bus = LocalBus()
+    sent = asyncio.Queue()
+
+    class Chat:
+        async def send(self, channel, message):
+            await sent.put(message)
+
+    class Bot:
+        chat = Chat()
+
+    checker = asyncio.ensure_future(
+        notification_checker("conv_id", Bot(), storage, bus)
+    )
+    try:
+        # Wait for the checker to start listening
+        while bus._loop is None:
+            await asyncio.sleep(0.01)
+
+        gateway = KeybaseNotifications(storage=storage, bus=bus)
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            gateway.add,
+            "reverse_shell",
+            {
+                "hostIdentifier": "UUID1",
+                "user_name": "Nick Fury",
+                "action": "added",
+                "calendarTime": "Mon Apr 20 12:00:00 2020 UTC",
+                "columns": {"pid": "1234"},
+            },
+        )
+        message = await asyncio.wait_for(sent.get(), 5)
+        assert "A reverse shell was detected" in message
+        assert storage.count_undelivered() == 0
+    finally:
+        checker.cancel()
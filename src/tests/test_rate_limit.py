@@ -0,0 +1,77 @@
+from flock_server import rate_limit
+from flock_server.rate_limit import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_limits_requests(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = RateLimiter(requests_per_second=0.5, requests_burst=2)
+
+    assert limiter.admit("UUID1") == 0
+    assert limiter.admit("UUID1") == 0
+    assert limiter.admit("UUID1") == 2
+
+    # Other hosts have their own buckets
+    assert limiter.admit("UUID2") == 0
+
+    clock.now += 2
+    assert limiter.admit("UUID1") == 0
+    assert limiter.admit("UUID1") == 2
+
+
+def test_limits_docs(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = RateLimiter(docs_per_second=10, docs_burst=100)
+
+    # A large batch is admitted, and then the host waits until it's paid for
+    assert limiter.admit("UUID1") == 0
+    limiter.consume_docs("UUID1", 150)
+    assert limiter.admit("UUID1") == 5
+
+    clock.now += 5
+    assert limiter.admit("UUID1") == 0
+
+
+def test_per_host_limits(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = RateLimiter(
+        requests_per_second=1,
+        requests_burst=1,
+        overrides={"noisy": {"requests_per_second": 0.1, "requests_burst": 1}},
+    )
+
+    assert limiter.admit("noisy") == 0
+    assert limiter.admit("noisy") == 10
+    assert limiter.admit("UUID1") == 0
+    assert limiter.admit("UUID1") == 1
+
+
+def test_unlimited_by_default():
+    limiter = RateLimiter()
+    for i in range(100):
+        assert limiter.admit("UUID1") == 0
+        limiter.consume_docs("UUID1", 1000)
+
+
+def test_forgets_least_recently_used_hosts(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = RateLimiter(requests_per_second=1, requests_burst=1, max_hosts=2)
+
+    assert limiter.admit("UUID1") == 0
+    assert limiter.admit("UUID2") == 0
+    assert limiter.admit("UUID3") == 0
+    assert len(limiter._buckets) == 2
+
+    # UUID1 was forgotten, so its bucket is full again
+    assert limiter.admit("UUID1") == 0
@@ -0,0 +1,98 @@
+import os
+
+from flock_server.spool import Spool
+
+
+class IndexStub:
+    """
+    Stub for indexing bulk actions into ElasticSearch
+    """
+
+    def __init__(self):
+        self.indexed = {}
+        self.available = True
+
+    def __call__(self, actions):
+        if not self.available:
+            raise Exception("ElasticSearch is down")
+        for action in actions:
+            self.indexed[action["_id"]] = action["_source"]
+        return len(actions), []
+
+
+def create_spool(directory, index_stub, **kwargs):
+    return Spool(
+        str(directory), index_stub, lambda: False, replay_interval=3600, **kwargs
+    )
+
+
+def test_replays_spooled_actions(tmp_path):
+    index_stub = IndexStub()
+    spool = create_spool(tmp_path, index_stub)
+
+    spool.append([{"_index": "flock", "_source": {"n": i}} for i in range(5)])
+    spool.append([{"_index": "flock", "_source": {"n": 5}}])
+    assert spool.replay() == 6
+    assert sorted(doc["n"] for doc in index_stub.indexed.values()) == list(range(6))
+
+    # Nothing is replayed twice
+    assert spool.replay() == 0
+
+
+def test_keeps_spooled_actions_while_elasticsearch_is_down(tmp_path):
+    index_stub = IndexStub()
+    spool = create_spool(tmp_path, index_stub)
+    spool.append([{"_index": "flock", "_source": {"n": 1}}])
+
+    index_stub.available = False
+    try:
+        spool.replay()
+        assert False
+    except Exception:
+        pass
+
+    index_stub.available = True
+    assert spool.replay() == 1
+
+
+def test_rolls_over_segments(tmp_path):
+    index_stub = IndexStub()
+    spool = create_spool(tmp_path, index_stub, segment_bytes=100)
+    for i in range(10):
+        spool.append([{"_index": "flock", "_source": {"n": i}}])
+    assert len(os.listdir(tmp_path / "0")) > 5
+
+    assert spool.replay() == 10
+    assert len(index_stub.indexed) == 10
+
+    # Replayed segments are deleted, except the one still being written
+    segments = [f for f in os.listdir(tmp_path / "0") if f.startswith("segment-")]
+    assert len(segments) == 1
+
+
+def test_resumes_from_checkpoint_after_restart(tmp_path):
+    index_stub = IndexStub()
+    spool = create_spool(tmp_path, index_stub, replay_batch_size=2)
+    spool.append([{"_index": "flock", "_source": {"n": i}} for i in range(3)])
+
+    # Fail after the first batch of 2
+    calls = []
+
+    def flaky_index(actions):
+        calls.append(actions)
+        if len(calls) > 1:
+            raise Exception("ElasticSearch is down")
+        return index_stub(actions)
+
+    spool.index_func = flaky_index
+    try:
+        spool.replay()
+    except Exception:
+        pass
+    assert len(index_stub.indexed) == 2
+
+    # A new process replays the slot that the old process left behind
+    spool._slot.release()
+    new_spool = create_spool(tmp_path, index_stub)
+    assert new_spool.replay() == 1
+    assert len(index_stub.indexed) == 3
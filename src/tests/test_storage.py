@@ -0,0 +1,321 @@
+import json
+import base64
+import pytest
+from datetime import datetime, timedelta
+
+from flock_server import create_api_app, MemoryStorage, NdjsonStorage
+from flock_server.storage import Storage
+from flock_server.elasticsearch import KeybaseNotification
+from flock_server.keybase import Handler, deliver_notifications
+
+
+@pytest.fixture(params=["memory", "ndjson"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStorage()
+    return NdjsonStorage(str(tmp_path))
+
+
+def notification(i):
+    return KeybaseNotification(
+        notification_type="user_registered",
+        details=json.dumps({"username": f"UUID{i}", "name": ""}),
+        delivered=False,
+        created_at=datetime.now(),
+    )
+
+
+def test_users(storage):
+    storage.add_user("UUID1", "Nick Fury", "token1")
+    storage.add_user("UUID2", "Jessica Jones", "token2")
+
+    assert storage.get_user("UUID1").name == "Nick Fury"
+    assert storage.get_user("UUID1", "token1").username == "UUID1"
+    assert storage.get_user("UUID1", "token2") is None
+    assert storage.get_user("UUID3") is None
+
+    storage.rename_user("UUID1", "Carol Danvers")
+    storage.delete_user("UUID2")
+    assert [(user.username, user.name) for user in storage.list_users()] == [
+        ("UUID1", "Carol Danvers")
+    ]
+
+    # Gateway processes find out which users changed
+    since = datetime.utcnow() - timedelta(minutes=1)
+    assert [username for username, _ in storage.user_changes(since)] == [
+        "UUID1",
+        "UUID2",
+    ]
+    assert storage.user_changes(datetime.utcnow() + timedelta(minutes=1)) == []
+
+
+def test_settings(storage):
+    assert storage.get_setting("keybase_notifications") is None
+    storage.save_setting("keybase_notifications", "{}")
+    storage.save_setting("keybase_notifications", '{"launchd": false}')
+    assert storage.get_setting("keybase_notifications") == '{"launchd": false}'
+
+
+def test_index_docs(storage):
+    actions = [
+        {"_index": "flock-2020-04-20", "_source": {"hostIdentifier": "UUID1"}},
+        {
+            "_op_type": "create",
+            "_index": "flock-2020-04-20",
+            "_id": "abc",
+            "_source": {"hostIdentifier": "UUID2", "name": "launchd"},
+        },
+    ]
+    assert storage.index_docs(actions) == (2, [])
+
+
+def test_host_states(storage):
+    storage.add_user("UUID1", "Nick Fury", "token1")
+    storage.update_host_states(
+        {
+            "UUID1": {
+                "last_seen": "2020-04-20T12:00:00.000Z",
+                "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+                "twigs": {"a": True},
+                "submit_count": 1,
+            },
+            "UUID2": {"last_seen": "2020-04-20T12:00:00.000Z"},
+        }
+    )
+    storage.update_host_states(
+        {
+            "UUID1": {
+                "last_seen": "2020-04-20T11:00:00.000Z",
+                "twigs": {"b": True},
+                "submit_count": 2,
+            }
+        }
+    )
+    assert storage.host_states(["UUID1", "UUID3"]) == {
+        "UUID1": {
+            "last_seen": "2020-04-20T12:00:00.000Z",
+            "os_version": {"name": "Mac OS X", "version": "10.15.4"},
+            "twigs": {"a": True, "b": True},
+            "submit_count": 3,
+        }
+    }
+
+    storage.delete_user("UUID1")
+    assert list(storage.host_states(["UUID1", "UUID2"])) == ["UUID2"]
+
+
+def test_incomplete_storage_cant_be_created():
+    class IncompleteStorage(Storage):
+        def get_user(self, username, token=None):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteStorage()
+
+
+def test_memory_storage_rejects_duplicates():
+    storage = MemoryStorage(max_docs=2)
+    action = {"_op_type": "create", "_index": "flock", "_id": "abc", "_source": {}}
+    assert storage.index_docs([action]) == (1, [])
+    indexed_count, failures = storage.index_docs([action])
+    assert indexed_count == 0
+    assert failures[0]["status"] == 409
+
+    storage.index_docs([{"_index": "flock", "_source": {"n": i}} for i in range(3)])
+    assert storage.docs("flock") == [{"n": 1}, {"n": 2}]
+
+
+def test_ndjson_storage_writes_bulk_files(tmp_path):
+    storage = NdjsonStorage(str(tmp_path))
+    storage.index_docs(
+        [
+            {"_index": "flock-2020-04-20", "_source": {"hostIdentifier": "UUID1"}},
+            {
+                "_op_type": "create",
+                "_index": "flock-2020-04-20",
+                "_id": "abc",
+                "_source": {"hostIdentifier": "UUID1"},
+            },
+        ]
+    )
+    lines = (tmp_path / "docs" / "flock-2020-04-20.ndjson").read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"index": {"_index": "flock-2020-04-20"}},
+        {"hostIdentifier": "UUID1"},
+        {"create": {"_index": "flock-2020-04-20", "_id": "abc"}},
+        {"hostIdentifier": "UUID1"},
+    ]
+
+
+def test_ndjson_storage_is_shared(tmp_path):
+    # Like the gateway and the bot, in different processes
+    gateway = NdjsonStorage(str(tmp_path))
+    bot = NdjsonStorage(str(tmp_path))
+
+    gateway.add_user("UUID1", "Nick Fury", "token1")
+    gateway.add_notifications([notification(1)])
+    assert bot.get_user("UUID1").name == "Nick Fury"
+    assert bot.count_undelivered() == 1
+
+    bot.rename_user("UUID1", "Carol Danvers")
+    bot.mark_delivered(bot.undelivered_notifications(10))
+    assert gateway.get_user("UUID1").name == "Carol Danvers"
+    assert gateway.count_undelivered() == 0
+
+    # Everything is still there after a restart, and partial lines are ignored
+    with open(tmp_path / "users.ndjson", "a") as f:
+        f.write('{"op": "delete", "user')
+    restarted = NdjsonStorage(str(tmp_path))
+    assert restarted.get_user("UUID1", "token1").name == "Carol Danvers"
+
+
+def test_ndjson_storage_reads_docs(tmp_path):
+    storage = NdjsonStorage(str(tmp_path))
+    action = {"_op_type": "create", "_index": "flock-a", "_id": "abc", "_source": {}}
+    storage.index_docs([action, {"_index": "flock-b", "_source": {"n": 1}}])
+    storage.index_docs([action, {"_index": "flock-a", "_source": {"n": 2}}])
+    with open(tmp_path / "docs" / "flock-a.ndjson", "a") as f:
+        f.write('{"index": {"_index": "flock-a"}}\n{"n": 3')
+
+    assert storage.docs("flock-a") == [{}, {"n": 2}]
+    assert storage.docs() == [{}, {"n": 2}, {"n": 1}]
+    assert storage.docs("flock-c") == []
+
+
+def test_ndjson_storage_compacts_logs(tmp_path):
+    gateway = NdjsonStorage(str(tmp_path), compact_bytes=1000)
+    bot = NdjsonStorage(str(tmp_path), compact_bytes=1000)
+
+    gateway.add_user("UUID1", "Nick Fury", "token1")
+    gateway.add_user("UUID2", "Jessica Jones", "token2")
+    bot.delete_user("UUID2")
+    for i in range(20):
+        gateway.add_notifications([notification(i)])
+        bot.mark_delivered(bot.undelivered_notifications(10)[:1])
+        gateway.rename_user("UUID1", f"Nick Fury {i}")
+        gateway.save_setting("delivery", i)
+        gateway.update_host_states({"UUID1": {"submit_count": 1}})
+    gateway.add_notifications([notification(20)])
+
+    # Every log was replaced by a snapshot of its state
+    for log_name in ["users", "settings", "notifications", "hosts"]:
+        size = (tmp_path / f"{log_name}.ndjson").stat().st_size
+        assert size < 1000
+
+    # Which the other process, and a new one, replay instead
+    for storage in [bot, NdjsonStorage(str(tmp_path))]:
+        assert storage.get_user("UUID1", "token1").name == "Nick Fury 19"
+        assert storage.get_user("UUID2") is None
+        assert [username for username, _ in storage.user_changes(datetime.min)][
+            -1
+        ] == "UUID1"
+        assert storage.get_setting("delivery") == 19
+        assert storage.host_states(["UUID1"])["UUID1"]["submit_count"] == 20
+        undelivered = storage.undelivered_notifications(10)
+        assert [n.details for n in undelivered] == [
+            json.dumps({"username": "UUID20", "name": ""})
+        ]
+
+    # Notifications keep their order
+    first = bot.undelivered_notifications(10)[0]
+    gateway.add_notifications([notification(21)])
+    assert len(bot.undelivered_notifications(10, after=first)) == 1
+
+
+def test_ndjson_storage_records_attempts(tmp_path):
+    gateway = NdjsonStorage(str(tmp_path))
+    bot = NdjsonStorage(str(tmp_path))
+    gateway.add_notifications([notification(0)])
+
+    (keybase_notification,) = bot.undelivered_notifications(10)
+    keybase_notification.attempts = 3
+    keybase_notification.next_attempt_at = datetime(2020, 4, 20, 12)
+    bot.record_attempts([keybase_notification])
+
+    # Failed attempts are kept when the log is replayed, and when it's compacted
+    for storage in [gateway, NdjsonStorage(str(tmp_path))]:
+        (keybase_notification,) = storage.undelivered_notifications(10)
+        assert keybase_notification.attempts == 3
+        assert keybase_notification.next_attempt_at == datetime(2020, 4, 20, 12)
+    gateway.compact("notifications")
+    (keybase_notification,) = NdjsonStorage(str(tmp_path)).undelivered_notifications(10)
+    assert keybase_notification.attempts == 3
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications(storage):
+    handler = Handler(storage)
+    storage.add_notifications([notification(i) for i in range(25)])
+
+    class Chat:
+        def __init__(self):
+            self.sent_messages = []
+
+        async def send(self, channel, message):
+            self.sent_messages.append(message)
+
+    class Bot:
+        chat = Chat()
+
+    bot = Bot()
+    backlog = await deliver_notifications(
+        "conv_id",
+        bot,
+        handler.keybase_notifications,
+        page_size=10,
+        max_per_cycle=20,
+    )
+    assert backlog
+    assert storage.count_undelivered() == 5
+
+    backlog = await deliver_notifications(
+        "conv_id", bot, handler.keybase_notifications, page_size=10
+    )
+    assert not backlog
+    assert storage.count_undelivered() == 0
+    for i in range(25):
+        assert sum(f"UUID{i}\"" in message for message in bot.chat.sent_messages) == 1
+
+
+def test_api_with_memory_storage():
+    app = create_api_app(
+        {"TESTING": True, "STORAGE": "memory", "HOST_STATE_INTERVAL": 3600}
+    )
+    client = app.test_client()
+    storage = app.extensions["flock_storage"]
+
+    res = client.post("/register", json={"username": "UUID1", "name": "Nick Fury"})
+    assert res.status_code == 200
+    credentials = f"UUID1:{res.json['auth_token']}"
+    auth_header = {
+        "Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}"
+    }
+
+    res = client.post(
+        "/submit",
+        json=[{"hostIdentifier": "UUID1", "name": "uptime", "unixTime": 1587384000}],
+        headers=auth_header,
+    )
+    assert res.status_code == 200
+    assert res.json["indexed_count"] == 1
+    assert storage.docs()[0]["username"] == "UUID1"
+
+    res = client.post(
+        "/submit_flock_logs",
+        json=[{"type": "server_enabled", "timestamp": "2020-04-20T12:00:00"}],
+        headers=auth_header,
+    )
+    assert res.status_code == 200
+
+    # The host's state is written when the tracker flushes
+    assert storage.host_states(["UUID1"]) == {}
+    app.extensions["flock_host_states"].flush()
+    host_state = storage.host_states(["UUID1"])["UUID1"]
+    assert host_state["last_result_at"] == "2020-04-20T12:00:00.000Z"
+    assert host_state["server_enabled"] is True
+    assert host_state["submit_count"] == 1
+    assert host_state["doc_count"] == 1
+    assert host_state["log_count"] == 1
+
+    # Registering and enabling the server sent Keybase notifications
+    assert storage.count_undelivered() == 2
@@ -0,0 +1,47 @@
+import io
+import json
+import pytest
+
+from flock_server.streaming import iter_json_array, NotAnArrayError, BodyTooLargeError
+
+
+def parse(data, **kwargs):
+    return list(iter_json_array(io.BytesIO(data.encode()), **kwargs))
+
+
+def test_parses_arrays():
+    docs = [{"hostIdentifier": "UUID1", "n": i, "name": "ünïcødé"} for i in range(100)]
+    assert parse(json.dumps(docs), read_size=7) == docs
+    assert parse(" [ ] ") == []
+    assert parse("[1, 22, 333]", read_size=1) == [1, 22, 333]
+    assert parse('[{"a": [1, 2, {"b": "]"}]}, null]', read_size=3) == [
+        {"a": [1, 2, {"b": "]"}]},
+        None,
+    ]
+
+
+def test_rejects_non_arrays():
+    with pytest.raises(NotAnArrayError):
+        parse('{"hostIdentifier": "UUID1"}')
+    with pytest.raises(NotAnArrayError):
+        parse("")
+
+
+def test_rejects_invalid_json():
+    for data in ["not json", "[1,]", "[1 2]", '[{"a": 1}', "[1] 2", "[1"]:
+        with pytest.raises(ValueError):
+            parse(data, read_size=2)
+
+
+def test_yields_items_before_reading_everything():
+    stream = io.BytesIO(json.dumps([{"n": i} for i in range(1000)]).encode())
+    items = iter_json_array(stream, read_size=64)
+    assert next(items) == {"n": 0}
+    assert stream.tell() < 1000
+
+
+def test_max_bytes():
+    data = json.dumps([{"n": i} for i in range(1000)])
+    with pytest.raises(BodyTooLargeError):
+        parse(data, read_size=64, max_bytes=1000)
+    assert len(parse(data, max_bytes=len(data))) == 1000